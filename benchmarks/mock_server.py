@@ -0,0 +1,124 @@
+"""
+A local stand-in XYZ tile server for the benchmarks.
+
+    python benchmarks/mock_server.py --port 8765 --latency 50 --jitter 20 --error-rate .05 --format jpeg
+    # http://127.0.0.1:8765/{z}/{x}/{y}
+"""
+import io
+import time
+import random
+import asyncio
+import argparse
+import threading
+import numpy as np
+from PIL import Image
+from aiohttp import web
+
+FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+
+def make_tiles(fmt="png", n=16, size=256, seed=0):
+    """`n` encoded tiles of smooth noise, compressing like imagery rather than a flat color."""
+    rng = np.random.default_rng(seed)
+    res = []
+    for _ in range(n):
+        coarse = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=np.uint8)
+        img = Image.fromarray(coarse).resize((size, size), Image.BICUBIC)
+        arr = np.asarray(img).astype(np.int16) + rng.integers(-12, 13, (size, size, 3))
+        with io.BytesIO() as stream:
+            Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8)).save(stream, FORMATS[fmt][0])
+            res.append(stream.getvalue())
+
+    return res
+
+
+class MockTileServer():
+    """XYZ tile server with a configurable latency, error rate and tile format, in a daemon thread.
+
+    Args:
+        port (int, optional): 0 for a free port. Defaults to 0.
+        latency (float, optional): the mean delay of a response, in seconds. Defaults to 0.
+        jitter (float, optional): the delay is uniform in `latency` +/- `jitter`. Defaults to 0.
+        error_rate (float, optional): the share of the requests answered with a 503. Defaults to 0.
+        fmt (str, optional): png, jpeg or webp. Defaults to 'png'.
+
+    Example:
+        >>> server = MockTileServer(latency=.05, error_rate=.01).start()
+        >>> server.url
+        'http://127.0.0.1:40125/{z}/{x}/{y}'
+    """
+
+    def __init__(self, port=0, latency=0., jitter=0., error_rate=0., fmt="png", seed=0):
+        assert fmt in FORMATS, f"Check fmt is within {list(FORMATS)}."
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fmt = fmt
+        self.tiles = make_tiles(fmt, seed=seed)
+        self.stats = {"requests": 0, "errors": 0, "bytes": 0}
+        self._random = random.Random(seed)
+        self._loop = None
+        self._runner = None
+
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/{{z}}/{{x}}/{{y}}"
+
+
+    async def handle(self, request):
+        self.stats["requests"] += 1
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self._random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=503)
+
+        info = request.match_info
+        key = int(info["z"]) * 7919 + int(info["x"]) * 31 + int(info["y"])
+        body = self.tiles[key % len(self.tiles)]
+        self.stats["bytes"] += len(body)
+
+        return web.Response(body=body, content_type=FORMATS[self.fmt][1])
+
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get(r"/{z:\d+}/{x:-?\d+}/{y:-?\d+}", self.handle)
+        self._loop = asyncio.new_event_loop()
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+        return self
+
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A local stand-in XYZ tile server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="ms")
+    parser.add_argument("--jitter", type=float, default=0, help="ms")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--format", default="png", choices=list(FORMATS))
+    args = parser.parse_args()
+
+    server = MockTileServer(args.port, args.latency / 1000, args.jitter / 1000, args.error_rate, args.format).start()
+    print(f"Serving {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,287 @@
+"""
+End-to-end fetch / merge benchmarks against the local mock tile server.
+
+    python benchmarks/run.py --latency 30 --jitter 10 --error-rate .01 --format jpeg -o results.json
+    python benchmarks/run.py -o new.json --compare results.json
+
+Every scenario runs over a cold cache (an empty folder) and then a warm one
+(the tiles left on disk by the cold run), each run in a fresh process, so the
+peak RSS and the in-memory caches belong to that run alone.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import resource
+import subprocess
+import numpy as np
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_server import MockTileServer, FORMATS
+
+SCENARIOS = ["fetch_tiles", "bounds2img", "add_basemap", "baidu"]
+BBOX = (113.90, 22.50, 114.00, 22.60)
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+    return None
+
+
+def _timed(owner, name, bucket):
+    """Record the seconds of each call of `owner.name` into `bucket`."""
+    func = getattr(owner, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            bucket.append(time.perf_counter() - start)
+
+    setattr(owner, name, wrapper)
+
+
+def _instrument_fetcher(bucket):
+    """Record the seconds from the scheduling of a tile to its content, the waits of the
+    rate limiter and the retries included."""
+    from tilemap.fetcher import AsyncFetcher
+    fetch_url = AsyncFetcher._fetch_url
+
+    async def _fetch_url(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fetch_url(self, *args, **kwargs)
+        finally:
+            bucket.append(time.perf_counter() - start)
+
+    AsyncFetcher._fetch_url = _fetch_url
+
+
+def run_scenario(name, cfg):
+    """Run the scenario `name` once in this process, return its measures."""
+    import mercantile as mt
+    from tilemap import TileMap, TileProvider
+    from tilemap import tile as tile_module
+    from tilemap.coordtransform import baidutile
+    from tilemap.mosaic import Mosaic
+
+    sys_ = 'bd' if name == 'baidu' else 'wgs'
+    provider = TileProvider(
+        name=f"Bench.{sys_}", url=cfg["url"], sys=sys_, max_zoom=20, attribution="", rate_limit=cfg["rate_limit"])
+    latencies, merges = [], []
+    _instrument_fetcher(latencies)
+    _timed(tile_module, "_merge_tiles", merges)
+    _timed(Mosaic, "put", merges)
+    _timed(baidutile, "merge_tiles_bd", merges)
+
+    w, s, e, n = cfg["bbox"]
+    z = cfg["zoom"]
+    kwargs = dict(cache_folder=cfg["cache_folder"], cache=cfg["cache"], concurrency=cfg["concurrency"],
+                  limit_per_host=cfg["limit_per_host"], throttle=cfg["throttle"])
+    base_rss = _rss_mb()
+    extra = {}
+
+    start = time.perf_counter()
+    if name == "fetch_tiles":
+        tm = TileMap(provider, **kwargs)
+        tiles, _ = tm.fetch_tiles(w, s, e, n, zoom=z, wait=cfg["wait"], max_retries=cfg["max_retries"])
+        n_tiles = len(tiles)
+    elif name == "bounds2img":
+        tm = TileMap(provider, **kwargs)
+        img, _ = tm.bounds2img(w, s, e, n, zoom=z, wait=cfg["wait"], max_retries=cfg["max_retries"])
+        n_tiles = len(list(mt.tiles(w, s, e, n, [z])))
+        extra["shape"] = list(img.shape)
+    elif name == "add_basemap":
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        from tilemap.plotting import add_basemap
+
+        fig, ax = plt.subplots()
+        ax.axis((w, e, s, n))
+        add_basemap(ax, zoom=z, provider=provider, cache_folder=cfg["cache_folder"])
+        plt.close(fig)
+        n_tiles = len(list(mt.tiles(w, s, e, n, [z])))
+    elif name == "baidu":
+        from tilemap.coordtransform import wgs84_to_bd09
+        tm = TileMap(provider, **kwargs)
+        bw, bs = wgs84_to_bd09(w, s)
+        be, bn = wgs84_to_bd09(e, n)
+        t0 = time.perf_counter()
+        tiles = list(baidutile.tiles_bd(bw, bs, be, bn, [z]))
+        extra["tiles_bd_s"] = time.perf_counter() - t0
+        arrays = tm._fetch_tiles(tiles, cfg["wait"], cfg["max_retries"])
+        img, _ = baidutile.merge_tiles_bd(tiles, arrays)
+        n_tiles = len(tiles)
+        extra["shape"] = list(img.shape)
+    else:
+        raise ValueError(f"Unknown scenario {name}.")
+    elapsed = time.perf_counter() - start
+
+    lat = np.array(latencies) * 1000
+    return {
+        "tiles": n_tiles,
+        "seconds": elapsed,
+        "tiles_per_s": n_tiles / elapsed if elapsed else None,
+        "requests": len(latencies),
+        "latency_p50_ms": float(np.percentile(lat, 50)) if len(lat) else None,
+        "latency_p99_ms": float(np.percentile(lat, 99)) if len(lat) else None,
+        "merge_s": sum(merges) if merges else None,
+        "base_rss_mb": base_rss,
+        # ru_maxrss is in KB on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **extra,
+    }
+
+
+def _run_isolated(name, cfg):
+    ctx = mp.get_context("spawn")
+    pool = ctx.Pool(1)
+    try:
+        return pool.apply(run_scenario, (name, cfg))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _git_commit():
+    try:
+        res = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return res.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    server = MockTileServer(
+        latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate, fmt=args.format).start()
+    workdir = tempfile.mkdtemp(prefix="tilemap-bench-")
+    results = []
+    try:
+        for name in args.scenarios:
+            for i in range(args.repeat):
+                cache_folder = os.path.join(workdir, f"{name}-{i}")
+                cfg = {
+                    "url": server.url,
+                    "bbox": args.bbox,
+                    "zoom": args.zoom,
+                    "cache_folder": cache_folder,
+                    "cache": args.cache,
+                    "concurrency": args.concurrency,
+                    "limit_per_host": args.limit_per_host,
+                    "throttle": not args.no_throttle,
+                    "rate_limit": args.rate_limit,
+                    "wait": args.wait,
+                    "max_retries": args.max_retries,
+                }
+                for state in ["cold", "warm"]:
+                    before = dict(server.stats)
+                    res = _run_isolated(name, cfg)
+                    res.update(
+                        scenario=name,
+                        cache_state=state,
+                        run=i,
+                        server_requests=server.stats["requests"] - before["requests"],
+                        server_errors=server.stats["errors"] - before["errors"],
+                    )
+                    results.append(res)
+                    print(_format_row(res))
+                shutil.rmtree(cache_folder, ignore_errors=True)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "params": {k: v for k, v in vars(args).items() if k not in ["output", "compare"]},
+        },
+        "results": results,
+        "summary": summarize(results),
+    }
+
+
+def summarize(results):
+    """The median of the repeated runs, keyed by 'scenario/cache_state'."""
+    groups = {}
+    for res in results:
+        groups.setdefault(f"{res['scenario']}/{res['cache_state']}", []).append(res)
+
+    summary = {}
+    for key, items in groups.items():
+        summary[key] = {}
+        for metric in ["tiles_per_s", "seconds", "latency_p50_ms", "latency_p99_ms", "merge_s", "peak_rss_mb"]:
+            values = [i[metric] for i in items if i.get(metric) is not None]
+            summary[key][metric] = float(np.median(values)) if values else None
+
+    return summary
+
+
+def compare(summary, baseline):
+    """Print the relative change of every metric against the summary of a previous run."""
+    print(f"\n{'':<24} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for key, metrics in summary.items():
+        for metric, value in metrics.items():
+            old = baseline.get(key, {}).get(metric)
+            if value is None or not old:
+                continue
+            print(f"{key:<24} {metric:<16} {old:>10.2f} {value:>10.2f} {(value - old) / old:>+8.1%}")
+
+
+def _format_row(res):
+    p50 = f"{res['latency_p50_ms']:.1f}" if res["latency_p50_ms"] is not None else "-"
+    p99 = f"{res['latency_p99_ms']:.1f}" if res["latency_p99_ms"] is not None else "-"
+    merge = f"{res['merge_s']:.3f}" if res["merge_s"] is not None else "-"
+    return (f"{res['scenario']:<12} {res['cache_state']:<5} tiles {res['tiles']:>5} "
+            f"{res['tiles_per_s']:>8.1f} tiles/s  p50 {p50:>7} ms  p99 {p99:>7} ms  "
+            f"merge {merge:>6} s  peak rss {res['peak_rss_mb']:.0f} MB")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the fetch and merge paths against a local mock tile server.")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--bbox", nargs=4, type=float, default=BBOX, metavar=("W", "S", "E", "N"))
+    parser.add_argument("-z", "--zoom", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=20, help="the mean latency of the mock server, in ms")
+    parser.add_argument("--jitter", type=float, default=5, help="ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="the share of 503 responses")
+    parser.add_argument("--format", default="png", choices=list(FORMATS))
+    parser.add_argument("--cache", default="dir", choices=["dir", "mbtiles"])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--limit-per-host", type=int, default=8)
+    parser.add_argument("--rate-limit", type=float, default=1000, help="the `rate_limit` of the mock provider")
+    parser.add_argument("--no-throttle", action="store_true")
+    parser.add_argument("--wait", type=float, default=.1)
+    parser.add_argument("--max-retries", type=int, default=2)
+    parser.add_argument("-o", "--output", help="write the results into a json file")
+    parser.add_argument("--compare", help="the json of a previous run to compare with")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report["summary"], json.load(f)["summary"])
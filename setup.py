@@ -33,4 +33,5 @@ setup(
     python_requires=">=3.6",
     install_requires=install_requires,
     zip_safe=False,
+    entry_points={"console_scripts": ["tilemap=tilemap.cli:main"]},
 )
\ No newline at end of file
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+from tilemap import TileMap, TileProvider
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "benchmarks"))
+from mock_server import MockTileServer
+
+
+@pytest.fixture(scope="session")
+def server():
+    server = MockTileServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="session")
+def flaky_server():
+    # half of the requests are answered with a 503
+    server = MockTileServer(error_rate=.5).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_tilemap(tmp_path, server):
+    """`make_tilemap(url=None, sys='wgs', **kwargs)`, a `TileMap` of the mock `server` cached in `tmp_path`.
+
+    The provider is named after the test, the array caches shared by the
+    instances of a provider do not leak from one test into another.
+    """
+    tms = []
+
+    def make(url=None, sys="wgs", **kwargs):
+        provider = TileProvider(name=f"Mock.{tmp_path.name}", url=url or server.url, sys=sys, max_zoom=18,
+                                attribution="", rate_limit=1000)
+        tm = TileMap(provider, cache_folder=tmp_path, **kwargs)
+        tms.append(tm)
+        return tm
+
+    yield make
+    for tm in tms:
+        tm.close()
@@ -0,0 +1,164 @@
+"""
+Generate the MVT fixtures of `tests/test_vector.py`.
+
+The tiles are written by the reference encoder `mapbox-vector-tile`, only the
+tile with a hole before its shell is assembled from raw geometry commands,
+serialized by `protobuf` as well; neither is a dependency of tilemap.
+
+    $ pip install mapbox-vector-tile
+    $ python tests/fixtures/mvt/make_fixtures.py
+
+`expected.json` keeps the source geometries in wgs84 lon/lat (WKT), the
+decoded ones are only equal up to the pixel grid of the tiles.
+"""
+import gzip
+import json
+from pathlib import Path
+
+import numpy as np
+import shapely
+import mercantile as mt
+import mapbox_vector_tile
+from mapbox_vector_tile.Mapbox import vector_tile_pb2
+from shapely.geometry import LineString, MultiLineString, MultiPoint, MultiPolygon, Point, Polygon, box
+
+FOLDER = Path(__file__).parent
+EXTENT = 4096
+BUFFER = 64
+TILE = mt.tile(113.93, 22.57, 14)
+EAST = mt.Tile(TILE.x + 1, TILE.y, TILE.z)
+
+
+def transform(geom, fn):
+    return shapely.transform(geom, lambda coords: np.array([fn(x, y) for x, y in coords]))
+
+
+def to_merc(geom):
+    return transform(geom, mt.xy)
+
+
+def pixels_to_lonlat(geom, tile):
+    """Pixels (y down) of `tile` -> lon/lat, through the mercator bounds of the tile."""
+    b = mt.xy_bounds(tile)
+    fn = lambda x, y: mt.lnglat(b.left + x / EXTENT * (b.right - b.left), b.top - y / EXTENT * (b.top - b.bottom))
+    return transform(geom, fn)
+
+
+def lonlat(tile, fx, fy):
+    """The lon/lat at the fractions (fx, fy) of `tile`, from its north west corner."""
+    b = mt.bounds(tile)
+    return b.west + fx * (b.east - b.west), b.north - fy * (b.north - b.south)
+
+
+def encode(tile, layers):
+    """Encode {name: [(id, props, lon/lat geometry)]}, clipped to the buffer of `tile`."""
+    b = mt.xy_bounds(tile)
+    pad = BUFFER / EXTENT * (b.right - b.left)
+    clip = box(b.left - pad, b.bottom - pad, b.right + pad, b.top + pad)
+    res = []
+    for name, features in layers.items():
+        feats = []
+        for fid, props, geom in features:
+            geom = to_merc(geom).intersection(clip)
+            if geom.is_empty:
+                continue
+            feat = {"geometry": geom.wkt, "properties": props}
+            if fid is not None:
+                feat["id"] = fid
+            feats.append(feat)
+        res.append({"name": name, "features": feats})
+
+    return mapbox_vector_tile.encode(res, default_options={"quantize_bounds": tuple(b), "extents": EXTENT})
+
+
+def ring_commands(ring):
+    """MoveTo, LineTo and ClosePath of an unclosed ring, the cursor starting at (0, 0)."""
+    zigzag = lambda n: (n << 1) ^ (n >> 31)
+    cmds, (cx, cy) = [], (0, 0)
+    for i, (x, y) in enumerate(ring):
+        if i == 0:
+            cmds.append(1 | 1 << 3)
+        elif i == 1:
+            cmds.append(2 | (len(ring) - 1) << 3)
+        cmds += [zigzag(x - cx), zigzag(y - cy)]
+        cx, cy = x, y
+
+    return cmds + [7 | 1 << 3]
+
+
+def hole_first_tile():
+    # pixels, y down: the shell is clockwise on screen (positive area), the hole counter clockwise
+    shell = [(1000, 1000), (3000, 1000), (3000, 3000), (1000, 3000)]
+    hole = [(1500, 1500), (1500, 2500), (2500, 2500), (2500, 1500)]
+    tile = vector_tile_pb2.tile()
+    layer = tile.layers.add()
+    layer.name, layer.version, layer.extent = "buildings", 2, EXTENT
+    layer.keys.append("kind")
+    layer.values.add().string_value = "courtyard"
+    feature = layer.features.add()
+    feature.id, feature.type = 7, vector_tile_pb2.tile.Polygon
+    feature.tags.extend([0, 0])
+    # the cursor carries over from the hole to the shell
+    cmds = ring_commands(hole)
+    end = hole[-1]
+    shifted = [(x - end[0], y - end[1]) for x, y in shell]
+    cmds += ring_commands(shifted)
+    feature.geometry.extend(cmds)
+
+    return tile.SerializeToString(), pixels_to_lonlat(Polygon(shell, [hole]), TILE)
+
+
+def main():
+    expected = {}
+
+    # multi-part geometries of every type, with ids and properties of every value type
+    pts = MultiPoint([lonlat(TILE, .2, .2), lonlat(TILE, .4, .3), lonlat(TILE, .6, .7)])
+    roads = MultiLineString([[lonlat(TILE, .1, .5), lonlat(TILE, .5, .5)], [lonlat(TILE, .6, .1), lonlat(TILE, .6, .9)]])
+    square = lambda x0, y0, x1, y1: [lonlat(TILE, x0, y0), lonlat(TILE, x1, y0), lonlat(TILE, x1, y1), lonlat(TILE, x0, y1)]
+    buildings = MultiPolygon([
+        Polygon(square(.1, .1, .3, .3)),
+        Polygon(square(.5, .5, .9, .9), [square(.6, .6, .8, .8)]),
+    ])
+    layers = {
+        "poi": [(1, {"name": "kiosk", "rank": 3, "delta": -7, "score": 1.5, "open": True}, pts)],
+        "roads": [(2, {"class": "primary"}, roads)],
+        "buildings": [(3, {"height": 12.5}, buildings)],
+    }
+    content = encode(TILE, layers)
+    (FOLDER / "multipart.pbf").write_bytes(content)
+    (FOLDER / "multipart.pbf.gz").write_bytes(gzip.compress(content, mtime=0))
+    expected["multipart"] = {name: [[fid, props, geom.wkt] for fid, props, geom in feats] for name, feats in layers.items()}
+
+    # features without an id
+    layers = {"poi": [
+        (None, {"name": "a"}, Point(lonlat(TILE, .25, .25))),
+        (None, {"name": "b"}, Point(lonlat(TILE, .75, .75))),
+    ]}
+    (FOLDER / "no_id.pbf").write_bytes(encode(TILE, layers))
+    expected["no_id"] = {name: [[fid, props, geom.wkt] for fid, props, geom in feats] for name, feats in layers.items()}
+
+    # a hole before its shell
+    content, geom = hole_first_tile()
+    (FOLDER / "hole_first.pbf").write_bytes(content)
+    expected["hole_first"] = {"buildings": [[7, {"kind": "courtyard"}, geom.wkt]]}
+
+    # a road and a building across the boundary of two tiles, without ids
+    road = LineString([lonlat(TILE, .3, .4), lonlat(TILE, 1.5, .6)])
+    house = Polygon(square(.8, .2, 1.3, .5))
+    layers = {"roads": [(None, {"class": "primary"}, road)], "buildings": [(None, {"kind": "house"}, house)]}
+    for tile, fn in [(TILE, "split_west.pbf"), (EAST, "split_east.pbf")]:
+        (FOLDER / fn).write_bytes(encode(tile, layers))
+    expected["split"] = {name: [[fid, props, geom.wkt] for fid, props, geom in feats] for name, feats in layers.items()}
+
+    expected["tiles"] = {"tile": list(TILE), "east": list(EAST)}
+    with open(FOLDER / "expected.json", "w") as f:
+        json.dump(expected, f, indent=2)
+
+    # the reference decoder reads the tiles back
+    for fn in sorted(FOLDER.glob("*.pbf")):
+        layers = mapbox_vector_tile.decode(fn.read_bytes(), default_options={"y_coord_down": True})
+        print(fn.name, {name: [f["geometry"]["type"] for f in layer["features"]] for name, layer in layers.items()})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import pickle
+import sqlite3
+
+import numpy as np
+import pytest
+import mercantile as mt
+
+from tilemap.cache import DirectoryCache, MBTilesCache
+
+TILES = [mt.Tile(x, y, 16) for x in range(53440, 53443) for y in range(28480, 28482)]
+CONTENTS = [f"{t.z}/{t.x}/{t.y}".encode() * 64 for t in TILES]
+# e.g. the blank tiles of the sea
+BLANK = b"blank" * 64
+
+
+def open_cache(kind, folder, **kwargs):
+    if kind == "dir":
+        return DirectoryCache(folder / "tiles", **kwargs)
+    return MBTilesCache(folder / "tiles.mbtiles", **kwargs)
+
+
+@pytest.mark.parametrize("kind", ["dir", "mbtiles"])
+def test_round_trip(kind, tmp_path):
+    cache = open_cache(kind, tmp_path)
+    for tile, content in zip(TILES, CONTENTS):
+        cache.put(tile, content)
+    # the pending tiles of the mbtiles are read before they are committed
+    assert cache.get(TILES[0]) == CONTENTS[0]
+    assert cache.get(mt.Tile(0, 0, 16)) is None
+    assert cache.exists(TILES[-1]) and not cache.exists(mt.Tile(0, 0, 16))
+    cache.close()
+
+    cache = open_cache(kind, tmp_path)
+    assert [cache.get(t) for t in TILES] == CONTENTS
+    assert sorted(cache.tiles(16)) == sorted(TILES)
+    assert list(cache.tiles(15)) == []
+
+    cache.put(TILES[0], b"new")
+    cache.flush()
+    assert cache.get(TILES[0]) == b"new"
+    assert cache.get(TILES[1]) == CONTENTS[1]
+    cache.close()
+
+
+@pytest.mark.parametrize("flip_y", [True, False])
+def test_mbtiles_scheme(flip_y, tmp_path):
+    cache = MBTilesCache(tmp_path / "tiles.mbtiles", fmt="jpg", flip_y=flip_y)
+    cache.put(TILES[0], CONTENTS[0])
+    cache.close()
+
+    with sqlite3.connect(tmp_path / "tiles.mbtiles") as conn:
+        meta = dict(conn.execute("SELECT name, value FROM metadata"))
+        rows = conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles").fetchall()
+    assert meta == {"name": "tiles", "format": "jpg", "scheme": "tms" if flip_y else "xyz"}
+    tile = TILES[0]
+    assert rows == [(tile.z, tile.x, (1 << tile.z) - 1 - tile.y if flip_y else tile.y)]
+
+
+def test_mbtiles_batches(tmp_path):
+    cache = MBTilesCache(tmp_path / "tiles.mbtiles", batch_size=4)
+    for tile, content in zip(TILES, CONTENTS):
+        cache.put(tile, content)
+    # one batch committed, the others pending
+    assert len(cache._pending) == len(TILES) - 4
+    with sqlite3.connect(tmp_path / "tiles.mbtiles") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 4
+
+    # a worker process gets the committed tiles and its own connection
+    other = pickle.loads(pickle.dumps(cache))
+    assert other._conn is None and other._pending == {}
+    assert [other.get(t) for t in TILES] == CONTENTS
+    other.close()
+    cache.close()
+
+
+@pytest.mark.parametrize("kind", ["dir", "mbtiles"])
+def test_dedup(kind, tmp_path):
+    cache = open_cache(kind, tmp_path, dedup=True)
+    for tile in TILES[:-1]:
+        cache.put(tile, BLANK)
+    cache.put(TILES[-1], CONTENTS[-1])
+    assert cache.dedup_stats() == {"tiles": len(TILES), "blobs": 2, "blob_bytes": len(BLANK) + len(CONTENTS[-1])}
+    cache.close()
+
+    cache = open_cache(kind, tmp_path, dedup=True)
+    assert [cache.get(t) for t in TILES] == [BLANK] * (len(TILES) - 1) + [CONTENTS[-1]]
+    assert sorted(cache.tiles(16)) == sorted(TILES)
+    # a rewritten tile leaves the tiles sharing its former blob alone
+    cache.put(TILES[0], CONTENTS[0])
+    assert cache.get(TILES[0]) == CONTENTS[0] and cache.get(TILES[1]) == BLANK
+    assert cache.dedup_stats()["tiles"] == len(TILES)
+    cache.close()
+
+
+def test_directory_links(tmp_path):
+    cache = DirectoryCache(tmp_path / "tiles", dedup=True)
+    cache.put(TILES[0], BLANK)
+    cache.put(TILES[1], BLANK)
+    assert os.path.samefile(cache.path(TILES[0]), cache.path(TILES[1]))
+
+    # a plain cache on the same folder replaces the link, the blob is untouched
+    plain = DirectoryCache(tmp_path / "tiles")
+    plain.put(TILES[0], CONTENTS[0])
+    assert plain.get(TILES[0]) == CONTENTS[0] and plain.get(TILES[1]) == BLANK
+    assert not list((tmp_path / "tiles").rglob("*.tmp"))
+
+
+def test_mbtiles_keeps_schema(tmp_path):
+    cache = MBTilesCache(tmp_path / "tiles.mbtiles")
+    cache.put(TILES[0], BLANK)
+    cache.close()
+
+    cache = MBTilesCache(tmp_path / "tiles.mbtiles", dedup=True)
+    assert not cache.dedup
+    cache.put(TILES[1], BLANK)
+    assert cache.get(TILES[0]) == cache.get(TILES[1]) == BLANK
+    cache.close()
+
+    with sqlite3.connect(tmp_path / "tiles.mbtiles") as conn:
+        assert conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone() == ("table", )
+
+
+def test_dedup_arrays(make_tilemap):
+    # the mock server serves 16 distinct tiles, the duplicated tiles share one decoded array
+    tm = make_tilemap(dedup=True)
+    bbox = (113.93, 22.56, 113.95, 22.58)
+    img, _ = tm.bounds2img(*bbox, zoom=17)
+    tiles = tm._bbox_tiles(*bbox, zoom=17)
+    n_blobs = tm.cache.dedup_stats()["blobs"]
+    assert len(tiles) > n_blobs == len({tm.cache.get(t) for t in tiles})
+    assert len(tm.arrays) == n_blobs
+
+    plain, _ = make_tilemap(cache="mbtiles", array_cache_bytes=0).bounds2img(*bbox, zoom=17)
+    assert np.array_equal(img, plain)
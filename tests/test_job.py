@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from tilemap import job
+from tilemap.job import CrawlJob, DONE, FAILED, PENDING
+
+BBOX = (113.93, 22.56, 113.95, 22.58)
+ZOOMS = [15, 16]
+
+
+class Batches(list):
+    # the crawl is interrupted (Ctrl-C) on the batch `interrupt_at`
+    interrupt_at = None
+
+
+@pytest.fixture
+def walked(monkeypatch):
+    """The batches of tiles handed to the fetcher by `CrawlJob.run`."""
+    batches = Batches()
+    crawl_batch = job._crawl_batch
+
+    def record(tm, tiles, policy, skip_cached=True):
+        if len(batches) == batches.interrupt_at:
+            raise KeyboardInterrupt
+        batches.append(tiles)
+        return crawl_batch(tm, tiles, policy, skip_cached)
+
+    monkeypatch.setattr(job, "_crawl_batch", record)
+    return batches
+
+
+def pending(crawl):
+    return {t for z, g in crawl.grids.items() for t in crawl._tiles(z, np.flatnonzero(g["state"] == PENDING))}
+
+
+def test_resume(make_tilemap, walked, tmp_path):
+    tm = make_tilemap()
+    manifest = tmp_path / "crawl.npz"
+    crawl = CrawlJob(tm, manifest, BBOX, ZOOMS)
+    total = sum(g["state"].size for g in crawl.grids.values())
+    assert manifest.exists() and len(pending(crawl)) == total
+
+    walked.interrupt_at = 2
+    with pytest.raises(KeyboardInterrupt):
+        crawl.run(batch_size=4, wait=0)
+    assert len(walked) == 2
+    done = {t for batch in walked for t in batch}
+
+    # the manifest is checkpointed on the interruption, bounds and zooms are not needed to resume
+    resumed = CrawlJob(tm, manifest)
+    assert resumed.bounds == crawl.bounds
+    todo = pending(resumed)
+    assert len(todo) == total - len(done) and not todo & done
+
+    walked.clear()
+    walked.interrupt_at = None
+    stats = resumed.run(batch_size=4, wait=0, skip_cached=False)
+    assert {t for batch in walked for t in batch} == todo
+    assert sum(s["done"] for s in stats.values()) == total
+    assert all(tm.cache.exists(t) for t in todo | done)
+
+
+def test_retry_failed(make_tilemap, walked, tmp_path):
+    crawl = CrawlJob(make_tilemap(), tmp_path / "crawl.npz", BBOX, ZOOMS)
+    grid = crawl.grids[16]
+    grid["state"][:] = DONE
+    grid["state"][:3] = FAILED
+    crawl.grids[15]["state"][:] = DONE
+    failed = crawl.failed_tiles()
+
+    crawl.run(wait=0)
+    assert walked == []
+    assert crawl.stats()[16]["failed"] == 3
+
+    crawl.run(wait=0, retry_failed=True)
+    assert [t for batch in walked for t in batch] == failed
+    assert crawl.stats()[16] == {"pending": 0, "done": grid["state"].size, "failed": 0, "skipped": 0}
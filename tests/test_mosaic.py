@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import mercantile as mt
+
+from tilemap.mosaic import Mosaic, convert_channels
+
+BBOX = (113.93, 22.56, 113.95, 22.58)
+ZOOM = 16
+TILES = [mt.Tile(x, y, ZOOM) for x in range(10, 13) for y in range(20, 22)]
+
+
+def tile_array(i, size=4):
+    """A flat RGBA tile of the color `i`, the alpha is kept opaque."""
+    return np.full((size, size, 4), (i, 2 * i, 3 * i, 255), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("flip", [False, True])
+def test_layout(flip):
+    mosaic = Mosaic(TILES, flip)
+    assert mosaic.layout == (10, 20, 12, 21) and mosaic.shape == (2, 3)
+    # the last tile is missing
+    for i in range(len(TILES) - 1):
+        mosaic.put(i, tile_array(i + 1))
+    assert mosaic.image.shape == (8, 12, 4) and mosaic.count == len(TILES) - 1
+
+    for i, tile in enumerate(TILES):
+        row, col = mosaic.slot(tile)
+        assert row == (21 - tile.y if flip else tile.y - 20) and col == tile.x - 10
+        expected = tile_array(i + 1) if i < len(TILES) - 1 else 0
+        assert np.all(mosaic.image[row * 4: (row + 1) * 4, col * 4: (col + 1) * 4] == expected)
+
+    with pytest.raises(AssertionError):
+        mosaic.put(0, tile_array(1, size=8))
+
+
+@pytest.mark.parametrize("channels", ["RGB", "L"])
+def test_channels(channels):
+    mosaic = Mosaic(TILES, channels=channels)
+    # decoded into the channels of the mosaic, or RGBA for the synthesized tiles of overzoom
+    mosaic.put(0, convert_channels(tile_array(100), channels))
+    mosaic.put(1, tile_array(100))
+    assert mosaic.image.shape[2] == (3 if channels == "RGB" else 1)
+    assert np.array_equal(mosaic.image[:4, :4], mosaic.image[4:8, :4])
+    assert np.array_equal(mosaic.image[:4, :4], convert_channels(tile_array(100), channels))
+
+
+@pytest.mark.parametrize("sys", ["wgs", "bd"])
+def test_bounds2img_concatenate(make_tilemap, sys):
+    tm = make_tilemap(sys=sys)
+    img, extent = tm.bounds2img(*BBOX, zoom=ZOOM)
+
+    # the former path: the arrays of every tile, concatenated by `merge_tile`
+    tiles = tm._bbox_tiles(*BBOX, zoom=ZOOM)
+    assert len(tiles) > 1
+    merged, (west, south, east, north) = tm.merge_tile(tiles, tm._fetch_tiles(tiles, 0))
+    assert img.dtype == merged.dtype and np.array_equal(img, merged)
+    if sys == "wgs":
+        assert extent == pytest.approx((west, east, south, north))
+
+    for channels in ["RGB", "L"]:
+        other, other_extent = tm.bounds2img(*BBOX, zoom=ZOOM, channels=channels)
+        assert np.array_equal(other, convert_channels(merged, channels))
+        assert other_extent == extent
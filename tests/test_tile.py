@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from tilemap.cache import ArrayLRU
+from tilemap.misc import RetryPolicy, TileFetchError
+
+BBOX = (113.93, 22.56, 113.95, 22.58)
+ZOOM = 16
+
+
+def test_array_lru():
+    arrays = [np.full((4, 4, 4), i, dtype=np.uint8) for i in range(3)]
+    lru = ArrayLRU(max_bytes=2 * arrays[0].nbytes)
+    lru.put("a", arrays[0])
+    lru.put("b", arrays[1])
+    assert lru.get("a") is arrays[0]
+    # "b" is the least recently used
+    lru.put("c", arrays[2])
+    assert lru.get("b") is None
+    assert lru.get("a") is arrays[0] and lru.get("c") is arrays[2]
+    assert lru.stats() == {"hits": 3, "misses": 1, "hit_ratio": .75, "count": 2,
+                           "nbytes": 2 * arrays[0].nbytes, "max_bytes": lru.max_bytes}
+
+    # the cached arrays are shared by the readers
+    with pytest.raises(ValueError):
+        arrays[0][0, 0, 0] = 1
+    # larger than the whole cache, not kept
+    lru.put("d", np.zeros((8, 8, 4), dtype=np.uint8))
+    assert lru.get("d") is None and len(lru) == 2
+
+
+def test_array_cache_shared(make_tilemap, server):
+    tm = make_tilemap()
+    img, extent = tm.bounds2img(*BBOX, zoom=ZOOM)
+    n_tiles = len(tm.arrays)
+    assert n_tiles > 1
+
+    # another instance of the provider, e.g. the next request of a web app
+    other = make_tilemap()
+    assert other.arrays is tm.arrays
+    hits, n_requests = other.arrays.hits, server.stats["requests"]
+    other_img, other_extent = other.bounds2img(*BBOX, zoom=ZOOM)
+    assert other.arrays.hits - hits == n_tiles
+    assert server.stats["requests"] == n_requests
+    assert np.array_equal(img, other_img) and other_extent == extent
+
+    # the other channels are cached apart
+    rgb, _ = other.bounds2img(*BBOX, zoom=ZOOM, channels="RGB")
+    assert np.array_equal(rgb, img[..., :3])
+    assert len(other.arrays) == 2 * n_tiles
+
+
+def test_array_cache_opt_out(make_tilemap):
+    tm = make_tilemap()
+    img, _ = tm.bounds2img(*BBOX, zoom=ZOOM, cache_arrays=False)
+    assert len(tm.arrays) == 0
+    # read from the disk cache and decoded again
+    again, _ = tm.bounds2img(*BBOX, zoom=ZOOM, cache_arrays=False)
+    assert np.array_equal(img, again) and tm.arrays.hits == 0
+
+    assert make_tilemap(array_cache_bytes=0).arrays is None
+
+
+def test_failed_per_call(make_tilemap, flaky_server):
+    # the policy of the instance, without retries, unless a call overrides it
+    tm = make_tilemap(flaky_server.url, retry_policy=RetryPolicy(max_retries=0, backoff=0))
+    first, second = [], []
+    tiles, arrays = tm.fetch_tiles(*BBOX, zoom=ZOOM, wait=None, max_retries=None, failed=first)
+    n_tiles = len(tiles) + len(first)
+    assert first and tm.failed_tiles == first
+    assert not {t for t, _ in first} & set(tiles)
+    for _, err in first:
+        assert isinstance(err, TileFetchError)
+        assert err.status == 503 and err.retryable
+    failures = list(first)
+
+    # the fetched tiles are read from the cache, the others are retried until they pass
+    tiles, arrays = tm.fetch_tiles(*BBOX, zoom=ZOOM, wait=0, max_retries=10, failed=second)
+    assert second == [] and tm.failed_tiles == []
+    assert len(tiles) == n_tiles and all(arr is not None for arr in arrays)
+    assert first == failures
+
+
+def test_permanent_failure(make_tilemap, server):
+    tm = make_tilemap(server.url + "/missing")
+    failed = []
+    with pytest.raises(TileFetchError):
+        tm.bounds2img(*BBOX, zoom=ZOOM, max_retries=5, failed=failed)
+    assert len(failed) == len({t for t, _ in failed}) > 1
+    assert all(err.status == 404 and not err.retryable for _, err in failed)
@@ -0,0 +1,118 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+import shapely
+import mercantile as mt
+
+from tilemap.vector import FeatureCollector, check_tile, tile_features
+
+FIXTURES = Path(__file__).parent / "fixtures" / "mvt"
+EXPECTED = json.loads((FIXTURES / "expected.json").read_text())
+TILE = mt.Tile(*EXPECTED["tiles"]["tile"])
+EAST = mt.Tile(*EXPECTED["tiles"]["east"])
+# a pixel of the tiles at z14, in degrees; the decoded vertices are rounded to the pixels
+PIXEL = 360 / (4096 * 2 ** TILE.z)
+
+
+def read(fn):
+    return (FIXTURES / fn).read_bytes()
+
+
+def assert_geom_close(geom, expected_wkt, tolerance=2 * PIXEL):
+    expected = shapely.from_wkt(expected_wkt)
+    assert geom.geom_type == expected.geom_type
+    assert shapely.get_num_geometries(geom) == shapely.get_num_geometries(expected)
+    assert shapely.hausdorff_distance(geom, expected) < tolerance
+
+
+def test_multipart():
+    layers = tile_features(read("multipart.pbf"), TILE)
+    assert set(layers) == {"poi", "roads", "buildings"}
+
+    for name, features in EXPECTED["multipart"].items():
+        ids, props, geoms = layers[name]
+        assert ids == [fid for fid, _, _ in features]
+        assert props == [prop for _, prop, _ in features]
+        for geom, (_, _, wkt) in zip(geoms, features):
+            assert_geom_close(geom, wkt)
+
+    buildings = layers["buildings"][2][0]
+    assert [len(p.interiors) for p in buildings.geoms] == [0, 1]
+
+
+def test_property_types():
+    props = tile_features(read("multipart.pbf"), TILE)["poi"][1][0]
+    assert props == {"name": "kiosk", "rank": 3, "delta": -7, "score": 1.5, "open": True}
+    assert isinstance(props["open"], bool)
+    assert isinstance(props["delta"], int)
+
+
+def test_gzipped():
+    raw = tile_features(read("multipart.pbf"), TILE)
+    gz = tile_features(read("multipart.pbf.gz"), TILE)
+    assert check_tile(read("multipart.pbf.gz")) == read("multipart.pbf")
+    for name in raw:
+        assert raw[name][:2] == gz[name][:2]
+        assert all(shapely.equals_exact(a, b, 0) for a, b in zip(raw[name][2], gz[name][2]))
+
+
+def test_layers_filter():
+    assert set(tile_features(read("multipart.pbf"), TILE, layers={"roads"})) == {"roads"}
+    assert tile_features(read("multipart.pbf"), TILE, layers={"water"}) == {}
+
+
+def test_no_id():
+    ids, props, geoms = tile_features(read("no_id.pbf"), TILE)["poi"]
+    assert ids == [None, None]
+    assert props == [{"name": "a"}, {"name": "b"}]
+    for geom, (_, _, wkt) in zip(geoms, EXPECTED["no_id"]["poi"]):
+        assert_geom_close(geom, wkt)
+
+    collector = FeatureCollector([TILE])
+    collector.put(0, read("no_id.pbf"))
+    gdf = collector.to_geodataframes()["poi"]
+    assert gdf["feature_id"].isna().all()
+    assert sorted(gdf["name"]) == ["a", "b"]
+
+
+def test_hole_before_shell():
+    ids, props, geoms = tile_features(read("hole_first.pbf"), TILE)["buildings"]
+    assert ids == [7] and props == [{"kind": "courtyard"}]
+    polygon = geoms[0]
+    assert polygon.geom_type == "Polygon" and polygon.is_valid
+    assert len(polygon.interiors) == 1
+    _, _, wkt = EXPECTED["hole_first"]["buildings"][0]
+    assert_geom_close(polygon, wkt)
+    assert polygon.area == pytest.approx(shapely.from_wkt(wkt).area, rel=1e-3)
+
+
+@pytest.mark.parametrize("merge", [True, False])
+def test_split_features(merge):
+    collector = FeatureCollector([TILE, EAST])
+    collector.put(0, read("split_west.pbf"))
+    collector.put(1, read("split_east.pbf"))
+    res = collector.to_geodataframes(merge=merge)
+
+    road = shapely.from_wkt(EXPECTED["split"]["roads"][0][2])
+    house = shapely.from_wkt(EXPECTED["split"]["buildings"][0][2])
+    if not merge:
+        assert len(res["roads"]) == len(res["buildings"]) == 2
+        return
+
+    assert len(res["roads"]) == len(res["buildings"]) == 1
+    merged_road, merged_house = res["roads"].geometry[0], res["buildings"].geometry[0]
+    assert merged_road.geom_type == "LineString"
+    assert merged_road.length == pytest.approx(road.length, rel=1e-3)
+    assert_geom_close(merged_road, road.wkt)
+    assert merged_house.geom_type == "Polygon"
+    assert merged_house.area == pytest.approx(house.area, rel=1e-2)
+    assert_geom_close(merged_house, house.wkt)
+
+
+def test_truncated():
+    content = read("multipart.pbf")
+    with pytest.raises(ValueError):
+        check_tile(content[:-5])
+    assert np.all(check_tile(content) == content)
@@ -1,5 +1,6 @@
 from .tile import TileMap, CACHE_FOLDER, set_logger
 from ._providers import providers, TileProvider, Baidu, Amap, OpenStreetMap
 from .plotting import add_basemap, plot_geodata
+from .render import render_maps
 
 __version__ = "1.1.0"
\ No newline at end of file
@@ -31,6 +31,7 @@ providers = Bunch(
             subdomains = 'abc',
             max_zoom = 18,
             attribution = '(C) OpenStreetMap contributors',
+            rate_limit = 2, # 单个子域名每秒请求数的初始值, 会根据响应自适应调整
             name = 'OpenStreetMap.Mapnik'
         )
     ),
@@ -42,6 +43,7 @@ providers = Bunch(
             subdomains = '1234',
             attribution = '(C) AutoNavi',
             describe='style=6为影像图, style=7为矢量路网, style=8为影像路网',
+            rate_limit = 20,
             name = 'Amap.Satellite'
         ),
         Normal = TileProvider(
@@ -51,6 +53,7 @@ providers = Bunch(
             subdomains = '1234',
             attribution = '(C) AutoNavi',
             describe='style=6为影像图, style=7为矢量路网, style=8为影像路网',
+            rate_limit = 20,
             name = 'Amap.Normal'
         )
         
@@ -62,6 +65,7 @@ providers = Bunch(
             max_zoom = 19,
             subdomains = '0123',
             attribution = '(C) Baidu contributors',
+            rate_limit = 20,
             name = 'Baidu.Satellite'
         ),
         Tile = TileProvider(
@@ -70,9 +74,22 @@ providers = Bunch(
             max_zoom = 19,
             subdomains = '01',
             attribution = '(C) Baidu contributors',
+            rate_limit = 20,
             name = 'Baidu.Tile'
         )
     ),
+    Mapbox = Bunch(
+        Streets = TileProvider(
+            url = 'https://api.mapbox.com/v4/mapbox.mapbox-streets-v8/{z}/{x}/{y}.vector.pbf?access_token={accessToken}',
+            sys='wgs',
+            format = 'pbf', # 矢量瓦片, 见 `TileMap.fetch_features`
+            max_zoom = 16,
+            accessToken = '<insert your access token here>',
+            attribution = '(C) Mapbox (C) OpenStreetMap contributors',
+            rate_limit = 20,
+            name = 'Mapbox.Streets'
+        )
+    ),
     Google = Bunch(
         Mapnik = TileProvider(
             url = "http://mt{s}.google.cn/vt/lyrs={lyr}@258000000&hl=zh-CN&gl=CN&src=app&s=Ga&x={x}&y={y}&z={z}",
@@ -81,6 +98,7 @@ providers = Bunch(
             max_zoom = 19,
             lyrs='mtpsyh', #Google style m：路线图 t：地形图 p：带标签的地形图 s：卫星图 y：带标签的卫星图 h：标签层（路名、地名等）
             attribution = '(C) Google contributors',
+            rate_limit = 10,
             name = 'Google.Base'
         )
     ),
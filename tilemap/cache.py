@@ -0,0 +1,443 @@
+import os
+import errno
+import hashlib
+import sqlite3
+import threading
+import mercantile as mt
+from pathlib import Path
+from loguru import logger
+from collections import OrderedDict
+
+ARRAY_CACHE_BYTES = 512 * 2 ** 20
+_ARRAY_CACHES = {}
+
+
+def content_digest(content):
+    """The content address of a tile."""
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+class TileCache():
+    """Storage of the raw tile contents, keyed by `mercantile.Tile`.
+
+    Backends implement `get`, `put`; `flush` and `close` are optional. The
+    `dedup` backends store each distinct content once, the tiles point at
+    the shared blobs, see `dedup_stats`.
+    """
+
+    dedup = False
+
+    def get(self, tile):
+        """Return the content (bytes) of `tile`, or None if it is not cached."""
+        raise NotImplementedError
+
+
+    def put(self, tile, content):
+        raise NotImplementedError
+
+
+    def exists(self, tile):
+        return self.get(tile) is not None
+
+
+    def tiles(self, z):
+        """Iterate over the cached tiles of the zoom level `z`."""
+        raise NotImplementedError
+
+
+    def dedup_stats(self):
+        """{'tiles': .., 'blobs': .., 'blob_bytes': ..} of a `dedup` backend."""
+        raise NotImplementedError
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        self.flush()
+
+
+class DirectoryCache(TileCache):
+    """The `folder/z/x/y.png` layout, one file per tile.
+
+    With `dedup`, each distinct content is written once into `folder/.blobs`,
+    named by its digest, and `z/x/y.png` is a hard link to it; the layout is
+    unchanged for the readers. The file system has to support hard links,
+    the tiles are copied otherwise.
+    """
+
+    def __init__(self, folder, ext="png", dedup=False):
+        self.folder = Path(folder)
+        self.ext = ext
+        self.dedup = dedup
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+
+    def path(self, tile):
+        return self.folder / str(tile.z) / str(tile.x) / f"{tile.y}.{self.ext}"
+
+
+    def get(self, tile):
+        # a single open instead of `exists` + open
+        try:
+            return self.path(tile).read_bytes()
+        except FileNotFoundError:
+            return None
+
+
+    def exists(self, tile):
+        return self.path(tile).exists()
+
+
+    def tiles(self, z):
+        folder = self.folder / str(z)
+        if not folder.exists():
+            return
+        
+        suffix = f".{self.ext}"
+        for x in os.scandir(folder):
+            if not x.is_dir() or not x.name.lstrip('-').isdigit():
+                continue
+            for y in os.scandir(x.path):
+                if y.name.endswith(suffix):
+                    yield mt.Tile(int(x.name), int(y.name[:-len(suffix)]), z)
+
+
+    def put(self, tile, content):
+        fn = self.path(tile)
+        if not self.dedup:
+            # replace, not write in place: the file may be a link to a blob of a dedup folder
+            self._write(fn, content)
+            return
+        fn.parent.mkdir(parents=True, exist_ok=True)
+
+        digest = content_digest(content)
+        blob = self.folder / ".blobs" / digest[:2] / f"{digest}.{self.ext}"
+        if not blob.exists():
+            self._write(blob, content)
+        tmp = self._tmp(fn)
+        try:
+            os.link(blob, tmp)
+        except OSError as e:
+            if e.errno == errno.EMLINK:
+                # the links of an inode are limited (65000 on ext4), continue on a fresh copy of the blob
+                self._write(blob, content)
+                os.link(blob, tmp)
+            else:
+                tmp.write_bytes(content)
+        os.replace(tmp, fn)
+
+
+    def _tmp(self, fn):
+        return fn.with_name(f"{fn.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+    def _write(self, fn, content):
+        # atomic, the tiles and the blobs are shared by the concurrent writers
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._tmp(fn)
+        tmp.write_bytes(content)
+        os.replace(tmp, fn)
+
+
+    def dedup_stats(self):
+        n_tiles = n_blobs = n_bytes = 0
+        folder = self.folder / ".blobs"
+        if folder.exists():
+            for sub in os.scandir(folder):
+                for blob in os.scandir(sub.path):
+                    stat = blob.stat()
+                    n_blobs += 1
+                    n_bytes += stat.st_size
+                    n_tiles += stat.st_nlink - 1
+
+        return {"tiles": n_tiles, "blobs": n_blobs, "blob_bytes": n_bytes}
+
+
+class MBTilesCache(TileCache):
+    """MBTiles (SQLite) backend.
+
+    Writes are buffered and inserted in batches within one transaction, the
+    database runs in WAL mode so other processes can read it while crawling.
+
+    Args:
+        fn (str): the path of the `.mbtiles` file.
+        name (str, optional): the `name` in the metadata table.
+        batch_size (int, optional): the number of pending tiles triggering a commit. Defaults to 256.
+        flip_y (bool, optional): store rows in the TMS scheme as the MBTiles spec requires;
+            set False for grids which are not XYZ (e.g. Baidu). Defaults to True.
+        dedup (bool, optional): the deduplicated schema of MBTiles, i.e. the tables `map` and
+            `images` keyed by the digest of the contents, and the view `tiles`; an existing
+            file keeps its schema. Defaults to False.
+    """
+
+    def __init__(self, fn, name=None, fmt="png", batch_size=256, flip_y=True, dedup=False):
+        self.fn = Path(fn)
+        self.name = name or self.fn.stem
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.flip_y = flip_y
+        self.dedup = dedup
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._conn = None
+        self.fn.parent.mkdir(parents=True, exist_ok=True)
+        self._connect()
+
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        state.update({"_conn": None, "_lock": None, "_pending": {}})
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+
+        conn = sqlite3.connect(str(self.fn), timeout=60, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+        if row is not None and self.dedup != (row[0] == "view"):
+            logger.warning(f"{self.fn.name} keeps its schema, dedup={row[0] == 'view'}.")
+            self.dedup = row[0] == "view"
+        if self.dedup:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS map "
+                "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)")
+            conn.execute("CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)")
+            conn.execute(
+                "CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, "
+                "map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data "
+                "FROM map JOIN images ON images.tile_id = map.tile_id")
+        else:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles "
+                "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        if conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 0:
+            conn.executemany("INSERT INTO metadata VALUES (?, ?)", [
+                ("name", self.name),
+                ("format", self.fmt),
+                ("scheme", "tms" if self.flip_y else "xyz")
+            ])
+        self._conn = conn
+
+        return conn
+
+
+    def _key(self, tile):
+        row = (1 << tile.z) - 1 - tile.y if self.flip_y else tile.y
+        return (tile.z, tile.x, row)
+
+
+    def get(self, tile):
+        key = self._key(tile)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            row = self._connect().execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", key
+            ).fetchone()
+
+        return None if row is None else bytes(row[0])
+
+
+    def tiles(self, z):
+        with self._lock:
+            self.flush()
+            table = "map" if self.dedup else "tiles"
+            rows = self._connect().execute(
+                f"SELECT tile_column, tile_row FROM {table} WHERE zoom_level=?", (z, )).fetchall()
+        
+        for x, row in rows:
+            yield mt.Tile(x, (1 << z) - 1 - row if self.flip_y else row, z)
+
+
+    def put(self, tile, content):
+        with self._lock:
+            self._pending[self._key(tile)] = content
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                if self.dedup:
+                    # the blobs replaced by others are kept, a tile is rarely rewritten
+                    digests = {key: content_digest(content) for key, content in self._pending.items()}
+                    blobs = {digests[key]: content for key, content in self._pending.items()}
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO images VALUES (?, ?)",
+                        [(sqlite3.Binary(content), digest) for digest, content in blobs.items()]
+                    )
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)",
+                        [(*key, digest) for key, digest in digests.items()]
+                    )
+                else:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                        [(*key, sqlite3.Binary(content)) for key, content in self._pending.items()]
+                    )
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+            logger.trace(f"Committed {len(self._pending)} tiles into {self.fn.name}")
+            self._pending.clear()
+
+
+    def dedup_stats(self):
+        with self._lock:
+            self.flush()
+            conn = self._connect()
+            n_tiles = conn.execute("SELECT COUNT(*) FROM map").fetchone()[0]
+            n_blobs, n_bytes = conn.execute("SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM images").fetchone()
+
+        return {"tiles": n_tiles, "blobs": n_blobs, "blob_bytes": n_bytes or 0}
+
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ArrayLRU():
+    """Bounded LRU of decoded tile arrays, limited by the total bytes.
+
+    The arrays are shared by all readers, so they are marked read-only. The
+    mosaics of `bounds2img` fill it as well, unless `cache_arrays=False`.
+    """
+
+    def __init__(self, max_bytes=ARRAY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update({"_data": OrderedDict(), "nbytes": 0, "_lock": None})
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            array = self._data.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        
+        return array
+
+
+    def _nbytes(self, value):
+        return value.nbytes
+
+
+    def _freeze(self, value):
+        value.flags.writeable = False
+
+
+    def put(self, key, array):
+        size = self._nbytes(array)
+        if size > self.max_bytes:
+            return array
+        
+        self._freeze(array)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= self._nbytes(old)
+            self._data[key] = array
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= self._nbytes(evicted)
+        
+        return array
+
+
+    def pop(self, key):
+        with self._lock:
+            array = self._data.pop(key, None)
+            if array is not None:
+                self.nbytes -= self._nbytes(array)
+        
+        return array
+
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.,
+            "count": len(self._data),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class MosaicLRU(ArrayLRU):
+    """Bounded LRU of the (image, extent) of the basemaps, limited by the bytes of the images."""
+
+    def _nbytes(self, value):
+        return value[0].nbytes
+
+
+    def _freeze(self, value):
+        value[0].flags.writeable = False
+
+
+def get_array_cache(name, max_bytes=ARRAY_CACHE_BYTES):
+    """The `ArrayLRU` shared by every `TileMap` of the provider `name`."""
+    cache = _ARRAY_CACHES.get(name)
+    if cache is None:
+        cache = _ARRAY_CACHES.setdefault(name, ArrayLRU(max_bytes))
+    elif max_bytes > cache.max_bytes:
+        cache.max_bytes = max_bytes
+    
+    return cache
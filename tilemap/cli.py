@@ -0,0 +1,212 @@
+"""
+`tilemap` command line tool.
+
+    tilemap howmany -p Amap.Satellite --bbox 113.9 22.5 114.1 22.7 -z 14-18
+    tilemap seed    -p Amap.Satellite --geojson shenzhen.geojson -z 14-18 -j 8
+    tilemap stats   -p Amap.Satellite --manifest shenzhen.npz
+    tilemap export  -p Amap.Satellite --bbox 113.9 22.5 114.1 22.7 -z 17 -o shenzhen.tif
+"""
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+import mercantile as mt
+from pathlib import Path
+
+from .tile import TileMap, CACHE_FOLDER, set_logger
+from .server import find_provider
+from .metrics import registry as metrics, PrometheusFileSink
+
+
+def parse_zooms(value):
+    """'16' -> [16], '14-18' -> [14, 15, 16, 17, 18]"""
+    lo, _, hi = value.partition('-')
+    lo, hi = int(lo), int(hi or lo)
+    if lo > hi:
+        raise argparse.ArgumentTypeError(f"Check the zoom range {value}.")
+
+    return list(range(lo, hi + 1))
+
+
+def load_area(args):
+    """The (bounds, geofence) of the `--bbox` or `--geojson` arguments, in `args.sys`."""
+    if args.geojson is None:
+        return tuple(args.bbox), None
+
+    import shapely
+    from shapely.geometry import shape
+    with open(args.geojson, encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get("type") == "FeatureCollection":
+        geoms = [shape(i["geometry"]) for i in data["features"]]
+    elif data.get("type") == "Feature":
+        geoms = [shape(data["geometry"])]
+    else:
+        geoms = [shape(data)]
+    geom = shapely.union_all(geoms)
+
+    if args.sys != 'wgs':
+        from .geofence import transform_geometry
+        bounds = transform_geometry(geom, args.sys, 'wgs').bounds
+    else:
+        bounds = geom.bounds
+
+    return bounds, geom
+
+
+def get_tilemap(args):
+    provider = find_provider(args.provider)
+    if provider is None:
+        sys.exit(f"Unknown provider {args.provider}, e.g. Amap.Satellite, OpenStreetMap.Mapnik.")
+
+    return TileMap(provider, cache_folder=args.cache_folder, cache=args.cache, concurrency=args.concurrency,
+                   throttle=not args.no_throttle, dedup=args.dedup)
+
+
+def _default_manifest(args, bounds):
+    key = json.dumps([args.provider, bounds, args.zoom, args.geojson])
+    return f"tilemap-seed-{hashlib.md5(key.encode()).hexdigest()[:8]}.npz"
+
+
+def cmd_howmany(args):
+    from .job import init_grid, PENDING
+
+    tm = get_tilemap(args)
+    bounds, geofence = load_area(args)
+    total = 0
+    print(f"{'zoom':>4} {'tiles':>12} {'cached':>12}")
+    for z in args.zoom:
+        grid = init_grid(tm, bounds, z, geofence, args.sys)
+        idxs = np.flatnonzero(grid["state"] == PENDING)
+        cached = ''
+        if args.cached:
+            xs, ys = np.divmod(idxs, grid["ny"])
+            cached = sum(tm.cache.exists(mt.Tile(int(x) + grid["x0"], int(y) + grid["y0"], z)) for x, y in zip(xs, ys))
+        total += len(idxs)
+        print(f"{z:>4} {len(idxs):>12} {cached:>12}")
+    print(f"{'all':>4} {total:>12}")
+
+
+def cmd_seed(args):
+    from .job import CrawlJob
+
+    tm = get_tilemap(args)
+    bounds, geofence = load_area(args)
+    manifest = args.manifest or _default_manifest(args, bounds)
+    job = CrawlJob(tm, manifest, bounds, args.zoom, geofence, args.sys)
+    stats = job.run(
+        batch_size=args.batch_size,
+        wait=args.wait,
+        max_retries=args.max_retries,
+        retry_failed=args.retry_failed,
+        n_jobs=args.workers
+    )
+    _print_job_stats(stats)
+    print(f"Manifest: {manifest}")
+
+
+def cmd_stats(args):
+    tm = get_tilemap(args)
+    if args.manifest is not None:
+        from .job import CrawlJob
+        _print_job_stats(CrawlJob(tm, args.manifest).stats())
+        return
+
+    max_zoom = tm.provider.get('max_zoom', 20)
+    print(f"{'zoom':>4} {'cached':>12}")
+    for z in range(tm.provider.get('min_zoom', 0), max_zoom + 1):
+        n = sum(1 for _ in tm.cache.tiles(z))
+        if n:
+            print(f"{z:>4} {n:>12}")
+    if tm.cache.dedup:
+        stats = tm.cache.dedup_stats()
+        print(f"{stats['tiles']} tiles share {stats['blobs']} blobs, {stats['blob_bytes'] / 2 ** 20:.1f} MB")
+
+
+def _print_job_stats(stats):
+    names = ["pending", "done", "failed", "skipped"]
+    print(f"{'zoom':>4} " + " ".join(f"{i:>10}" for i in names))
+    for z, counts in stats.items():
+        print(f"{z:>4} " + " ".join(f"{counts[i]:>10}" for i in names))
+
+
+def cmd_export(args):
+    tm = get_tilemap(args)
+    bounds, _ = load_area(args)
+    assert len(args.zoom) == 1, "Check a single zoom level is given to export."
+    driver = "npy" if args.output.endswith(".npy") else "GTiff"
+    failed = []
+    _, extent = tm.bounds2raster(*bounds, args.output, zoom=args.zoom[0], ll=True, wait=args.wait,
+                                 max_retries=args.max_retries, driver=driver, failed=failed)
+    print(f"Exported {args.output}, extent {extent}")
+    if failed:
+        print(f"{len(failed)} tiles failed and are left transparent.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="tilemap", description="Seed, count and export map tiles.")
+    parser.add_argument("--log-level", default="WARNING")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-p", "--provider", default="Amap.Satellite", help="the name in `providers`, e.g. Amap.Satellite")
+    common.add_argument("--cache-folder", default=CACHE_FOLDER)
+    common.add_argument("--cache", default="dir", choices=["dir", "mbtiles"])
+    common.add_argument("--dedup", action="store_true", help="store each distinct tile content once")
+    common.add_argument("--concurrency", type=int, default=64, help="requests in flight per process")
+    common.add_argument("--no-throttle", action="store_true",
+                        help="disable the adaptive per-host rate limit, which applies to each worker process")
+
+    area = argparse.ArgumentParser(add_help=False)
+    group = area.add_mutually_exclusive_group(required=True)
+    group.add_argument("--bbox", nargs=4, type=float, metavar=("W", "S", "E", "N"), help="in wgs")
+    group.add_argument("--geojson", help="the area to crawl, only the tiles intersecting it are used")
+    area.add_argument("--sys", default="wgs", choices=["wgs", "gcj", "bd"], help="the coordination system of the geojson")
+    area.add_argument("-z", "--zoom", type=parse_zooms, required=True, help="a zoom level or a range, e.g. 14-18")
+
+    fetch = argparse.ArgumentParser(add_help=False)
+    fetch.add_argument("--wait", type=float, default=.5, help="the base of the retry backoff in seconds")
+    fetch.add_argument("--max-retries", type=int, default=2)
+    fetch.add_argument("--metrics", help="a Prometheus text file of the crawl metrics, updated during the run")
+
+    p = subparsers.add_parser("howmany", parents=[common, area], help="count the tiles of an area")
+    p.add_argument("--cached", action="store_true", help="count the cached ones as well")
+    p.set_defaults(func=cmd_howmany)
+
+    p = subparsers.add_parser("seed", parents=[common, area, fetch], help="crawl the tiles of an area into the cache")
+    p.add_argument("-j", "--workers", type=int, default=-1, help="worker processes, -1 for all the cores")
+    p.add_argument("--manifest", help="the progress file, resumed if it exists")
+    p.add_argument("--batch-size", type=int, default=1024)
+    p.add_argument("--retry-failed", action="store_true")
+    p.set_defaults(func=cmd_seed)
+
+    p = subparsers.add_parser("stats", parents=[common], help="the cached tiles, or the progress of a seed job")
+    p.add_argument("--manifest")
+    p.set_defaults(func=cmd_stats)
+
+    p = subparsers.add_parser("export", parents=[common, area, fetch], help="write an area into a GeoTIFF / .npy")
+    p.add_argument("-o", "--output", required=True, help="*.tif or *.npy")
+    p.set_defaults(func=cmd_export)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    set_logger(level=args.log_level)
+    if Path(args.cache_folder).exists() is False:
+        Path(args.cache_folder).mkdir(parents=True, exist_ok=True)
+    sink = None
+    if getattr(args, "metrics", None):
+        sink = metrics.add_sink(PrometheusFileSink(args.metrics))
+    try:
+        args.func(args)
+    finally:
+        if sink is not None:
+            metrics.flush(final=True)
+            metrics.remove_sink(sink)
+
+
+if __name__ == "__main__":
+    main()
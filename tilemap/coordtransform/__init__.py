@@ -1,3 +1,6 @@
 from .coordTransform_py import wgs84_to_bd09, wgs84_to_gcj02
 from .coordTransform_py import gcj02_to_bd09, gcj02_to_wgs84
 from .coordTransform_py import bd09_to_wgs84, bd09_to_gcj02
+from .coordTransform_np import wgs84_to_bd09_np, wgs84_to_gcj02_np
+from .coordTransform_np import gcj02_to_bd09_np, gcj02_to_wgs84_np
+from .coordTransform_np import bd09_to_wgs84_np, bd09_to_gcj02_np
@@ -47,12 +47,16 @@ def merge_tiles_bd(tiles, arrays):
         x, y = ind
         img[(n_y - y - 1) * h : (n_y - y) * h, x * w : (x + 1) * w, :] = arr
 
-    bounds = np.array([bounds_bd(t) for t in tiles])
+    # convert the corners of all tiles in one call, the same as `bounds_bd` for each tile
+    f = 256 * math.pow(2, 18 - tiles[0].z)
+    xs, ys = tile_xys[:, 0] * f, tile_xys[:, 1] * f
+    wests, souths = bd_mc_to_coord(xs, ys)
+    easts, norths = bd_mc_to_coord(xs + f, ys + f)
     west, south, east, north = (
-        min(bounds[:, 0]),
-        min(bounds[:, 1]),
-        max(bounds[:, 2]),
-        max(bounds[:, 3]),
+        np.min(wests),
+        np.min(souths),
+        np.max(easts),
+        np.max(norths),
     )
 
     return img, (west, south, east, north)
@@ -1,44 +1,126 @@
 import math
 import ctypes
 import os
-import math
+import numpy as np
+from loguru import logger
 
 from .coordTransform_py import bd09_to_wgs84,wgs84_to_bd09
 
-lib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), './baiduCoord.so'))
+"""
+百度经纬度(BD-09)与百度墨卡托(BD-09MC)之间的分段多项式投影, 参数源于百度地图 JS API.
+`baiduCoord.so` 存在时作为单点转换的加速器, 否则使用 NumPy 实现, 支持数组批量转换.
+"""
+
+MCBAND = np.array([12890594.86, 8362377.87, 5591021, 3481989.83, 1678043.12, 0])
+LLBAND = np.array([75, 60, 45, 30, 15, 0])
+MC2LL = np.array([
+    [1.410526172116255e-008, 8.983055096488720e-006, -1.99398338163310, 2.009824383106796e+002, -1.872403703815547e+002, 91.60875166698430, -23.38765649603339, 2.57121317296198, -0.03801003308653, 1.733798120000000e+007],
+    [-7.435856389565537e-009, 8.983055097726239e-006, -0.78625201886289, 96.32687599759846, -1.85204757529826, -59.36935905485877, 47.40033549296737, -16.50741931063887, 2.28786674699375, 1.026014486000000e+007],
+    [-3.030883460898826e-008, 8.983055099835780e-006, 0.30071316287616, 59.74293618442277, 7.35798407487100, -25.38371002664745, 13.45380521110908, -3.29883767235584, 0.32710905363475, 6.856817370000000e+006],
+    [-1.981981304930552e-008, 8.983055099779535e-006, 0.03278182852591, 40.31678527705744, 0.65659298677277, -4.44255534477492, 0.85341911805263, 0.12923347998204, -0.04625736007561, 4.482777060000000e+006],
+    [3.091913710684370e-009, 8.983055096812155e-006, 0.00006995724062, 23.10934304144901, -0.00023663490511, -0.63218178102420, -0.00663494467273, 0.03430082397953, -0.00466043876332, 2.555164400000000e+006],
+    [2.890871144776878e-009, 8.983055095805407e-006, -0.00000003068298, 7.47137025468032, -0.00000353937994, -0.02145144861037, -0.00001234426596, 0.00010322952773, -0.00000323890364, 8.260885000000000e+005],
+])
+LL2MC = np.array([
+    [-0.00157021024440, 1.113207020616939e+005, 1.704480524535203e+015, -1.033898737604234e+016, 2.611266785660388e+016, -3.514966917665370e+016, 2.659570071840392e+016, -1.072501245418824e+016, 1.800819912950474e+015, 82.5],
+    [8.277824516172526e-004, 1.113207020463578e+005, 6.477955746671608e+008, -4.082003173641316e+009, 1.077490566351142e+010, -1.517187553151559e+010, 1.205306533862167e+010, -5.124939663577472e+009, 9.133119359512032e+008, 67.5],
+    [0.00337398766765, 1.113207020202162e+005, 4.481351045890365e+006, -2.339375119931662e+007, 7.968221547186455e+007, -1.159649932797253e+008, 9.723671115602145e+007, -4.366194633752821e+007, 8.477230501135234e+006, 52.5],
+    [0.00220636496208, 1.113207020209128e+005, 5.175186112841131e+004, 3.796837749470245e+006, 9.920137397791013e+005, -1.221952217112870e+006, 1.340652697009075e+006, -6.209436990984312e+005, 1.444169293806241e+005, 37.5],
+    [-3.441963504368392e-004, 1.113207020576856e+005, 2.782353980772752e+002, 2.485758690035394e+006, 6.070750963243378e+003, 5.482118345352118e+004, 9.540606633304236e+003, -2.710553267466450e+003, 1.405483844121726e+003, 22.5],
+    [-3.218135878613132e-004, 1.113207020701615e+005, 0.00369383431289, 8.237256402795718e+005, 0.46104986909093, 2.351343141331292e+003, 1.58060784298199, 8.77738589078284, 0.37238884252424, 7.45],
+])
+
+
+def _load_lib():
+    fn = os.path.join(os.path.dirname(__file__), './baiduCoord.so')
+    if not os.path.exists(fn):
+        return None
+    try:
+        return ctypes.cdll.LoadLibrary(fn)
+    except OSError as e:
+        logger.warning(f"Load {fn} failed, fallback to the numpy implementation: {e}")
+        return None
 
 
 class coords_type(ctypes.Structure):
     _fields_ = [('x', ctypes.c_double), ('y', ctypes.c_double)]
 
 
-LL2MC_lng = lib.LL2MC_lng
-LL2MC_lat = lib.LL2MC_lat
-MC2LL_lat = lib.MC2LL_lat
-MC2LL_lng = lib.MC2LL_lng
-for i in [LL2MC_lng, LL2MC_lat, MC2LL_lat, MC2LL_lng]:
-    i.argtypes = [ctypes.c_double, ctypes.c_double]
-    i.restype = ctypes.c_double
+lib = _load_lib()
+if lib is not None:
+    LL2MC_lng = lib.LL2MC_lng
+    LL2MC_lat = lib.LL2MC_lat
+    MC2LL_lat = lib.MC2LL_lat
+    MC2LL_lng = lib.MC2LL_lng
+    for i in [LL2MC_lng, LL2MC_lat, MC2LL_lat, MC2LL_lng]:
+        i.argtypes = [ctypes.c_double, ctypes.c_double]
+        i.restype = ctypes.c_double
+
+    LL2MC_c, MC2LL_c = lib.LL2MC, lib.MC2LL
+    for i in [LL2MC_c, MC2LL_c]:
+        i.argtypes = [ctypes.c_double, ctypes.c_double]
+        i.restype = coords_type
+
+
+def _convertor(x, y, factors):
+    """Evaluate the polynomial of each point with its own row of `factors`."""
+    f = np.moveaxis(factors, -1, 0)
+    lng = f[0] + f[1] * np.abs(x)
+    c = np.abs(y) / f[9]
+    lat = f[2] + f[3] * c + f[4] * c ** 2 + f[5] * c ** 3 + f[6] * c ** 4 + f[7] * c ** 5 + f[8] * c ** 6
+    lng = np.where(x < 0, -lng, lng)
+    lat = np.where(y < 0, -lat, lat)
+    return lng, lat
+
+
+def bd_coord_to_mc_np(lng, lat):
+    """百度经纬度 -> 百度墨卡托, 输入输出均为数组"""
+    lng = np.asarray(lng, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    # getLoop(lng, -180, 180), getRange(lat, -74, 74)
+    lng = np.where(lng > 180, lng - 360 * np.ceil((lng - 180) / 360), lng)
+    lng = np.where(lng < -180, lng + 360 * np.ceil((-180 - lng) / 360), lng)
+    lat = np.clip(lat, -74, 74)
+    # 与 JS API 保持一致: 北半球按纬度带取参数, 南半球均落在最后一个纬度带
+    band = np.where(lat >= 0, np.argmax(lat[..., None] >= LLBAND, axis=-1), len(LLBAND) - 1)
+    
+    return _convertor(lng, lat, LL2MC[band])
 
 
-LL2MC, MC2LL = lib.LL2MC, lib.MC2LL
-for i in [LL2MC, MC2LL]:
-    i.argtypes = [ctypes.c_double, ctypes.c_double]
-    i.restype = coords_type
+def bd_mc_to_coord_np(x, y):
+    """百度墨卡托 -> 百度经纬度, 输入输出均为数组"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    band = np.argmax(np.abs(y)[..., None] >= MCBAND, axis=-1)
+    
+    return _convertor(x, y, MC2LL[band])
 
 
 def bd_coord_to_mc(lng, lat):
-    coord = LL2MC(lng, lat)
-    return coord.x, coord.y
+    if lib is not None and np.isscalar(lng) and np.isscalar(lat):
+        coord = LL2MC_c(lng, lat)
+        return coord.x, coord.y
+    
+    x, y = bd_coord_to_mc_np(lng, lat)
+    if x.ndim == 0:
+        return float(x), float(y)
+    return x, y
 
 
 def bd_mc_to_coord(lng, lat):
-    coord = MC2LL(lng, lat)
-    return coord.x, coord.y
+    if lib is not None and np.isscalar(lng) and np.isscalar(lat):
+        coord = MC2LL_c(lng, lat)
+        return coord.x, coord.y
+    
+    x, y = bd_mc_to_coord_np(lng, lat)
+    if x.ndim == 0:
+        return float(x), float(y)
+    return x, y
 
 
 def bd_mc_to_coord_old(lng, lat):
-    return MC2LL_lng(lng, lat), MC2LL_lat(lng, lat)
+    # kept for the callers of the per component functions of `baiduCoord.so`, which may be missing
+    return bd_mc_to_coord(lng, lat)
 
 
 def bd_mc_to_wgs_vector(record, attr=["X", "Y"], factor=100):
@@ -0,0 +1,135 @@
+"""
+`coordTransform_py` 的向量化版本, 输入为 lng/lat 数组, 输出为 (lng, lat) 数组,
+计算顺序与标量版本一致, 结果逐位相同.
+"""
+import math
+import numpy as np
+
+from .coordTransform_py import x_pi, pi, a, ee
+
+# np.arctan2 (SIMD 实现) 与 math.atan2 在最后一位上存在差异, 为了与标量版本逐位一致, 仍使用 libm 的 atan2
+_atan2 = np.frompyfunc(math.atan2, 2, 1)
+
+
+def gcj02_to_bd09_np(lng, lat):
+    """
+    火星坐标系(GCJ-02)转百度坐标系(BD-09), 向量化版本
+    :param lng:火星坐标经度数组
+    :param lat:火星坐标纬度数组
+    :return: (bd_lng, bd_lat)
+    """
+    lng, lat = _as_array(lng, lat)
+    z = np.sqrt(lng * lng + lat * lat) + 0.00002 * np.sin(lat * x_pi)
+    theta = _arctan2(lat, lng) + 0.000003 * np.cos(lng * x_pi)
+    bd_lng = z * np.cos(theta) + 0.0065
+    bd_lat = z * np.sin(theta) + 0.006
+    return bd_lng, bd_lat
+
+
+def bd09_to_gcj02_np(bd_lon, bd_lat):
+    """
+    百度坐标系(BD-09)转火星坐标系(GCJ-02), 向量化版本
+    :param bd_lon:百度坐标经度数组
+    :param bd_lat:百度坐标纬度数组
+    :return: (gg_lng, gg_lat)
+    """
+    bd_lon, bd_lat = _as_array(bd_lon, bd_lat)
+    x = bd_lon - 0.0065
+    y = bd_lat - 0.006
+    z = np.sqrt(x * x + y * y) - 0.00002 * np.sin(y * x_pi)
+    theta = _arctan2(y, x) - 0.000003 * np.cos(x * x_pi)
+    gg_lng = z * np.cos(theta)
+    gg_lat = z * np.sin(theta)
+    return gg_lng, gg_lat
+
+
+def wgs84_to_gcj02_np(lng, lat):
+    """
+    WGS84转GCJ02(火星坐标系), 向量化版本, 国外的点不做偏移
+    :param lng:WGS84坐标系的经度数组
+    :param lat:WGS84坐标系的纬度数组
+    :return: (mglng, mglat)
+    """
+    lng, lat = _as_array(lng, lat)
+    dlng, dlat = _delta(lng, lat)
+    mask = out_of_china_np(lng, lat)
+    mglng = np.where(mask, lng, lng + dlng)
+    mglat = np.where(mask, lat, lat + dlat)
+    return mglng, mglat
+
+
+def gcj02_to_wgs84_np(lng, lat):
+    """
+    GCJ02(火星坐标系)转GPS84, 向量化版本, 国外的点不做偏移
+    :param lng:火星坐标系的经度数组
+    :param lat:火星坐标系纬度数组
+    :return: (lng, lat)
+    """
+    lng, lat = _as_array(lng, lat)
+    dlng, dlat = _delta(lng, lat)
+    mask = out_of_china_np(lng, lat)
+    mglng = lng + dlng
+    mglat = lat + dlat
+    return np.where(mask, lng, lng * 2 - mglng), np.where(mask, lat, lat * 2 - mglat)
+
+
+def bd09_to_wgs84_np(bd_lon, bd_lat):
+    lon, lat = bd09_to_gcj02_np(bd_lon, bd_lat)
+    return gcj02_to_wgs84_np(lon, lat)
+
+
+def wgs84_to_bd09_np(lon, lat):
+    lon, lat = wgs84_to_gcj02_np(lon, lat)
+    return gcj02_to_bd09_np(lon, lat)
+
+
+def out_of_china_np(lng, lat):
+    """
+    判断是否在国内，不在国内不做偏移
+    :return: bool 数组, True 表示在国外
+    """
+    return ~((lng > 73.66) & (lng < 135.05) & (lat > 3.86) & (lat < 53.55))
+
+
+def _as_array(lng, lat):
+    return np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+
+
+def _arctan2(y, x):
+    return np.asarray(_atan2(y, x), dtype=np.float64)
+
+
+def _delta(lng, lat):
+    dlat = _transformlat_np(lng - 105.0, lat - 35.0)
+    dlng = _transformlng_np(lng - 105.0, lat - 35.0)
+    radlat = lat / 180.0 * pi
+    magic = np.sin(radlat)
+    magic = 1 - ee * magic * magic
+    sqrtmagic = np.sqrt(magic)
+    dlat = (dlat * 180.0) / ((a * (1 - ee)) / (magic * sqrtmagic) * pi)
+    dlng = (dlng * 180.0) / (a / sqrtmagic * np.cos(radlat) * pi)
+    return dlng, dlat
+
+
+def _transformlat_np(lng, lat):
+    ret = -100.0 + 2.0 * lng + 3.0 * lat + 0.2 * lat * lat + \
+          0.1 * lng * lat + 0.2 * np.sqrt(np.fabs(lng))
+    ret += (20.0 * np.sin(6.0 * lng * pi) + 20.0 *
+            np.sin(2.0 * lng * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(lat * pi) + 40.0 *
+            np.sin(lat / 3.0 * pi)) * 2.0 / 3.0
+    ret += (160.0 * np.sin(lat / 12.0 * pi) + 320 *
+            np.sin(lat * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def _transformlng_np(lng, lat):
+    ret = 300.0 + lng + 2.0 * lat + 0.1 * lng * lng + \
+          0.1 * lng * lat + 0.1 * np.sqrt(np.fabs(lng))
+    ret += (20.0 * np.sin(6.0 * lng * pi) + 20.0 *
+            np.sin(2.0 * lng * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(lng * pi) + 40.0 *
+            np.sin(lng / 3.0 * pi)) * 2.0 / 3.0
+    ret += (150.0 * np.sin(lng / 12.0 * pi) + 300.0 *
+            np.sin(lng / 30.0 * pi)) * 2.0 / 3.0
+    return ret
@@ -0,0 +1,216 @@
+import os
+import time
+import asyncio
+import weakref
+import threading
+from tqdm import tqdm
+from loguru import logger
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .misc import USER_AGENT, RetryPolicy, TileFetchError
+from .proxy import NoProxyError
+from .throttle import get_host_limiter, parse_retry_after
+from .metrics import registry as metrics
+
+_LOOP = None
+_LOOP_PID = None
+_LOOP_LOCK = threading.Lock()
+
+
+def get_loop():
+    """The event loop shared by all fetchers, running in a daemon thread.
+
+    It is recreated after a fork, since the thread does not survive it.
+    """
+    global _LOOP, _LOOP_PID
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP_PID != os.getpid():
+            _LOOP = asyncio.new_event_loop()
+            _LOOP_PID = os.getpid()
+            threading.Thread(target=_LOOP.run_forever, name="tilemap-fetcher", daemon=True).start()
+    
+    return _LOOP
+
+
+def _close_session(loop, session):
+    if session.closed or loop.is_closed() or not loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+    except Exception as e:
+        logger.debug(f"Close session failed: {e!r}")
+
+
+class AsyncFetcher():
+    """Asyncio engine downloading many tiles concurrently from a single process.
+
+    The event loop lives in a daemon thread shared by all fetchers, so `fetch`
+    can be called from plain scripts as well as from a running loop (jupyter).
+    """
+
+    def __init__(self, limit=64, limit_per_host=8, timeout=(5, 30), keep_alive=30, throttle=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        # kwargs of the per-host `HostLimiter`, None to disable the throttling
+        self.throttle = throttle
+        self._session = None
+        self._finalizer = None
+
+
+    def __getstate__(self):
+        # the session is bound to the loop of this process, it is recreated lazily
+        state = self.__dict__.copy()
+        state.update({"_session": None, "_finalizer": None})
+        return state
+
+
+    async def _get_session(self):
+        # one session for the fetcher's lifetime, its connector keeps a pool of
+        # keep-alive connections for every host (i.e. provider subdomain)
+        if self._session is None or self._session.closed:
+            connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, 
+                limit_per_host=self.limit_per_host,
+                force_close=not self.keep_alive,
+                keepalive_timeout=self.keep_alive if self.keep_alive else None,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, 
+                headers={"user-agent": USER_AGENT},
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            )
+            self._finalizer = weakref.finalize(self, _close_session, asyncio.get_running_loop(), self._session)
+        
+        return self._session
+
+
+    def close(self):
+        """Close the http session."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._session, self._finalizer = None, None
+
+
+    def run(self, coro):
+        """Run a coroutine on the shared loop and block until it is done."""
+        return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+    def fetch(self, jobs, handler, policy=None, proxies=None, pbar_switch=False, desc="Fetching tiles", 
+              return_exceptions=False):
+        """Download `jobs` concurrently.
+
+        Args:
+            jobs (list): [(key, url), ...] pairs.
+            handler (Function): `handler(key, content)` called in a worker thread once
+                the content of `key` is downloaded; its return value is collected.
+            policy (RetryPolicy, optional): the retry policy of each url. Defaults to `RetryPolicy()`.
+            proxies (ProxyManager, optional): picks the proxy of each request and is fed with its outcome.
+            pbar_switch (bool, optional): show a progress bar. Defaults to False.
+            return_exceptions (bool, optional): put the exception of a failed job in the
+                results instead of raising it. Defaults to False.
+
+        Returns:
+            list: the results of `handler`, in the order of `jobs`.
+        """
+        if len(jobs) == 0:
+            return []
+
+        policy = policy or RetryPolicy()
+        return self.run(self._fetch_all(jobs, handler, policy, proxies, pbar_switch, desc, return_exceptions))
+
+
+    async def fetch_one(self, url, policy=None, proxies=None):
+        """Download one url from a coroutine running on the shared loop (`get_loop`).
+
+        Returns:
+            bytes: the content.
+
+        Raises:
+            TileFetchError: when the url fails permanently or after the retries of `policy`.
+        """
+        session = await self._get_session()
+        return await self._fetch_url(session, url, policy or RetryPolicy(), proxies)
+
+
+    async def _fetch_all(self, jobs, handler, policy, proxies, pbar_switch, desc, return_exceptions=False):
+        session = await self._get_session()
+        semaphore = asyncio.Semaphore(self.limit)
+        pbar = tqdm(total=len(jobs), desc=desc) if pbar_switch else None
+
+        async def _run(key, url):
+            try:
+                async with semaphore:
+                    content = await self._fetch_url(session, url, policy, proxies)
+                return await asyncio.get_running_loop().run_in_executor(None, handler, key, content)
+            finally:
+                if pbar is not None:
+                    pbar.update()
+
+        try:
+            res = await asyncio.gather(*[_run(key, url) for key, url in jobs], return_exceptions=return_exceptions)
+        finally:
+            if pbar is not None:
+                pbar.close()
+
+        return res
+
+
+    async def _fetch_url(self, session, url, policy, proxies=None):
+        limiter = get_host_limiter(url, **self.throttle) if self.throttle is not None else None
+        host = urlsplit(url).netloc
+        for attempt in range(policy.max_retries + 1):
+            try:
+                proxy = await proxies.get_async() if proxies is not None else None
+            except NoProxyError as e:
+                err = TileFetchError(f"Fetch {url} failed: {e}", url, retryable=True)
+                if attempt < policy.max_retries:
+                    await asyncio.sleep(policy.delay(attempt))
+                continue
+
+            if limiter is not None:
+                with metrics.timer("throttle_wait_seconds", host=host):
+                    await limiter.acquire_async()
+            status, retry_after, error = None, None, None
+            start = time.monotonic()
+            try:
+                logger.debug(f"Fetching tile: {url}, {proxy}")
+                async with session.get(url, proxy=proxy) as response:
+                    status = response.status
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if response.status < 400:
+                        content = await response.read()
+                        metrics.inc("bytes_downloaded", len(content), host=host)
+                        return content
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # connection errors, timeouts and broken bodies are transient
+                error = e
+                status = None
+            finally:
+                latency = time.monotonic() - start
+                metrics.inc("requests", host=host, status=str(status) if status else "error")
+                metrics.observe("request_seconds", latency, host=host)
+                if limiter is not None:
+                    limiter.release(status, latency, error, retry_after)
+                if proxies is not None:
+                    proxies.report(proxy, status, latency, error)
+            
+            if error is not None:
+                err = TileFetchError(f"Fetch {url} failed: {error!r}", url, retryable=True)
+            elif status == 404:
+                raise TileFetchError(f"Tile URL resulted in a 404 error. Double-check your tile url:\n{url}", url, status)
+            else:
+                err = TileFetchError(f"Tile URL resulted in a {status} error: {url}", url, status, policy.is_retryable(status))
+                if not err.retryable:
+                    raise err
+            
+            if attempt < policy.max_retries:
+                logger.debug(f"Retry {url} after {err}")
+                await asyncio.sleep(policy.delay(attempt, retry_after))
+        
+        raise err
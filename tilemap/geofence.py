@@ -0,0 +1,103 @@
+import numpy as np
+import shapely
+from loguru import logger
+
+from .coordtransform import wgs84_to_gcj02_np, gcj02_to_wgs84_np
+from .coordtransform import wgs84_to_bd09_np, bd09_to_wgs84_np
+from .coordtransform import gcj02_to_bd09_np, bd09_to_gcj02_np
+
+TRANSFORMS = {
+    ('wgs', 'gcj'): wgs84_to_gcj02_np,
+    ('gcj', 'wgs'): gcj02_to_wgs84_np,
+    ('wgs', 'bd'): wgs84_to_bd09_np,
+    ('bd', 'wgs'): bd09_to_wgs84_np,
+    ('gcj', 'bd'): gcj02_to_bd09_np,
+    ('bd', 'gcj'): bd09_to_gcj02_np,
+}
+
+
+def to_geometry(geofence):
+    """Union a shapely geometry / GeoSeries / GeoDataFrame into one geometry in lon/lat."""
+    if isinstance(geofence, shapely.Geometry):
+        return geofence
+
+    if getattr(geofence, "crs", None) is not None and not geofence.crs.equals("epsg:4326"):
+        geofence = geofence.to_crs(epsg=4326)
+    geoms = np.asarray(getattr(geofence, "geometry", geofence))
+
+    return shapely.union_all(geoms)
+
+
+def transform_geometry(geom, src='wgs', dst='wgs'):
+    """Transform the vertices of `geom` between the wgs/gcj/bd systems."""
+    assert src in ['wgs', 'gcj', 'bd'] and dst in ['wgs', 'gcj', 'bd'], \
+        "Check the coordination systems are within ['wgs', 'gcj', 'bd']."
+    if src == dst:
+        return geom
+
+    func = TRANSFORMS[(src, dst)]
+    return shapely.transform(geom, lambda coords: np.column_stack(func(coords[:, 0], coords[:, 1])))
+
+
+def xyz_bounds_np(xs, ys, z):
+    """Vectorized `mercantile.bounds`, returns the arrays (west, south, east, north)."""
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    Z2 = 2. ** z
+    west = xs / Z2 * 360.0 - 180.0
+    east = (xs + 1) / Z2 * 360.0 - 180.0
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ys / Z2))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (ys + 1) / Z2))))
+
+    return west, south, east, north
+
+
+def bd_bounds_np(xs, ys, z):
+    """Vectorized `baidutile.bounds_bd` in BD-09, returns the arrays (west, south, east, north)."""
+    from .coordtransform.coordTransform_bd import bd_mc_to_coord_np
+
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    f = 256 * 2. ** (18 - z)
+    west, south = bd_mc_to_coord_np(xs * f, ys * f)
+    east, north = bd_mc_to_coord_np((xs + 1) * f, (ys + 1) * f)
+
+    return west, south, east, north
+
+
+def intersects_mask(xs, ys, z, geom, sys='wgs'):
+    """Boolean mask of the tiles (xs, ys, z) intersecting `geom`.
+
+    The tile boxes are indexed with an STRtree and queried with the geofence.
+    """
+    bounds_func = bd_bounds_np if sys == 'bd' else xyz_bounds_np
+    boxes = shapely.box(*bounds_func(xs, ys, z))
+    mask = np.zeros(len(boxes), dtype=bool)
+    if len(boxes) == 0:
+        return mask
+
+    tree = shapely.STRtree(boxes)
+    mask[tree.query(geom, predicate="intersects")] = True
+
+    return mask
+
+
+def filter_tiles(tiles, geom, sys='wgs'):
+    """Keep the tiles intersecting `geom`.
+
+    Args:
+        tiles (list): list of mercantile.Tile, all at the same zoom.
+        geom (shapely.Geometry): the geofence, in the coordination system of the tiles.
+        sys (str, optional): the coordination system of the tile grid, the grid of
+            Baidu is used when `sys` is `bd`. Defaults to 'wgs'.
+
+    Returns:
+        list: the tiles intersecting the geofence, in the original order.
+    """
+    if len(tiles) == 0:
+        return tiles
+
+    xs = np.fromiter((t.x for t in tiles), dtype=np.int64, count=len(tiles))
+    ys = np.fromiter((t.y for t in tiles), dtype=np.int64, count=len(tiles))
+    idxs = np.flatnonzero(intersects_mask(xs, ys, tiles[0].z, geom, sys))
+    logger.debug(f"Geofence keeps {len(idxs)} / {len(tiles)} tiles.")
+
+    return [tiles[i] for i in idxs]
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import pickle
+import numpy as np
+import mercantile as mt
+from tqdm import tqdm
+from pathlib import Path
+from loguru import logger
+from mercantile import LL_EPSILON
+from multiprocessing import Pool, cpu_count
+
+from . import throttle
+from .metrics import registry as metrics
+
+PENDING, DONE, FAILED, SKIPPED = 0, 1, 2, 3
+STATES = {PENDING: "pending", DONE: "done", FAILED: "failed", SKIPPED: "skipped"}
+
+
+class CrawlJob():
+    """Resumable crawl of a bounding box over several zoom levels.
+
+    Every zoom level is a rectangle of tile indexes with a state (pending, done,
+    failed, or skipped by the geofence) per tile. The manifest is a compressed
+    `.npz` file, checkpointed periodically; resuming a job only walks the pending
+    tiles, without looking the cache up for the finished ones.
+
+    Args:
+        tilemap (TileMap): the provider and cache to crawl into.
+        manifest (str): the path of the `.npz` manifest, loaded if it exists.
+        bounds (tuple, optional): (west, south, east, north) in wgs; ignored when resuming.
+        zooms (list, optional): the zoom levels; ignored when resuming.
+        geofence (optional): shapely geometry / GeoDataFrame, only the tiles intersecting it are crawled.
+        geofence_sys (str, optional): the coordination system of the geofence. Defaults to 'wgs'.
+        checkpoint_interval (int, optional): seconds between two checkpoints. Defaults to 60.
+
+    Example:
+        >>> job = CrawlJob(TileMap(providers.Amap.Satellite), './shenzhen.npz', bounds, zooms=[16, 17, 18])
+        >>> job.run()
+        >>> job.stats()
+    """
+
+    def __init__(self, tilemap, manifest, bounds=None, zooms=None, geofence=None, geofence_sys='wgs', checkpoint_interval=60):
+        self.tilemap = tilemap
+        self.manifest = Path(manifest)
+        self.checkpoint_interval = checkpoint_interval
+        self.grids = {}
+        self._last_checkpoint = time.time()
+
+        if self.manifest.exists():
+            self._load()
+            logger.info(f"Resume crawl job from {self.manifest}: {self.stats()}")
+        else:
+            assert bounds is not None and zooms is not None, "Check `bounds` and `zooms` for a new crawl job."
+            self.bounds = tuple(float(i) for i in bounds)
+            for z in zooms:
+                self.grids[int(z)] = self._init_grid(self.bounds, int(z), geofence, geofence_sys)
+            self.checkpoint()
+
+
+    def _init_grid(self, bounds, z, geofence=None, geofence_sys='wgs'):
+        return init_grid(self.tilemap, bounds, z, geofence, geofence_sys)
+
+
+    def _load(self):
+        with np.load(self.manifest) as data:
+            meta = json.loads(str(data["meta"]))
+            assert meta["provider"] == self.tilemap.provider.name, \
+                f"The manifest belongs to {meta['provider']}, not {self.tilemap.provider.name}."
+            self.bounds = tuple(meta["bounds"])
+            for z, grid in meta["grids"].items():
+                self.grids[int(z)] = dict(grid, state=data[f"state_{z}"].copy())
+
+
+    def checkpoint(self):
+        """Write the manifest atomically."""
+        meta = {
+            "provider": self.tilemap.provider.name,
+            "bounds": self.bounds,
+            "grids": {z: {k: v for k, v in g.items() if k != "state"} for z, g in self.grids.items()},
+        }
+        states = {f"state_{z}": g["state"] for z, g in self.grids.items()}
+
+        tmp = self.manifest.with_name(self.manifest.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, meta=json.dumps(meta), **states)
+        os.replace(tmp, self.manifest)
+        self._last_checkpoint = time.time()
+        logger.debug(f"Checkpoint {self.manifest}: {self.stats()}")
+
+
+    def stats(self):
+        """The number of tiles in each state, per zoom level."""
+        res = {}
+        for z, grid in self.grids.items():
+            counts = np.bincount(grid["state"], minlength=len(STATES))
+            res[z] = {name: int(counts[i]) for i, name in STATES.items()}
+
+        return res
+
+
+    def failed_tiles(self):
+        return [t for z in self.grids for t in self._tiles(z, np.flatnonzero(self.grids[z]["state"] == FAILED))]
+
+
+    def _tiles(self, z, idxs):
+        grid = self.grids[z]
+        xs, ys = np.divmod(idxs, grid["ny"])
+
+        return [mt.Tile(int(x) + grid["x0"], int(y) + grid["y0"], z) for x, y in zip(xs, ys)]
+
+
+    def run(self, batch_size=1024, wait=.5, max_retries=2, retry_failed=False, skip_cached=True, n_jobs=1):
+        """Crawl the pending tiles.
+
+        Args:
+            batch_size (int, optional): the number of tiles handed to the fetcher at once. Defaults to 1024.
+            wait (float, optional): the base of the backoff between two attempts. Defaults to .5.
+            max_retries (int, optional): the retries allowed for each tile. Defaults to 2.
+            retry_failed (bool, optional): crawl the failed tiles again. Defaults to False.
+            skip_cached (bool, optional): look the pending tiles up in the cache before
+                fetching them, e.g. for a cache filled by others. Defaults to True.
+            n_jobs (int, optional): the number of worker processes, each running a concurrent
+                fetch loop over the batches it is handed; -1 for all the cores. Defaults to 1.
+
+        Returns:
+            dict: `stats` of the job.
+        """
+        tm = self.tilemap
+        if retry_failed:
+            for grid in self.grids.values():
+                grid["state"][grid["state"] == FAILED] = PENDING
+
+        policy = tm.retry_policy(backoff=wait, max_retries=max_retries)
+        todo = {z: np.flatnonzero(g["state"] == PENDING) for z, g in self.grids.items()}
+        batches = ((z, idxs[i: i + batch_size]) for z, idxs in todo.items() for i in range(0, len(idxs), batch_size))
+
+        pool = None
+        if n_jobs == 1:
+            results = (
+                (z, chunk, _crawl_batch(tm, self._tiles(z, chunk), policy, skip_cached), None) for z, chunk in batches)
+        else:
+            # every worker runs its own fetch loop, the manifest is only written here
+            n_jobs = cpu_count() if n_jobs == -1 else n_jobs
+            pool = Pool(n_jobs, _init_worker, (pickle.dumps(tm), policy, skip_cached, n_jobs))
+            results = pool.imap_unordered(_crawl_worker, ((z, chunk, self._tiles(z, chunk)) for z, chunk in batches))
+
+        pbar = tqdm(total=sum(len(i) for i in todo.values()), desc=f"Crawling {tm.provider.name}")
+        try:
+            for z, chunk, states, worker_metrics in results:
+                self.grids[z]["state"][chunk] = states
+                if worker_metrics is not None:
+                    metrics.merge(worker_metrics)
+                pbar.update(len(chunk))
+                if time.time() - self._last_checkpoint > self.checkpoint_interval:
+                    self.checkpoint()
+                    metrics.flush()
+        finally:
+            pbar.close()
+            if pool is not None:
+                pool.terminate()
+            self.checkpoint()
+            metrics.flush(final=True)
+
+        return self.stats()
+
+
+def _crawl_batch(tm, tiles, policy, skip_cached=True):
+    """Fetch the `tiles` of one batch, return their states (DONE / FAILED)."""
+    states = np.full(len(tiles), DONE, dtype=np.uint8)
+    todo = range(len(tiles))
+    if skip_cached:
+        todo = [j for j, t in enumerate(tiles) if not tm.cache.exists(t)]
+
+    jobs = [(j, tm._construct_tile_url(*tiles[j])) for j in todo]
+    res = tm.fetcher.fetch(
+        jobs,
+        lambda j, content: tm._save_tile(tiles[j], content),
+        policy,
+        tm.proxies,
+        return_exceptions=True
+    )
+    for (j, _), r in zip(jobs, res):
+        if isinstance(r, BaseException):
+            states[j] = FAILED
+    tm.cache.flush()
+
+    return states
+
+
+_WORKER = {}
+
+
+def _split_throttle(budget, n_workers):
+    """The share of the host `budget` of one of `n_workers` processes, each running its own `HostLimiter`."""
+    if budget is None or n_workers <= 1:
+        return budget
+
+    return {**budget, "rate": budget["rate"] / n_workers,
+            "max_concurrency": max(1, budget["max_concurrency"] // n_workers)}
+
+
+def _init_worker(tilemap, policy, skip_cached, n_workers=1):
+    tm = pickle.loads(tilemap)
+    # the decoded tiles are never read back while seeding
+    tm.arrays = None
+    # the workers share the rate and the concurrency allowed per host
+    throttle._LIMITERS.clear()
+    tm.throttle = _split_throttle(tm.throttle, n_workers)
+    tm._fetcher = None
+    metrics.reset()
+    metrics.sinks = []
+    _WORKER.update(tm=tm, policy=policy, skip_cached=skip_cached)
+
+
+def _crawl_worker(params):
+    z, chunk, tiles = params
+    states = _crawl_batch(_WORKER["tm"], tiles, _WORKER["policy"], _WORKER["skip_cached"])
+    # the metrics of the batch, merged into the registry of the parent
+    return z, chunk, states, metrics.collect(reset=True)
+
+
+def init_grid(tilemap, bounds, z, geofence=None, geofence_sys='wgs'):
+    """The rectangle of tile indexes covering `bounds` (wgs) at `z`, with the state
+    of each tile; the tiles not intersecting the geofence are SKIPPED."""
+    w, s, e, n = bounds
+    if tilemap.tile_coord_sys in ['gcj', 'bd']:
+        w, s = tilemap.from_wgs(w, s)
+        e, n = tilemap.from_wgs(e, n)
+    x0, y0, x1, y1 = tile_range(w, s, e, n, z, tilemap.tile_coord_sys)
+    nx, ny = x1 - x0 + 1, y1 - y0 + 1
+    state = np.zeros(nx * ny, dtype=np.uint8)
+
+    if geofence is not None:
+        from .geofence import to_geometry, transform_geometry, intersects_mask
+        geom = transform_geometry(to_geometry(geofence), geofence_sys, tilemap.tile_coord_sys)
+        # chunks of columns, to bound the number of boxes alive at once
+        step = max(1, 2 ** 20 // ny)
+        for i in range(0, nx, step):
+            cols = np.arange(i, min(i + step, nx))
+            xs = np.repeat(cols + x0, ny)
+            ys = np.tile(np.arange(y0, y1 + 1), len(cols))
+            mask = intersects_mask(xs, ys, z, geom, tilemap.tile_coord_sys)
+            state[i * ny: i * ny + len(xs)][~mask] = SKIPPED
+
+    return {"x0": x0, "y0": y0, "nx": nx, "ny": ny, "state": state}
+
+
+def tile_range(w, s, e, n, z, sys='wgs'):
+    """The (x0, y0, x1, y1) index range of the tiles covering a bounding box,
+    in the same way as `mercantile.tiles` or `baidutile.tiles_bd`."""
+    assert w < e, "Bounding boxes crossing the antimeridian are not supported."
+    w, s = max(-180.0, w), max(-85.051129, s)
+    e, n = min(180.0, e), min(85.051129, n)
+
+    if sys == 'bd':
+        import math
+        from .coordtransform.coordTransform_bd import bd_coord_to_mc
+        w, s = bd_coord_to_mc(w, s)
+        e, n = bd_coord_to_mc(e, n)
+        f = math.pow(2, 18 - z) * 256
+        return math.floor(w / f), math.floor(s / f), math.ceil(e / f), math.ceil(n / f)
+
+    ul = mt.tile(w, n, z)
+    lr = mt.tile(e - LL_EPSILON, s + LL_EPSILON, z)
+    return ul.x, ul.y, lr.x, lr.y
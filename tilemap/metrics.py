@@ -0,0 +1,264 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+
+
+class Histogram():
+    """Counts of the observations per bucket, the last bucket is +Inf."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def merge(self, other):
+        assert self.buckets == other.buckets, "Check the histograms share the buckets."
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+    def quantile(self, q):
+        """The `q` quantile, interpolated linearly within its bucket."""
+        if self.count == 0:
+            return None
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.buckets[i - 1] if i > 0 else 0.
+                if i == len(self.buckets):
+                    return lo
+                return lo + (self.buckets[i] - lo) * (rank - seen) / n
+            seen += n
+
+        return self.buckets[-1]
+
+
+class MetricsRegistry():
+    """In-process registry of the counters and histograms of the crawls.
+
+    Every metric is keyed by its name and labels, e.g. `requests` by host and
+    status. `flush` pushes the registry to the sinks, e.g. `PrometheusFileSink`
+    or `CallbackSink`; `TileMap` and `CrawlJob` flush at the end of each batch.
+    Each process has its own registry, `collect` and `merge` carry the metrics
+    of the workers back to the parent.
+
+    Metrics:
+        cache_hits (provider, layer): tiles read from the memory / disk cache.
+        cache_misses (provider): tiles not cached.
+        cache_read_seconds, cache_write_seconds (provider): the disk cache.
+        bytes_written (provider): tile bytes written into the cache.
+        requests (host, status): http attempts, status 'error' for the connection errors and timeouts.
+        request_seconds (host): latency of the http attempts.
+        throttle_wait_seconds (host): the waits for the per-host rate limiter.
+        bytes_downloaded (host): the bodies of the successful responses.
+        decode_seconds (provider): image decoding.
+        merge_seconds (provider): writing a tile into the mosaic of `bounds2img`.
+        render_seconds: a map of `render.render_maps`.
+
+    Example:
+        >>> from tilemap.metrics import registry, PrometheusFileSink
+        >>> registry.add_sink(PrometheusFileSink('./metrics/tilemap.prom'))
+        >>> tile.bounds2img(*bounds, zoom=17)
+        >>> registry.snapshot()['counters']['cache_hits']
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.sinks = []
+        self._lock = threading.Lock()
+
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def collect(self, reset=False):
+        """The raw state, picklable; emptied if `reset`, e.g. by the workers between two batches."""
+        with self._lock:
+            state = {"counters": dict(self.counters), "histograms": self.histograms}
+            if reset:
+                self.counters, self.histograms = {}, {}
+            else:
+                state["histograms"] = {k: _copy_histogram(v) for k, v in self.histograms.items()}
+
+        return state
+
+
+    def merge(self, state):
+        """Add the `collect` state of another registry."""
+        with self._lock:
+            for key, value in state["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, hist in state["histograms"].items():
+                if key in self.histograms:
+                    self.histograms[key].merge(hist)
+                else:
+                    self.histograms[key] = _copy_histogram(hist)
+
+
+    def snapshot(self):
+        """The metrics as plain dicts, {'counters': {name: [{'labels': .., 'value': ..}]}, 'histograms': ...}."""
+        state = self.collect()
+        res = {"counters": {}, "histograms": {}}
+        for (name, labels), value in sorted(state["counters"].items()):
+            res["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), hist in sorted(state["histograms"].items(), key=lambda i: i[0]):
+            res["histograms"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": hist.count,
+                "sum": hist.sum,
+                "p50": hist.quantile(.5),
+                "p99": hist.quantile(.99),
+            })
+
+        return res
+
+
+    def reset(self):
+        with self._lock:
+            self.counters, self.histograms = {}, {}
+
+
+    def add_sink(self, sink):
+        """`sink(registry)` is called on every `flush`; a sink throttling its calls defines
+        `force(registry)`, called on the final flush instead."""
+        self.sinks.append(sink)
+        return sink
+
+
+    def remove_sink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+
+    def flush(self, final=False):
+        """Call the sinks, `final` marks the last flush of a run, e.g. of a crawl job."""
+        for sink in list(self.sinks):
+            if final and hasattr(sink, "force"):
+                sink.force(self)
+            else:
+                sink(self)
+
+
+def _copy_histogram(hist):
+    res = Histogram(hist.buckets)
+    res.merge(hist)
+    return res
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def to_prometheus(registry, prefix="tilemap"):
+    """The registry in the Prometheus text exposition format."""
+    state = registry.collect()
+    lines = []
+    names = sorted({name for name, _ in state["counters"]})
+    for name in names:
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        for (key, labels), value in sorted(state["counters"].items()):
+            if key == name:
+                lines.append(f"{prefix}_{name}_total{_labels(labels)} {value}")
+
+    names = sorted({name for name, _ in state["histograms"]})
+    for name in names:
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        for (key, labels), hist in sorted(state["histograms"].items(), key=lambda i: i[0]):
+            if key != name:
+                continue
+            cumulative = 0
+            for bound, n in zip(list(hist.buckets) + ["+Inf"], hist.counts):
+                cumulative += n
+                lines.append(f"{prefix}_{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{prefix}_{name}_sum{_labels(labels)} {hist.sum}")
+            lines.append(f"{prefix}_{name}_count{_labels(labels)} {hist.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusFileSink():
+    """Write the registry into a Prometheus text file, e.g. for the textfile collector of node_exporter.
+
+    The file is replaced atomically, so a scrape never reads a partial file.
+    """
+
+    def __init__(self, path, prefix="tilemap"):
+        self.path = path
+        self.prefix = prefix
+
+
+    def __call__(self, registry):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(to_prometheus(registry, self.prefix))
+        os.replace(tmp, self.path)
+
+
+class CallbackSink():
+    """Call `func(snapshot)` on every flush, at most once every `interval` seconds; the
+    final flush is always emitted, so that `func` sees the totals."""
+
+    def __init__(self, func, interval=0):
+        self.func = func
+        self.interval = interval
+        self._last = 0
+
+
+    def __call__(self, registry):
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            return
+        self.force(registry)
+
+
+    def force(self, registry):
+        self._last = time.monotonic()
+        self.func(registry.snapshot())
+
+
+registry = MetricsRegistry()
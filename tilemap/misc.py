@@ -1,23 +1,147 @@
-import os
+import time
+import random
+import threading
 import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from .throttle import parse_retry_after
+from .metrics import registry as metrics
 
 
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/104.0.5112.102 Safari/537.36 Edg/104.0.1293.63"
 
 
+class SessionPool():
+    """Keep-alive `requests.Session` objects, one per (provider, host).
+
+    Each subdomain of a provider gets its own session and connection pool, so
+    tiles reuse the TCP/TLS connections instead of opening one per request.
+    """
+
+    def __init__(self, pool_size=8, timeout=(5, 30), keep_alive=30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        # sessions hold sockets, every process builds its own
+        state = self.__dict__.copy()
+        state.update({"_sessions": {}, "_lock": None})
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def get(self, url, provider=None):
+        key = (provider, urlsplit(url).netloc)
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+        
+        with self._lock:
+            if key not in self._sessions:
+                self._sessions[key] = self._create_session()
+        
+        return self._sessions[key]
+
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"user-agent": USER_AGENT})
+        if self.keep_alive:
+            session.headers.update({"Connection": "keep-alive", "Keep-Alive": f"timeout={self.keep_alive}"})
+        else:
+            session.headers.update({"Connection": "close"})
+        
+        return session
+
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
 def get_proxy(proxy_url=None):
     if proxy_url is None:
         return None
     
     try:
-        response = requests.get(proxy_url)
+        response = requests.get(proxy_url, timeout=10)
         if response.status_code == 200:
             return {'http': response.text} 
-    except requests.exceptions.ConnectionError:
+    except requests.RequestException:
         return None
 
 
-def http_retryer(url, wait, max_retries, proxy=None):
+class TileFetchError(requests.RequestException):
+    """A tile could not be fetched; `retryable` tells transient errors from permanent ones."""
+
+    def __init__(self, message, url=None, status=None, retryable=False):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+        self.retryable = retryable
+
+
+class NoProxyError(RuntimeError):
+    """The pool of a `proxy.ProxyManager` has no proxy and direct connections are not allowed."""
+
+
+class RetryPolicy():
+    """Retries with jittered exponential backoff.
+
+    The n-th retry sleeps `uniform(0, min(max_backoff, backoff * 2 ** n))`
+    seconds ("full jitter"), or the `Retry-After` of the response if longer.
+    Statuses in `retry_statuses` and connection errors / timeouts are retried,
+    the others (e.g. 404) fail at once.
+
+    Calling the policy returns an updated copy, e.g. `policy(max_retries=5)`.
+    """
+
+    def __init__(self, max_retries=2, backoff=.5, max_backoff=30, jitter=True, 
+                 retry_statuses=(104, 408, 429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+
+
+    def __call__(self, **kwargs):
+        new = RetryPolicy(**self.__dict__)
+        new.__dict__.update({k: v for k, v in kwargs.items() if v is not None})
+        return new
+
+
+    def __repr__(self):
+        return f"RetryPolicy({self.__dict__})"
+
+
+    def delay(self, attempt, retry_after=None):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        
+        return max(delay, retry_after or 0)
+
+
+    def is_retryable(self, status):
+        return status in self.retry_statuses
+
+
+def http_retryer(url, wait, max_retries, proxy=None, session=None, timeout=None, limiter=None, policy=None, proxies=None):
     """
     Retry a url many times in attempt to get a tile
 
@@ -28,30 +152,91 @@ def http_retryer(url, wait, max_retries, proxy=None):
         a properly-formatted url for a tile provider.
     wait : int
         if the tile API is rate-limited, the number of seconds to wait
-        between a failed request and the next try
+        between a failed request and the next try, i.e. the base of the
+        exponential backoff
     max_retries : int
         total number of rejected requests allowed before contextily
         will stop trying to fetch more tiles from a rate-limited API.
+    proxy : dict
+        [Optional. Default: None] proxies passed to `requests`.
+    session : requests.Session
+        [Optional. Default: None] keep-alive session used to send the
+        request, e.g. from `SessionPool.get`; a bare `requests.get` if None.
+    timeout : float or tuple
+        [Optional. Default: None] (connect, read) timeout in seconds.
+    limiter : throttle.HostLimiter
+        [Optional. Default: None] rate limiter of the host, fed with the
+        status and latency of the response.
+    policy : RetryPolicy
+        [Optional. Default: None] the retry policy, `wait` and `max_retries`
+        override its `backoff` and `max_retries`.
+    proxies : proxy.ProxyManager
+        [Optional. Default: None] pool picking the proxy of each attempt,
+        fed with the outcome; overrides `proxy`.
 
     Returns
     -------
     request object containing the web response.
+
+    Raises
+    ------
+    TileFetchError
+        when the tile fails permanently or after `max_retries` retries.
     """
-    try:
-        request = requests.get(url, headers={"user-agent": USER_AGENT}, proxies=proxy)
-        request.raise_for_status()
-    except requests.HTTPError:
-        if request.status_code == 404:
-            raise requests.HTTPError(
-                "Tile URL resulted in a 404 error. "
-                "Double-check your tile url:\n{}".format(url)
-            )
-        elif request.status_code == 104:
-            if max_retries > 0:
-                os.wait(wait)
-                max_retries -= 1
-                request = http_retryer(url, wait, max_retries, proxy)
+    policy = (policy or RetryPolicy())(backoff=wait, max_retries=max_retries)
+    host = urlsplit(url).netloc
+    for attempt in range(policy.max_retries + 1):
+        status, retry_after = None, None
+        if proxies is not None:
+            try:
+                proxy_url = proxies.get()
+            except NoProxyError as e:
+                error = TileFetchError(f"Fetch {url} failed: {e}", url, retryable=True)
+                if attempt < policy.max_retries:
+                    time.sleep(policy.delay(attempt))
+                continue
+            proxy = {"http": proxy_url, "https": proxy_url} if proxy_url else None
+        if limiter is not None:
+            with metrics.timer("throttle_wait_seconds", host=host):
+                limiter.acquire()
+        start = time.monotonic()
+        try:
+            if session is None:
+                request = requests.get(url, headers={"user-agent": USER_AGENT}, proxies=proxy, timeout=timeout)
             else:
-                raise requests.HTTPError("Connection reset by peer too many times.")
-    return request
-
+                request = session.get(url, proxies=proxy, timeout=timeout)
+        except requests.RequestException as e:
+            latency = time.monotonic() - start
+            metrics.inc("requests", host=host, status="error")
+            metrics.observe("request_seconds", latency, host=host)
+            if limiter is not None:
+                limiter.release(latency=latency, error=e)
+            if proxies is not None:
+                proxies.report(proxy_url, latency=latency, error=e)
+            error = TileFetchError(f"Fetch {url} failed: {e!r}", url, retryable=True)
+        else:
+            latency = time.monotonic() - start
+            status = request.status_code
+            retry_after = parse_retry_after(request.headers.get("Retry-After"))
+            metrics.inc("requests", host=host, status=str(status))
+            metrics.observe("request_seconds", latency, host=host)
+            if limiter is not None:
+                limiter.release(status, latency, retry_after=retry_after)
+            if proxies is not None:
+                proxies.report(proxy_url, status, latency)
+            if request.ok:
+                metrics.inc("bytes_downloaded", len(request.content), host=host)
+                return request
+            if status == 404:
+                raise TileFetchError(
+                    "Tile URL resulted in a 404 error. "
+                    "Double-check your tile url:\n{}".format(url), url, status)
+            error = TileFetchError(
+                f"Tile URL resulted in a {status} error: {url}", url, status, policy.is_retryable(status))
+            if not error.retryable:
+                raise error
+        
+        if attempt < policy.max_retries:
+            time.sleep(policy.delay(attempt, retry_after))
+    
+    raise error
@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+
+# the fixed point weights of PIL's `convert("L")`, ITU-R 601-2 luma
+LUMA = np.array([19595, 38470, 7471], dtype=np.uint32)
+CHANNELS = {"RGBA": 4, "RGB": 3, "L": 1}
+
+
+def convert_channels(array, channels="RGBA"):
+    """Convert the RGBA array of a tile into `channels`, i.e. RGBA, RGB or L (single band)."""
+    if channels == "RGBA":
+        return array
+    if channels == "RGB":
+        return array[..., :3]
+
+    luma = (array[..., :3].astype(np.uint32) @ LUMA + 0x8000) >> 16
+    return luma.astype(np.uint8)[..., None]
+
+
+class Mosaic():
+    """The preallocated output buffer of `bounds2img`.
+
+    The geometry is known from the tile indexes up front, the buffer is
+    allocated once the first tile tells the tile size, and every tile is
+    written straight into its slot as soon as it is decoded, from the threads
+    of the fetcher. The tiles are decoded straight into `channels` (PIL's
+    `convert`), so an RGB or L mosaic never holds an RGBA copy of a tile; only
+    the synthesized tiles of overzoom arrive as RGBA and are converted here.
+    Besides the mosaic, the decoded tiles are only held by the shared array
+    cache of the `TileMap`, see `cache_arrays` of `bounds2img`.
+    The slots of the failed tiles stay transparent.
+
+    Args:
+        tiles (list): the tiles of the mosaic, on one zoom level.
+        flip (bool, optional): the rows grow northward, i.e. the Baidu grid. Defaults to False.
+        channels (str, optional): RGBA, RGB or L (single band). Defaults to 'RGBA'.
+    """
+
+    def __init__(self, tiles, flip=False, channels="RGBA"):
+        assert channels in CHANNELS, f"Check channels is within {list(CHANNELS)}."
+        self.tiles = tiles
+        self.flip = flip
+        self.channels = channels
+        xs = [t.x for t in tiles]
+        ys = [t.y for t in tiles]
+        self.layout = min(xs), min(ys), max(xs), max(ys)
+        self.shape = (self.layout[3] - self.layout[1] + 1, self.layout[2] - self.layout[0] + 1)
+        self.image = None
+        self.count = 0
+        self._lock = threading.Lock()
+
+
+    def slot(self, tile):
+        """The (row, col) of `tile`, rows run from north to south."""
+        xmin, ymin, _, ymax = self.layout
+        # 百度瓦片的 y 轴向北递增
+        row = ymax - tile.y if self.flip else tile.y - ymin
+
+        return row, tile.x - xmin
+
+
+    def put(self, i, array):
+        """Write the `array` of `tiles[i]`, in the channels of the mosaic or RGBA, into its slot."""
+        h, w = array.shape[:2]
+        if self.image is None:
+            with self._lock:
+                if self.image is None:
+                    n_rows, n_cols = self.shape
+                    # calloc, the pages of the transparent slots are never touched
+                    self.image = np.zeros((n_rows * h, n_cols * w, CHANNELS[self.channels]), dtype=np.uint8)
+        assert self.image.shape[0] == self.shape[0] * h and self.image.shape[1] == self.shape[1] * w, \
+            f"Check the tiles share one size, {self.tiles[i]} is {w} x {h}."
+
+        row, col = self.slot(self.tiles[i])
+        if array.shape[2] != self.image.shape[2]:
+            array = convert_channels(array, self.channels)
+        self.image[row * h: (row + 1) * h, col * w: (col + 1) * w] = array
+        with self._lock:
+            self.count += 1
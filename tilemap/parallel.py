@@ -2,7 +2,7 @@ from tqdm import tqdm
 from multiprocessing import cpu_count, Pool
 
 
-def parallel_process(func, queue, pbar_switch=False, desc='Parallel processing', n_jobs=-1):
+def parallel_process(func, queue, pbar_switch=False, desc='Parallel processing', n_jobs=-1, initializer=None, initargs=()):
     """parallel process helper
 
     Args:
@@ -10,6 +10,7 @@ def parallel_process(func, queue, pbar_switch=False, desc='Parallel processing',
         queue ([tuple, tuple, ..., tuple]): the columns in df must contains the parmas in the func.
         desc (str, optional): [description]. Defaults to 'Parallel processing'.
         n_jobs (int, optional): [description]. Defaults to -1.
+        initializer (Function, optional): called with `initargs` by each worker on start. Defaults to None.
 
     Returns:
         [type]: [description]
@@ -21,7 +22,7 @@ def parallel_process(func, queue, pbar_switch=False, desc='Parallel processing',
             return []
     
     n_jobs = cpu_count() if n_jobs == -1 or n_jobs > cpu_count() else n_jobs
-    pool = Pool(n_jobs)
+    pool = Pool(n_jobs, initializer, initargs)
     
     if pbar_switch:
         pbar = tqdm(size, desc=desc)
@@ -6,11 +6,17 @@ from contextily.tile import warp_tiles
 
 from . import providers as PROVIDERS
 from . import TileProvider
+from . import tile as _tile
 from .tile import TileMap, PROVIDERS, CACHE_FOLDER
+from .cache import MosaicLRU
 
 ZOOM = "auto"
 ATTRIBUTION_SIZE = 8
 INTERPOLATION = "bilinear"
+MOSAIC_CACHE_BYTES = 256 * 2 ** 20
+# the merged (and warped) basemaps, shared by every `add_basemap`
+_MOSAICS = MosaicLRU(MOSAIC_CACHE_BYTES)
+_TILEMAPS = {}
 
 def add_basemap(
     ax,
@@ -23,6 +29,8 @@ def add_basemap(
     crs=None,
     resampling=Resampling.bilinear,
     cache_folder=None,
+    overzoom=False,
+    mosaic_cache=True,
     **extra_imshow_args
 ):
     """
@@ -77,6 +85,15 @@ def add_basemap(
         Source url for web tiles, or path to local file. If
         local, the file is read with `rasterio` and all
         bands are loaded into the basemap.
+    overzoom : bool
+        [Optional. Default=False] If True, the zoom levels beyond the
+        `max_zoom` of the provider are synthesized from its tiles at
+        `max_zoom`, see `TileMap.bounds2img`.
+    mosaic_cache : bool
+        [Optional. Default=True] Reuse the merged (and warped) basemap of a
+        previous call with the same provider, tile range, zoom, `crs` and
+        `resampling`, kept in a LRU of `MOSAIC_CACHE_BYTES`, see
+        `set_mosaic_cache`. The partial basemaps are never kept.
     **extra_imshow_args :
         Other parameters to be passed to `imshow`.
 
@@ -121,15 +138,26 @@ def add_basemap(
             left, right, bottom, top, crs, {"init": "epsg:3857"}
         )
     # Download image
-    cfg = {"provider": provider, "cache_folder": cache_folder}
-    tile_processor = TileMap(**cfg)
-    
-    image, extent = tile_processor.bounds2img(
-        left, bottom, right, top, zoom=zoom, ll=True
-    )
-    # Warping
-    if crs is not None:
-        image, extent = warp_tiles(image, extent, t_crs=crs, resampling=resampling)
+    tile_processor = _get_tilemap(provider, cache_folder)
+    key = None
+    if mosaic_cache:
+        z, tile_range = tile_processor.tile_range(left, bottom, right, top, zoom=zoom, ll=True, overzoom=overzoom)
+        key = (provider.get("name"), provider.get("url"), z, tile_range, str(crs), resampling)
+    cached = _MOSAICS.get(key) if key is not None else None
+
+    if cached is not None:
+        image, extent = cached
+    else:
+        # the tilemap is shared, the failures of this call are collected apart
+        failed = []
+        image, extent = tile_processor.bounds2img(
+            left, bottom, right, top, zoom=zoom, ll=True, overzoom=overzoom, failed=failed
+        )
+        # Warping
+        if crs is not None:
+            image, extent = warp_tiles(image, extent, t_crs=crs, resampling=resampling)
+        if key is not None and not failed:
+            _MOSAICS.put(key, (image, extent))
     # Check if overlay
     if _is_overlay(provider) and 'zorder' not in extra_imshow_args:
         # If zorder was not set then make it 9 otherwise leave it
@@ -164,6 +192,27 @@ def add_basemap(
     return
 
 
+def _get_tilemap(provider, cache_folder=None):
+    """The `TileMap` shared by the basemaps of `provider`, created on first use."""
+    folder = _tile.CACHE_FOLDER if cache_folder is None else cache_folder
+    key = (provider.get("name"), provider.get("url"), str(folder))
+    tm = _TILEMAPS.get(key)
+    if tm is None:
+        tm = _TILEMAPS.setdefault(key, TileMap(provider=provider, cache_folder=folder))
+
+    return tm
+
+
+def set_mosaic_cache(max_bytes=MOSAIC_CACHE_BYTES):
+    """Empty and resize the cache of the basemaps, 0 disables it."""
+    _MOSAICS.max_bytes = max_bytes
+    _MOSAICS.clear()
+
+
+def mosaic_cache_stats():
+    return _MOSAICS.stats()
+
+
 def plot_geodata(
     gdf,
     figsize=(12,9),
@@ -179,6 +228,7 @@ def plot_geodata(
     fn=None,
     tile_alpha=None,
     axis_off=True,
+    overzoom=False,
     extra_imshow_args={},
     *args,
     **extra_plot_args
@@ -235,6 +285,9 @@ def plot_geodata(
         Source url for web tiles, or path to local file. If
         local, the file is read with `rasterio` and all
         bands are loaded into the basemap.
+    overzoom : bool
+        [Optional. Default=False] Synthesize the zoom levels beyond the
+        `max_zoom` of the provider, see `add_basemap`.
     **extra_imshow_args :
         Other parameters to be passed to `imshow`.
 
@@ -268,7 +321,7 @@ def plot_geodata(
     gdf.plot(ax=ax, *args, **extra_plot_args)
     if tile_alpha is not None:
         extra_imshow_args['alpha'] = tile_alpha
-    add_basemap(ax, zoom, provider, interpolation, attribution, attribution_size, reset_extent, crs, resampling, cache_folder, **extra_imshow_args)
+    add_basemap(ax, zoom, provider, interpolation, attribution, attribution_size, reset_extent, crs, resampling, cache_folder, overzoom, **extra_imshow_args)
     
     # 去除科学记数法
     ax.get_xaxis().get_major_formatter().set_useOffset(False)
@@ -0,0 +1,288 @@
+import os
+import time
+import asyncio
+import random
+import threading
+from loguru import logger
+
+# defined in `misc`, whose `http_retryer` catches it
+from .misc import get_proxy, NoProxyError
+
+# the statuses blamed on the proxy rather than on the tile server
+PROXY_ERROR_STATUSES = (403, 407, 429, 502, 503, 504)
+_MANAGERS = {}
+_MANAGERS_LOCK = threading.Lock()
+
+
+class ProxyStats():
+    """Outcomes of the requests sent through one proxy."""
+
+    def __init__(self, url):
+        self.url = url
+        self.ok = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+
+
+    @property
+    def success_rate(self):
+        # Laplace smoothing, new proxies start at .5
+        return (self.ok + 1) / (self.ok + self.failures + 2)
+
+
+    def score(self, latency_ref=1.):
+        latency = self.latency if self.latency is not None else latency_ref
+        return self.success_rate / (1 + latency / latency_ref)
+
+
+    def to_dict(self):
+        return {
+            "ok": self.ok,
+            "failures": self.failures,
+            "success_rate": round(self.success_rate, 3),
+            "latency": self.latency,
+        }
+
+
+class ProxyManager():
+    """Pool of proxies prefetched from a `proxy_pool` api and scored by health.
+
+    A daemon thread keeps at least `min_size` proxies in the pool, so fetching a
+    tile never waits for the api. Each request picks a proxy at random weighted
+    by its score (smoothed success rate over latency) and reports its outcome;
+    a proxy failing `max_failures` times in a row, or whose success rate drops
+    below `min_success_rate` after `min_samples` requests, is evicted for
+    `cooldown` seconds and then re-admitted with fresh stats.
+
+    The requests never leave without a proxy unless `allow_direct`: when the
+    pool is empty, `get` waits `timeout` seconds for one and raises
+    `NoProxyError` otherwise, which the fetchers retry as a transient error.
+
+    Args:
+        api (str): the url returning one proxy (`host:port`) per call.
+        min_size (int, optional): the pool size triggering a refill. Defaults to 8.
+        max_size (int, optional): the pool size the refill stops at. Defaults to 32.
+        max_failures (int, optional): consecutive failures evicting a proxy. Defaults to 3.
+        min_success_rate (float, optional): Defaults to .5.
+        min_samples (int, optional): requests before `min_success_rate` applies. Defaults to 10.
+        interval (float, optional): seconds between two refills when the api fails
+            or returns known proxies. Defaults to 1.
+        timeout (float, optional): seconds `get` waits for a proxy when the pool is empty. Defaults to 10.
+        cooldown (float, optional): seconds before an evicted proxy is re-admitted, None for never. Defaults to 300.
+        allow_direct (bool, optional): send the request without a proxy when the pool stays
+            empty, exposing the ip of the crawler. Defaults to False.
+
+    Example:
+        >>> proxies = ProxyManager("http://127.0.0.1:5010/get")
+        >>> tm = TileMap(proxy_pool_api=proxies)
+        >>> proxies.stats()
+    """
+
+    def __init__(self, api, min_size=8, max_size=32, max_failures=3, min_success_rate=.5, min_samples=10, interval=1.,
+                 timeout=10., cooldown=300., allow_direct=False):
+        assert min_size <= max_size, "Check `min_size` <= `max_size`."
+        self.api = api
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_failures = max_failures
+        self.min_success_rate = min_success_rate
+        self.min_samples = min_samples
+        self.interval = interval
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.allow_direct = allow_direct
+
+        self.pool = {}
+        # url -> the time of the eviction
+        self.evicted = {}
+        self.counts = {"fetched": 0, "evicted": 0, "readmitted": 0, "requests": 0, "direct": 0, "unavailable": 0}
+        self._latency_ref = 1.
+        self._init_sync()
+
+
+    def _init_sync(self):
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._ready = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+
+    def __getstate__(self):
+        # every process prefetches its own proxies
+        state = self.__dict__.copy()
+        for key in ["_lock", "_refill", "_ready", "_closed", "_thread", "_pid"]:
+            state.pop(key)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_sync()
+
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._prefetch, name="tilemap-proxy", daemon=True)
+                self._thread.start()
+
+
+    def _prefetch(self):
+        while not self._closed:
+            if len(self.pool) < self.min_size and self.evicted:
+                with self._lock:
+                    self._readmit()
+            if len(self.pool) >= self.min_size:
+                self._refill.wait(self.interval * 10)
+                self._refill.clear()
+                continue
+
+            while not self._closed and len(self.pool) < self.max_size:
+                proxy = get_proxy(self.api)
+                url = None if proxy is None else proxy['http'].strip()
+                if not url:
+                    logger.debug(f"Proxy api {self.api} returned nothing.")
+                    break
+                url = url if '://' in url else f"http://{url}"
+                with self._lock:
+                    if url in self.pool or url in self.evicted:
+                        break
+                    self.pool[url] = ProxyStats(url)
+                    self.counts["fetched"] += 1
+                    self._ready.notify_all()
+            else:
+                continue
+            time.sleep(self.interval)
+
+
+    def _readmit(self):
+        # under the lock, the proxies evicted `cooldown` seconds ago start over
+        if self.cooldown is None:
+            return
+        now = time.monotonic()
+        for url, evicted_at in list(self.evicted.items()):
+            if now - evicted_at >= self.cooldown and len(self.pool) < self.max_size:
+                del self.evicted[url]
+                self.pool[url] = ProxyStats(url)
+                self.counts["readmitted"] += 1
+        self._ready.notify_all()
+
+
+    def _wake(self):
+        self._ensure_thread()
+        if len(self.pool) < self.min_size:
+            self._refill.set()
+
+
+    def get(self, timeout=None):
+        """Pick a proxy url, weighted by score.
+
+        Args:
+            timeout (float, optional): seconds to wait for a proxy when the pool
+                is empty. Defaults to None, i.e. `self.timeout`.
+
+        Returns:
+            str: the proxy url, None for a direct connection (only with `allow_direct`).
+
+        Raises:
+            NoProxyError: when the pool is still empty after `timeout`.
+        """
+        self._wake()
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            if not self.pool and timeout:
+                self._ready.wait_for(lambda: len(self.pool) > 0, timeout)
+            return self._pick()
+
+
+    async def get_async(self, timeout=None):
+        """`get` from a coroutine, waiting for a proxy without blocking the loop."""
+        self._wake()
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while not self.pool and time.monotonic() < deadline:
+            await asyncio.sleep(.05)
+        with self._lock:
+            return self._pick()
+
+
+    def _pick(self):
+        # under the lock
+        self.counts["requests"] += 1
+        if not self.pool:
+            if not self.allow_direct:
+                self.counts["unavailable"] += 1
+                raise NoProxyError(f"No proxy available from {self.api}.")
+            self.counts["direct"] += 1
+            return None
+        stats = list(self.pool.values())
+        weights = [i.score(self._latency_ref) for i in stats]
+
+        return random.choices(stats, weights)[0].url
+
+
+    def report(self, url, status=None, latency=None, error=None):
+        """Feed the outcome of a request sent through the proxy `url` back into the pool."""
+        if url is None:
+            return
+
+        failed = error is not None or status in PROXY_ERROR_STATUSES
+        with self._lock:
+            stats = self.pool.get(url)
+            if stats is None:
+                return
+            if failed:
+                stats.failures += 1
+                stats.consecutive_failures += 1
+            else:
+                stats.ok += 1
+                stats.consecutive_failures = 0
+                if latency is not None:
+                    stats.latency = latency if stats.latency is None else .8 * stats.latency + .2 * latency
+                    self._latency_ref = .99 * self._latency_ref + .01 * latency
+
+            n = stats.ok + stats.failures
+            if stats.consecutive_failures >= self.max_failures or \
+               (n >= self.min_samples and stats.ok / n < self.min_success_rate):
+                self._evict(url)
+
+
+    def _evict(self, url):
+        stats = self.pool.pop(url)
+        self.evicted[url] = time.monotonic()
+        self.counts["evicted"] += 1
+        logger.debug(f"Evict proxy {url}: {stats.to_dict()}")
+        if len(self.pool) < self.min_size:
+            self._refill.set()
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self.pool),
+                **self.counts,
+                "proxies": {url: i.to_dict() for url, i in self.pool.items()},
+            }
+
+
+    def close(self):
+        self._closed = True
+        self._refill.set()
+
+
+def get_proxy_manager(api, **kwargs):
+    """The `ProxyManager` shared by every `TileMap` using the proxy api `api`.
+
+    `kwargs` only take effect when the manager of the api is created.
+    """
+    manager = _MANAGERS.get(api)
+    if manager is None:
+        with _MANAGERS_LOCK:
+            manager = _MANAGERS.setdefault(api, ProxyManager(api, **kwargs))
+
+    return manager
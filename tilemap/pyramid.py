@@ -0,0 +1,149 @@
+import io
+import numpy as np
+import mercantile as mt
+from PIL import Image
+from loguru import logger
+
+from .parallel import parallel_process
+
+
+def downsample(children, flip=False):
+    """Merge the 2 x 2 children of a tile and halve the resolution.
+
+    Each parent pixel is the alpha weighted mean of a 2 x 2 block, so the
+    transparent pixels (e.g. a missing child) do not bleed into the others.
+
+    Args:
+        children (dict): {(dx, dy): RGBA array}, the child (2x + dx, 2y + dy).
+        flip (bool, optional): the rows grow northward, i.e. the Baidu grid. Defaults to False.
+
+    Returns:
+        np.ndarray: the RGBA array of the parent, the shape of a child.
+    """
+    h, w, _ = next(iter(children.values())).shape
+    mosaic = np.zeros((2 * h, 2 * w, 4), dtype=np.float32)
+    for (dx, dy), arr in children.items():
+        row = 1 - dy if flip else dy
+        mosaic[row * h: (row + 1) * h, dx * w: (dx + 1) * w] = arr
+
+    blocks = mosaic.reshape(h, 2, w, 2, 4)
+    alpha = blocks[..., 3:].sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3)) / np.maximum(alpha, 1)
+    parent = np.concatenate([rgb, alpha / 4], axis=-1)
+
+    return np.round(parent).astype(np.uint8)
+
+
+def upsample(array, tile, zoom, flip=False):
+    """Crop the part of the ancestor `array` (at `zoom`) covered by `tile`, and scale it up to a tile.
+
+    Args:
+        array (np.ndarray): the RGBA array of the ancestor of `tile` at `zoom`.
+        tile (mt.Tile): the tile to synthesize, `tile.z` > `zoom`.
+        zoom (int): the zoom level of the ancestor.
+        flip (bool, optional): the rows grow northward, i.e. the Baidu grid. Defaults to False.
+
+    Returns:
+        np.ndarray: the RGBA array of `tile`, the shape of `array`.
+    """
+    n = 1 << (tile.z - zoom)
+    h, w = array.shape[:2]
+    assert n <= min(h, w), f"Check {tile} is within {int(np.log2(min(h, w)))} levels of zoom {zoom}."
+
+    sh, sw = h // n, w // n
+    col, row = tile.x % n, tile.y % n
+    if flip:
+        row = n - 1 - row
+    crop = array[row * sh: (row + 1) * sh, col * sw: (col + 1) * sw]
+
+    return np.asarray(Image.fromarray(np.ascontiguousarray(crop)).resize((w, h), Image.BILINEAR))
+
+
+def encode_png(array, compress_level=6):
+    with io.BytesIO() as stream:
+        Image.fromarray(array, "RGBA").save(stream, "PNG", compress_level=compress_level)
+        return stream.getvalue()
+
+
+def _build_tiles(tilemap, parents):
+    """Build `parents` from the cached children, return [(tile, png bytes), ...]."""
+    flip = tilemap.tile_coord_sys == 'bd'
+    res = []
+    for tile in parents:
+        children = {}
+        for dx in (0, 1):
+            for dy in (0, 1):
+                content = tilemap.cache.get(mt.Tile(2 * tile.x + dx, 2 * tile.y + dy, tile.z + 1))
+                if content is not None:
+                    children[(dx, dy)] = tilemap._decode(content)
+        if children:
+            res.append((tile, encode_png(downsample(children, flip))))
+
+    return res
+
+
+def build_pyramid(tilemap, zoom, min_zoom=0, bounds=None, n_jobs=-1, overwrite=False, chunk_size=64, batch_size=4096):
+    """Build the zoom levels `zoom - 1` ... `min_zoom` from the cached tiles of `zoom`.
+
+    The parents are written into the cache of `tilemap` as PNG, level by level,
+    so each level is built from the one just written. Both the XYZ grid and the
+    Baidu grid (rows growing northward) are supported, as their children are
+    indexed alike, (2x + dx, 2y + dy).
+
+    Args:
+        tilemap (TileMap): the provider and the cache.
+        zoom (int): the source zoom level, e.g. a complete z18 crawl.
+        min_zoom (int, optional): the last zoom level to build. Defaults to 0.
+        bounds (tuple, optional): (west, south, east, north) in wgs, only the tiles
+            within are used; the whole cached level if None.
+        n_jobs (int, optional): the number of processes. Defaults to -1.
+        overwrite (bool, optional): rebuild the parents already cached. Defaults to False.
+        chunk_size (int, optional): the number of parents per task. Defaults to 64.
+        batch_size (int, optional): the number of parents in memory at once. Defaults to 4096.
+
+    Returns:
+        dict: the number of tiles built at each zoom level.
+
+    Example:
+        >>> tm = TileMap(providers.Amap.Satellite)
+        >>> tm.fetch_tiles(*bounds, zoom=18)
+        >>> build_pyramid(tm, 18, 10)
+    """
+    assert min_zoom < zoom, "Check `min_zoom` < `zoom`."
+    cache = tilemap.cache
+    children = set(cache.tiles(zoom))
+    if bounds is not None:
+        from .job import tile_range
+        w, s, e, n = bounds
+        if tilemap.tile_coord_sys in ['gcj', 'bd']:
+            w, s = tilemap.from_wgs(w, s)
+            e, n = tilemap.from_wgs(e, n)
+        x0, y0, x1, y1 = tile_range(w, s, e, n, zoom, tilemap.tile_coord_sys)
+        children = {t for t in children if x0 <= t.x <= x1 and y0 <= t.y <= y1}
+    logger.info(f"Build the pyramid of {tilemap.provider.name} from {len(children)} tiles at z{zoom}.")
+
+    counts = {}
+    for z in range(zoom - 1, min_zoom - 1, -1):
+        parents = sorted({mt.Tile(t.x // 2, t.y // 2, z) for t in children})
+        todo = parents if overwrite else [t for t in parents if not cache.exists(t)]
+
+        counts[z] = 0
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i: i + batch_size]
+            chunks = [batch[j: j + chunk_size] for j in range(0, len(batch), chunk_size)]
+            if n_jobs == 1:
+                res = [_build_tiles(tilemap, chunk) for chunk in chunks]
+            else:
+                res = parallel_process(
+                    _build_tiles, [(tilemap, chunk) for chunk in chunks], desc=f"Building z{z}", n_jobs=n_jobs)
+
+            for tile, content in (item for chunk in res for item in chunk):
+                cache.put(tile, content)
+                if tilemap.arrays is not None:
+                    tilemap.arrays.pop(tile)
+                counts[z] += 1
+        cache.flush()
+        logger.debug(f"z{z}: built {counts[z]} / {len(parents)} tiles.")
+        children = parents
+
+    return counts
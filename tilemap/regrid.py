@@ -0,0 +1,233 @@
+import numpy as np
+import mercantile as mt
+from loguru import logger
+
+from .cache import TileCache, DirectoryCache
+from .parallel import parallel_process
+from .pyramid import encode_png
+from .geofence import TRANSFORMS, xyz_bounds_np, bd_bounds_np
+from .coordtransform import wgs84_to_gcj02_np, wgs84_to_bd09_np
+
+TILE_SIZE = 256
+
+
+def src_zoom_of(z, sys):
+    """The zoom level of the source tiles re-gridded into the XYZ tiles at `z`.
+
+    A Baidu pixel at z is 2 ** (18 - z) mercator meters, while a Web Mercator
+    pixel is 156543 / 2 ** z; one level deeper keeps the resolution.
+    """
+    return z + 1 if sys == 'bd' else z
+
+
+def _xyz_lnglat(px, py, z):
+    """The lon/lat of the global pixel coordinates of the XYZ grid."""
+    n = 2. ** z * TILE_SIZE
+    lng = px / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * py / n))))
+
+    return lng, lat
+
+
+def _src_pixels(lng, lat, sys, z):
+    """The global pixel coordinates of wgs `lng`/`lat` in the tile grid of `sys`;
+    the rows of the Baidu grid grow northward."""
+    if sys == 'bd':
+        from .coordtransform.coordTransform_bd import bd_coord_to_mc_np
+        mx, my = bd_coord_to_mc_np(*wgs84_to_bd09_np(lng, lat))
+        res = 2. ** (18 - z)
+        return mx / res, my / res
+
+    lng, lat = wgs84_to_gcj02_np(lng, lat)
+    n = 2. ** z * TILE_SIZE
+    px = (lng + 180.0) / 360.0 * n
+    py = (1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n
+
+    return px, py
+
+
+def _interp_grid(grid, step, h, w):
+    """Bilinear interpolation of the control `grid` (one point every `step` pixels)
+    at the centers of the `h` x `w` pixels."""
+    u = (np.arange(w) + .5) / step
+    v = (np.arange(h) + .5) / step
+    i = np.minimum(u.astype(np.int64), grid.shape[1] - 2)
+    j = np.minimum(v.astype(np.int64), grid.shape[0] - 2)
+    a, b = (u - i)[None, :], (v - j)[:, None]
+
+    cols = grid[:, i] * (1 - a) + grid[:, i + 1] * a
+    return cols[j] * (1 - b) + cols[j + 1] * b
+
+
+def _bilinear(mosaic, x, y):
+    """Sample the RGBA `mosaic` at the (x, y) pixel positions, alpha premultiplied;
+    the positions out of the mosaic are transparent."""
+    h, w = mosaic.shape[:2]
+    inside = (x > -1) & (x < w) & (y > -1) & (y < h)
+    x = np.clip(x, 0, w - 1)
+    y = np.clip(y, 0, h - 1)
+    x0 = np.minimum(x.astype(np.int64), w - 2)
+    y0 = np.minimum(y.astype(np.int64), h - 2)
+    a = (x - x0)[..., None].astype(np.float32)
+    b = (y - y0)[..., None].astype(np.float32)
+
+    src = mosaic.astype(np.float32)
+    src[..., :3] *= src[..., 3:] / 255
+    res = (src[y0, x0] * (1 - a) + src[y0, x0 + 1] * a) * (1 - b) + \
+          (src[y0 + 1, x0] * (1 - a) + src[y0 + 1, x0 + 1] * a) * b
+    res[..., :3] *= 255 / np.maximum(res[..., 3:], 1e-6)
+    res[~inside] = 0
+
+    return np.round(np.clip(res, 0, 255)).astype(np.uint8)
+
+
+def _regrid_block(tilemap, tiles, src_zoom, step=16):
+    """Re-grid the XYZ `tiles` (one block, same zoom) from the cached tiles of `tilemap`.
+
+    Each source tile is decoded once per block, into a mosaic covering the block.
+
+    Returns:
+        list: [(tile, png bytes), ...], the tiles without any source pixel are skipped.
+    """
+    sys = tilemap.tile_coord_sys
+    z = tiles[0].z
+    x0, y0 = min(t.x for t in tiles), min(t.y for t in tiles)
+    nx, ny = max(t.x for t in tiles) - x0 + 1, max(t.y for t in tiles) - y0 + 1
+    h, w = ny * TILE_SIZE, nx * TILE_SIZE
+
+    # the source pixel of every output pixel, from a coarse grid of control points
+    cols = x0 * TILE_SIZE + np.arange(0, w + step, step, dtype=np.float64)
+    rows = y0 * TILE_SIZE + np.arange(0, h + step, step, dtype=np.float64)
+    sx, sy = _src_pixels(*_xyz_lnglat(*np.meshgrid(cols, rows), z), sys, src_zoom)
+    sx, sy = _interp_grid(sx, step, h, w), _interp_grid(sy, step, h, w)
+
+    # the mosaic of the source tiles covering the block
+    tx0, tx1 = int(np.floor(sx.min() / TILE_SIZE)), int(np.floor(sx.max() / TILE_SIZE))
+    ty0, ty1 = int(np.floor(sy.min() / TILE_SIZE)), int(np.floor(sy.max() / TILE_SIZE))
+    mosaic = np.zeros(((ty1 - ty0 + 1) * TILE_SIZE, (tx1 - tx0 + 1) * TILE_SIZE, 4), dtype=np.uint8)
+    found = False
+    for tx in range(tx0, tx1 + 1):
+        for ty in range(ty0, ty1 + 1):
+            content = tilemap.cache.get(mt.Tile(tx, ty, src_zoom))
+            if content is None:
+                continue
+            arr = tilemap._decode(content)
+            if arr.shape[:2] != (TILE_SIZE, TILE_SIZE):
+                continue
+            row = ty1 - ty if sys == 'bd' else ty - ty0
+            mosaic[row * TILE_SIZE: (row + 1) * TILE_SIZE, (tx - tx0) * TILE_SIZE: (tx - tx0 + 1) * TILE_SIZE] = arr
+            found = True
+    if not found:
+        return []
+
+    mx = sx - tx0 * TILE_SIZE - .5
+    my = (ty1 + 1) * TILE_SIZE - sy - .5 if sys == 'bd' else sy - ty0 * TILE_SIZE - .5
+    img = _bilinear(mosaic, mx, my)
+
+    res = []
+    for t in tiles:
+        r, c = (t.y - y0) * TILE_SIZE, (t.x - x0) * TILE_SIZE
+        arr = img[r: r + TILE_SIZE, c: c + TILE_SIZE]
+        if arr[..., 3].any():
+            res.append((t, encode_png(np.ascontiguousarray(arr))))
+
+    return res
+
+
+def _cached_extent_tiles(tilemap, z, src_zoom):
+    """The XYZ tiles at `z` overlapping the cached source tiles at `src_zoom`."""
+    sys = tilemap.tile_coord_sys
+    src = list(tilemap.cache.tiles(src_zoom))
+    if not src:
+        return []
+
+    xs = np.fromiter((t.x for t in src), dtype=np.int64, count=len(src))
+    ys = np.fromiter((t.y for t in src), dtype=np.int64, count=len(src))
+    bounds_func = bd_bounds_np if sys == 'bd' else xyz_bounds_np
+    west, south, east, north = bounds_func(xs, ys, src_zoom)
+    west, south = TRANSFORMS[(sys, 'wgs')](west, south)
+    east, north = TRANSFORMS[(sys, 'wgs')](east, north)
+
+    n = 2. ** z
+    def _xy(lng, lat):
+        x = np.floor((lng + 180.0) / 360.0 * n).astype(np.int64)
+        y = np.floor((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n).astype(np.int64)
+        return np.clip(x, 0, int(n) - 1), np.clip(y, 0, int(n) - 1)
+
+    x0, y0 = _xy(west, north)
+    x1, y1 = _xy(east, south)
+    tiles = set()
+    for a, b, c, d in zip(x0.tolist(), y0.tolist(), x1.tolist(), y1.tolist()):
+        for x in range(a, c + 1):
+            for y in range(b, d + 1):
+                tiles.add((x, y))
+
+    return [mt.Tile(x, y, z) for x, y in sorted(tiles)]
+
+
+def regrid(tilemap, dst, zooms, bounds=None, n_jobs=-1, overwrite=False, block_size=8, step=16, batch_size=64):
+    """Re-grid the cached gcj/bd tiles of `tilemap` into WGS84 aligned XYZ (Web Mercator) tiles.
+
+    The output tiles are processed in blocks of `block_size` x `block_size`; the
+    source pixel of every output pixel is interpolated from the wgs -> gcj/bd
+    transform of a control point every `step` pixels, and sampled bilinearly
+    from a mosaic of the source tiles of the block, so each source tile is
+    decoded once per block. The blocks run on a process pool.
+
+    Args:
+        tilemap (TileMap): the gcj (e.g. Amap) or bd (Baidu) provider and its cache.
+        dst (TileCache or str): the cache of the output tiles, a folder for a `DirectoryCache`.
+        zooms (int or list): the output zoom levels; Baidu tiles are read one level deeper, see `src_zoom_of`.
+        bounds (tuple, optional): (west, south, east, north) in wgs; the extent of the cached
+            source tiles if None.
+        n_jobs (int, optional): the number of processes. Defaults to -1.
+        overwrite (bool, optional): re-grid the tiles already in `dst`. Defaults to False.
+        block_size (int, optional): the output tiles per block side. Defaults to 8.
+        step (int, optional): pixels between two control points, 1 for an exact transform
+            of every pixel. Defaults to 16.
+        batch_size (int, optional): the number of blocks in memory at once. Defaults to 64.
+
+    Returns:
+        dict: the number of tiles written at each zoom level.
+
+    Example:
+        >>> tm = TileMap(providers.Amap.Satellite)
+        >>> regrid(tm, './tiles/Amap_wgs', zooms=[16, 17, 18])
+    """
+    sys = tilemap.tile_coord_sys
+    assert sys in ['gcj', 'bd'], f"Check the tiles of {tilemap.provider.name} are in gcj or bd, not {sys}."
+    assert TILE_SIZE % step == 0, f"Check `step` divides {TILE_SIZE}."
+    if not isinstance(dst, TileCache):
+        dst = DirectoryCache(dst)
+    if isinstance(zooms, int):
+        zooms = [zooms]
+
+    counts = {}
+    for z in zooms:
+        src_zoom = src_zoom_of(z, sys)
+        if bounds is not None:
+            tiles = list(mt.tiles(*bounds, [z]))
+        else:
+            tiles = _cached_extent_tiles(tilemap, z, src_zoom)
+        if not overwrite:
+            tiles = [t for t in tiles if not dst.exists(t)]
+
+        blocks = {}
+        for t in tiles:
+            blocks.setdefault((t.x // block_size, t.y // block_size), []).append(t)
+        blocks = [blocks[key] for key in sorted(blocks)]
+        logger.info(f"Re-grid {len(tiles)} tiles at z{z} from {sys} z{src_zoom}, {len(blocks)} blocks.")
+
+        counts[z] = 0
+        for i in range(0, len(blocks), batch_size):
+            params = [(tilemap, block, src_zoom, step) for block in blocks[i: i + batch_size]]
+            if n_jobs == 1:
+                res = [_regrid_block(*p) for p in params]
+            else:
+                res = parallel_process(_regrid_block, params, desc=f"Re-gridding z{z}", n_jobs=n_jobs)
+            for tile, content in (item for block in res for item in block):
+                dst.put(tile, content)
+                counts[z] += 1
+        dst.flush()
+
+    return counts
@@ -0,0 +1,227 @@
+"""
+Batch rendering of many small maps, e.g. the thumbnails of trips or stores.
+
+    >>> from tilemap.render import render_maps
+    >>> items = ((trip_gdf, f"./thumbs/{trip_id}.png") for trip_id, trip_gdf in trips.groupby('trip_id'))
+    >>> failed = render_maps(items, provider=providers.Amap.Normal, n_jobs=-1, dpi=100, color='red')
+"""
+import mercantile as mt
+from tqdm import tqdm
+from loguru import logger
+from multiprocessing import Pool, cpu_count
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from . import plotting
+from .job import DONE, _crawl_batch
+from .metrics import registry as metrics
+
+# the default `axes.xmargin` / `axes.ymargin` of matplotlib, padding the bounds of the data
+MARGIN = .05
+# the expander of the locators of matplotlib, widening the bounds without a width or height, e.g. a Point
+EXPANDER = .05
+
+
+def _bounds(geom):
+    """The (w, s, e, n) of a GeoDataFrame / GeoSeries or a shapely geometry."""
+    if hasattr(geom, "total_bounds"):
+        return tuple(geom.total_bounds)
+
+    return tuple(geom.bounds)
+
+
+def _to_geodata(geom):
+    if hasattr(geom, "plot"):
+        return geom
+    import geopandas as gpd
+
+    return gpd.GeoSeries([geom], crs=4326)
+
+
+def _nonsingular(vmin, vmax):
+    """Widen an empty interval as the autoscale of matplotlib does."""
+    if vmax - vmin > max(abs(vmin), abs(vmax)) * 1e-15:
+        return vmin, vmax
+    if vmin == 0:
+        return -EXPANDER, EXPANDER
+
+    return vmin - EXPANDER * abs(vmin), vmax + EXPANDER * abs(vmax)
+
+
+def _axis_bounds(w, s, e, n):
+    """The limits of the axes after plotting data within (w, s, e, n)."""
+    (w, e), (s, n) = _nonsingular(w, e), _nonsingular(s, n)
+    dx, dy = (e - w) * MARGIN, (n - s) * MARGIN
+
+    return w - dx, s - dy, e + dx, n + dy
+
+
+def render_maps(items, provider=None, zoom=plotting.ZOOM, cache_folder=None, figsize=(6, 6), dpi=300,
+                axis_off=True, attribution=False, tile_alpha=None, overzoom=False, prefetch=True,
+                wait=.5, max_retries=2, n_jobs=1, chunk_size=64, savefig_kwargs=None, **plot_kwargs):
+    """Render a map with a basemap for each of the `items`, as `plot_geodata(gdf, fn=path)` would.
+
+    The tiles of all the maps are resolved up front: the union of them is
+    fetched once into the cache (`prefetch`), and the maps are sorted by their
+    zoom and tile range, so the maps sharing tiles land in the same chunk and
+    reuse the basemap memoized by `add_basemap`. The chunks are rendered with
+    the Agg canvas across `n_jobs` processes, each reusing one figure per
+    `figsize` instead of creating a figure per map.
+
+    Args:
+        items (iterable): (geometry, path) pairs, the geometry being a GeoDataFrame,
+            a GeoSeries or a shapely geometry, in wgs84.
+        provider (TileProvider, optional): Defaults to None, i.e. `providers.Amap.Satellite`.
+        zoom (int or str, optional): Defaults to 'auto'.
+        cache_folder (str, optional): Defaults to None, i.e. `CACHE_FOLDER`.
+        figsize (tuple, optional): Defaults to (6, 6).
+        dpi (int, optional): Defaults to 300, as `plot_geodata`.
+        axis_off (bool, optional): Defaults to True.
+        attribution (str or bool, optional): Defaults to False.
+        tile_alpha (float, optional): the alpha of the basemap. Defaults to None.
+        overzoom (bool, optional): see `add_basemap`. Defaults to False.
+        prefetch (bool, optional): fetch the union of the tiles before rendering. Defaults to True.
+        wait (float, optional): the base of the backoff of the prefetch. Defaults to .5.
+        max_retries (int, optional): the retries of the prefetch. Defaults to 2.
+        n_jobs (int, optional): the number of worker processes, -1 for all the cores. Defaults to 1.
+        chunk_size (int, optional): the number of maps handed to a worker at once. Defaults to 64.
+        savefig_kwargs (dict, optional): Defaults to None, i.e. `bbox_inches='tight', pad_inches=.1`.
+        **plot_kwargs: passed to `gdf.plot`, e.g. color, alpha, linewidth.
+
+    Returns:
+        list: the (path, error) of the maps failed to render.
+    """
+    if provider is None:
+        provider = plotting.PROVIDERS.Amap.Satellite
+    tm = plotting._get_tilemap(provider, cache_folder)
+    items = [(geom, path) for geom, path in items]
+    if not items:
+        return []
+
+    # group the maps sharing tiles, the zoom and tile range key the memoized basemaps as well
+    keys, failed = {}, []
+    for i, (geom, path) in enumerate(items):
+        try:
+            w, s, e, n = _axis_bounds(*_bounds(geom))
+            keys[i] = tm.tile_range(w, s, e, n, zoom=zoom, ll=True, overzoom=overzoom)
+        except Exception as e:
+            failed.append((path, repr(e)))
+    order = sorted(keys, key=keys.get)
+
+    if prefetch:
+        _prefetch(tm, set(keys.values()), wait, max_retries)
+
+    opts = dict(zoom=zoom, figsize=figsize, dpi=dpi, axis_off=axis_off, attribution=attribution,
+                tile_alpha=tile_alpha, overzoom=overzoom, plot_kwargs=plot_kwargs,
+                savefig_kwargs={"bbox_inches": "tight", "pad_inches": .1} if savefig_kwargs is None else savefig_kwargs)
+    chunks = ([items[i] for i in order[j: j + chunk_size]] for j in range(0, len(order), chunk_size))
+
+    pool = None
+    if n_jobs == 1:
+        _init_worker(provider, cache_folder, opts, fork=False)
+        results = (_render_chunk(chunk) for chunk in chunks)
+    else:
+        pool = Pool(cpu_count() if n_jobs == -1 else n_jobs, _init_worker, (provider, cache_folder, opts))
+        results = pool.imap_unordered(_render_chunk, chunks)
+
+    pbar = tqdm(total=len(order), desc=f"Rendering {provider.name}")
+    try:
+        for n, errors, worker_metrics in results:
+            failed.extend(errors)
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            pbar.update(n)
+    finally:
+        pbar.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _WORKER.clear()
+        metrics.flush(final=True)
+
+    if failed:
+        path, err = failed[0]
+        logger.warning(f"{len(failed)} maps failed to render, e.g. {path}: {err}")
+
+    return failed
+
+
+def _prefetch(tm, keys, wait=.5, max_retries=2, batch_size=1024):
+    """Fetch the union of the tiles of the (zoom, tile range) `keys` into the cache."""
+    max_zoom = tm.provider.get("max_zoom")
+    tiles = set()
+    for z, (x0, y0, x1, y1) in keys:
+        # the overzoomed levels are cut from `max_zoom` by the renderers
+        if max_zoom is not None and z > max_zoom:
+            continue
+        tiles.update(mt.Tile(x, y, z) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+    tiles = sorted(tiles, key=lambda t: (t.z, t.x, t.y))
+
+    policy = tm.retry_policy(backoff=wait, max_retries=max_retries)
+    n_failed = 0
+    for i in tqdm(range(0, len(tiles), batch_size), desc=f"Prefetching {len(tiles)} tiles"):
+        states = _crawl_batch(tm, tiles[i: i + batch_size], policy)
+        n_failed += int((states != DONE).sum())
+    if n_failed:
+        logger.warning(f"Prefetch: {n_failed} of {len(tiles)} tiles failed, retried while rendering.")
+
+    return len(tiles) - n_failed
+
+
+_WORKER = {}
+
+
+def _init_worker(provider, cache_folder, opts, fork=True):
+    if fork:
+        # the fetchers and the thread pools of the parent do not survive the fork
+        plotting._TILEMAPS.clear()
+        plotting._MOSAICS.clear()
+        metrics.reset()
+        metrics.sinks = []
+    _WORKER.update(provider=provider, cache_folder=cache_folder, opts=opts, figures={}, fork=fork)
+
+
+def _get_axes(figsize):
+    """The figure of `figsize`, reused by the maps of the worker."""
+    figures = _WORKER["figures"]
+    if figsize not in figures:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        figures[figsize] = fig, fig.add_subplot(1, 1, 1)
+
+    return figures[figsize]
+
+
+def _render(geom, path):
+    opts = _WORKER["opts"]
+    fig, ax = _get_axes(opts["figsize"])
+    ax.clear()
+
+    _to_geodata(geom).plot(ax=ax, **opts["plot_kwargs"])
+    extra_imshow_args = {} if opts["tile_alpha"] is None else {"alpha": opts["tile_alpha"]}
+    plotting.add_basemap(ax, zoom=opts["zoom"], provider=_WORKER["provider"], attribution=opts["attribution"],
+                         cache_folder=_WORKER["cache_folder"], overzoom=opts["overzoom"], **extra_imshow_args)
+
+    # 去除科学记数法
+    ax.get_xaxis().get_major_formatter().set_useOffset(False)
+    ax.get_yaxis().get_major_formatter().set_useOffset(False)
+    if opts["axis_off"]:
+        ax.set_axis_off()
+    else:
+        ax.set_axis_on()
+
+    fig.savefig(path, dpi=opts["dpi"], **opts["savefig_kwargs"])
+
+
+def _render_chunk(chunk):
+    errors = []
+    for geom, path in chunk:
+        try:
+            with metrics.timer("render_seconds"):
+                _render(geom, path)
+        except Exception as e:
+            errors.append((path, repr(e)))
+
+    # the metrics of the chunk, merged into the registry of the parent
+    return len(chunk), errors, metrics.collect(reset=True) if _WORKER["fork"] else None
@@ -0,0 +1,213 @@
+import time
+import asyncio
+import hashlib
+import mercantile as mt
+from aiohttp import web
+from loguru import logger
+
+from .tile import TileMap
+from .fetcher import get_loop
+from .misc import TileFetchError
+from .throttle import throttle_stats
+from .metrics import registry as metrics
+from ._providers import providers as PROVIDERS, TileProvider
+
+MAX_AGE = 86400
+CONTENT_TYPES = [
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+]
+
+
+def find_provider(name, bunch=PROVIDERS):
+    """The provider of `providers` named `name`, e.g. 'Amap.Satellite'."""
+    for item in bunch.values():
+        if isinstance(item, TileProvider):
+            if item.get('name') == name:
+                return item
+        elif isinstance(item, dict):
+            provider = find_provider(name, item)
+            if provider is not None:
+                return provider
+
+    return None
+
+
+def _content_type(content):
+    for magic, content_type in CONTENT_TYPES:
+        if content.startswith(magic):
+            return content_type
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+
+    return "application/octet-stream"
+
+
+class TileServer():
+    """XYZ tile server backed by the `TileMap` caches.
+
+    `GET /{provider}/{z}/{x}/{y}` (with an optional extension, e.g. `.png`)
+    serves the cached tile, or fetches it from upstream through the `TileMap`
+    on a miss; the concurrent requests of the same missing tile share a single
+    upstream request. The server runs on the event loop of the fetchers
+    (`fetcher.get_loop`), so every front end shares one warm cache, the
+    keep-alive sessions and the per-host rate limits. `GET /stats` returns the
+    counters of the server, of the rate limiters and of `metrics.registry`.
+
+    Args:
+        tilemaps (list, optional): the `TileMap` instances served, keyed by provider name;
+            the other providers of `providers` are served by instances created on first use.
+        max_age (int, optional): the `Cache-Control` max-age in seconds. Defaults to MAX_AGE.
+        wait (float, optional): the base of the backoff of the upstream retries. Defaults to .5.
+        max_retries (int, optional): the upstream retries of each tile. Defaults to 2.
+        **kwargs: the arguments of the `TileMap` created on first use, e.g. `cache_folder`.
+
+    Example:
+        >>> TileServer(cache_folder='./tiles').run(port=8080)
+        >>> # http://127.0.0.1:8080/Amap.Satellite/16/53509/28540.png
+    """
+
+    def __init__(self, tilemaps=None, max_age=MAX_AGE, wait=.5, max_retries=2, **kwargs):
+        self.tilemaps = {tm.provider.name: tm for tm in (tilemaps or [])}
+        self.max_age = max_age
+        self.wait = wait
+        self.max_retries = max_retries
+        self.kwargs = kwargs
+        self.counts = {"requests": 0, "hits": 0, "misses": 0, "shared": 0, "errors": 0}
+        self._inflight = {}
+        self._runner = None
+
+
+    def get_tilemap(self, name):
+        tm = self.tilemaps.get(name)
+        if tm is None:
+            provider = find_provider(name)
+            if provider is None:
+                return None
+            tm = self.tilemaps.setdefault(name, TileMap(provider, **self.kwargs))
+
+        return tm
+
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_get(r"/{provider}/{z:\d+}/{x:-?\d+}/{y:-?\d+}", self.handle_tile)
+        app.router.add_get(r"/{provider}/{z:\d+}/{x:-?\d+}/{y:-?\d+}.{ext:\w+}", self.handle_tile)
+
+        return app
+
+
+    async def handle_tile(self, request):
+        self.counts["requests"] += 1
+        info = request.match_info
+        tm = self.get_tilemap(info["provider"])
+        if tm is None:
+            raise web.HTTPNotFound(text=f"Unknown provider {info['provider']}.")
+
+        tile = mt.Tile(int(info["x"]), int(info["y"]), int(info["z"]))
+        if not tm.provider.get('min_zoom', 0) <= tile.z <= tm.provider.get('max_zoom', 30):
+            raise web.HTTPNotFound(text=f"Zoom {tile.z} is out of the range of {tm.provider.name}.")
+
+        content = await asyncio.get_running_loop().run_in_executor(None, tm.cache.get, tile)
+        if content is None:
+            content = await self._fetch(tm, tile)
+        else:
+            self.counts["hits"] += 1
+
+        return self._response(request, content)
+
+
+    async def handle_stats(self, request):
+        return web.json_response({
+            **self.counts,
+            "inflight": len(self._inflight),
+            "throttle": throttle_stats(),
+            "metrics": metrics.snapshot(),
+        })
+
+
+    async def _fetch(self, tm, tile):
+        key = (tm.provider.name, tile)
+        task = self._inflight.get(key)
+        if task is None:
+            self.counts["misses"] += 1
+            task = asyncio.ensure_future(self._fetch_upstream(tm, tile))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.counts["shared"] += 1
+
+        try:
+            # shielded, a client going away does not cancel the others waiting for the tile
+            return await asyncio.shield(task)
+        except TileFetchError as e:
+            if e.status == 404:
+                raise web.HTTPNotFound(text=str(e))
+            raise web.HTTPBadGateway(text=str(e))
+
+
+    async def _fetch_upstream(self, tm, tile):
+        url = tm._construct_tile_url(*tile)
+        policy = tm.retry_policy(backoff=self.wait, max_retries=self.max_retries)
+        try:
+            content = await tm.fetcher.fetch_one(url, policy, tm.proxies)
+            # decoded before caching, so that broken contents never reach the cache
+            await asyncio.get_running_loop().run_in_executor(None, tm._save_tile, tile, content)
+        except Exception as e:
+            self.counts["errors"] += 1
+            logger.warning(f"Fetch {tm.provider.name} {tile} failed: {e!r}")
+            if not isinstance(e, TileFetchError):
+                e = TileFetchError(f"Fetch {url} failed: {e!r}", url)
+            raise e
+
+        return content
+
+
+    def _response(self, request, content):
+        etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+        headers = {
+            "Cache-Control": f"public, max-age={self.max_age}",
+            "ETag": etag,
+            "Access-Control-Allow-Origin": "*",
+        }
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(body=content, content_type=_content_type(content), headers=headers)
+
+
+    async def start(self, host="127.0.0.1", port=8080):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Serving tiles on http://{host}:{port}")
+
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for tm in self.tilemaps.values():
+            tm.cache.flush()
+
+
+    def run(self, host="127.0.0.1", port=8080, block=True):
+        """Serve on the shared loop; block until interrupted (Ctrl+C), or return at once if not `block`."""
+        loop = get_loop()
+        asyncio.run_coroutine_threadsafe(self.start(host, port), loop).result()
+        if not block:
+            return self
+
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), get_loop()).result()
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+from loguru import logger
+
+RATE_LIMIT = 20
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+class HostLimiter():
+    """Token bucket and AIMD concurrency window of one host.
+
+    Every success adds `increase / window` to the window and `rate_step` to the
+    rate; a throttling signal (429, 5xx, connection reset, or a latency above
+    `latency_factor` times the baseline) multiplies both by `decrease`, at most
+    once per `cooldown` seconds. A `Retry-After` pauses the host.
+
+    Args:
+        rate (float, optional): the initial requests per second. Defaults to RATE_LIMIT.
+        concurrency (int, optional): the initial number of requests in flight. Defaults to 4.
+    """
+
+    def __init__(self, host, rate=RATE_LIMIT, concurrency=4, min_rate=.5, max_rate=None, min_concurrency=1,
+                 max_concurrency=64, increase=1., rate_step=.1, decrease=.5, latency_factor=4., cooldown=1.):
+        self.host = host
+        self.rate = rate
+        self.window = min(concurrency, max_concurrency)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.rate_step = rate_step
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+
+        self.inflight = 0
+        self.latency = None
+        self.counts = {"ok": 0, "throttled": 0, "errors": 0}
+        self._tokens = 1.
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+
+    def _try_acquire(self):
+        """Reserve a slot, return the seconds to wait before sending, or None if the window is full."""
+        with self._lock:
+            if self.inflight >= int(self.window):
+                return None
+            now = time.monotonic()
+            self._tokens = min(max(self.rate, 1.), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            self.inflight += 1
+            delay = max(0., -self._tokens / self.rate, self._paused_until - now)
+
+        return delay
+
+
+    def _cancel(self):
+        # give back a slot reserved by a request never sent
+        with self._lock:
+            self.inflight -= 1
+
+
+    def acquire(self):
+        while True:
+            delay = self._try_acquire()
+            if delay is not None:
+                break
+            time.sleep(.01)
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            except BaseException:
+                self._cancel()
+                raise
+
+
+    async def acquire_async(self):
+        while True:
+            delay = self._try_acquire()
+            if delay is not None:
+                break
+            await asyncio.sleep(.01)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self._cancel()
+                raise
+
+
+    def release(self, status=None, latency=None, error=None, retry_after=None):
+        """Feed the outcome of a request back into the limiter.
+
+        Args:
+            status (int, optional): the http status code.
+            latency (float, optional): the seconds the request took.
+            error (Exception, optional): the connection error, if any.
+            retry_after (float, optional): the `Retry-After` of the response in seconds.
+        """
+        with self._lock:
+            self.inflight -= 1
+            throttled = error is not None or status == 429 or (status is not None and status >= 500)
+            if not throttled and latency is not None:
+                if self.latency is not None and latency > self.latency * self.latency_factor:
+                    throttled = True
+                else:
+                    self.latency = latency if self.latency is None else .9 * self.latency + .1 * latency
+
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+            if throttled:
+                self.counts["errors" if error is not None else "throttled"] += 1
+                self._decrease()
+            else:
+                self.counts["ok"] += 1
+                self.window = min(self.max_concurrency, self.window + self.increase / max(self.window, 1))
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.window = max(self.min_concurrency, self.window * self.decrease)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        logger.debug(f"Throttle {self.host}: rate {self.rate:.1f}/s, concurrency {self.window:.1f}")
+
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 2),
+            "concurrency": round(self.window, 2),
+            "inflight": self.inflight,
+            "latency": self.latency,
+            **self.counts,
+        }
+
+
+def get_host_limiter(url, **kwargs):
+    """The `HostLimiter` shared by every request to the host of `url`.
+
+    `kwargs` only take effect when the limiter of the host is created.
+    """
+    host = urlsplit(url).netloc
+    limiter = _LIMITERS.get(host)
+    if limiter is None:
+        with _LIMITERS_LOCK:
+            limiter = _LIMITERS.setdefault(host, HostLimiter(host, **kwargs))
+
+    return limiter
+
+
+def throttle_stats():
+    return {host: limiter.stats() for host, limiter in _LIMITERS.items()}
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -9,12 +9,20 @@ from PIL import Image
 import mercantile as mt
 from pathlib import Path
 from loguru import logger
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 import matplotlib.pyplot as plt
 
 from contextily.tile import _sm2ll, _validate_zoom, _merge_tiles
 
 
-from .misc import get_proxy, http_retryer
+from .proxy import ProxyManager, get_proxy_manager
+from .misc import http_retryer, SessionPool, RetryPolicy, TileFetchError
+from .throttle import get_host_limiter, RATE_LIMIT
+from .metrics import registry as metrics
+from .mosaic import Mosaic
+from .vector import FeatureCollector, check_tile
+from .cache import TileCache, DirectoryCache, MBTilesCache, get_array_cache, content_digest, ARRAY_CACHE_BYTES
 from .parallel import parallel_process
 from ._providers import providers as PROVIDERS
 from .coordtransform import wgs84_to_gcj02, gcj02_to_wgs84
@@ -23,6 +31,10 @@ from .coordtransform import wgs84_to_bd09, bd09_to_wgs84
 
 logger.remove()
 CACHE_FOLDER = "/home/pcl/minio/tile"
+# the deepest zoom level synthesized from the tiles at `max_zoom`
+OVERZOOM_MAX_ZOOM = 22
+# the synthesized tiles are cheap to synthesize again, favour the speed of their PNG encoding
+OVERZOOM_COMPRESS_LEVEL = 1
 
 
 #%%
@@ -44,8 +56,16 @@ def set_tile_cache_floder(folder):
     CACHE_FOLDER = folder
 
 
+def _init_fetch_worker():
+    # the workers of `_fetch_tiles_process` count from zero, their sinks belong to the parent
+    metrics.reset()
+    metrics.sinks = []
+
+
 class TileMap():
-    def __init__(self, provider=None, cache_folder=CACHE_FOLDER, proxy_pool_api=None):
+    def __init__(self, provider=None, cache_folder=CACHE_FOLDER, proxy_pool_api=None, concurrency=64, limit_per_host=8, 
+                 timeout=(5, 30), keep_alive=30, cache="dir", array_cache_bytes=ARRAY_CACHE_BYTES,
+                 throttle=True, retry_policy=None, decode_workers=None, dedup=False):
         self.provider = provider
         if provider is None:
             self.provider = PROVIDERS.Amap.Satellite 
@@ -53,43 +73,298 @@ class TileMap():
         if cache_folder is None:
             cache_folder = CACHE_FOLDER
         self.cache_folder = Path(cache_folder) / self.provider.name
-        self.cache_folder.mkdir(exist_ok=True)
         
         self.logger = logger
         self.tile_coord_sys = self.provider.get('sys', 'wgs')
+        # vector tiles (MVT), kept encoded and decoded into features by `fetch_features`
+        self.vector = self.provider.get('format') == 'pbf'
+        self.cache = self._cfg_cache(cache, dedup)
+        # decoded tiles, shared by the instances of the same provider
+        self.arrays = None
+        if array_cache_bytes and not self.vector:
+            self.arrays = get_array_cache(self.provider.name, array_cache_bytes)
         self.proxy_pool_api = proxy_pool_api
+        # prefetched proxies scored by health, shared by the instances using the same api
+        self.proxies = None
+        if isinstance(proxy_pool_api, ProxyManager):
+            self.proxies = proxy_pool_api
+        elif proxy_pool_api is not None:
+            self.proxies = get_proxy_manager(proxy_pool_api)
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.sessions = SessionPool(limit_per_host, timeout, keep_alive)
+        # adaptive rate limit and concurrency of each host (subdomain), shared by all instances
+        self.throttle = None
+        if throttle:
+            self.throttle = {"rate": self.provider.get('rate_limit', RATE_LIMIT), "max_concurrency": limit_per_host}
+        # `wait` and `max_retries` of each call override its backoff and retries
+        self.retry_policy = retry_policy or RetryPolicy()
+        # the failures of the last call, a convenience copy: the instances are shared, see the `failed` arguments
+        self.failed_tiles = []
+        self._fetcher = None
+        # threads decoding the cached tiles, PIL releases the GIL while decoding
+        self.decode_workers = decode_workers or os.cpu_count() or 1
+        self._decoder = None
         
         assert self.tile_coord_sys in ['wgs', 'gcj', 'bd'], \
             f"Check {self.provider}'s tile coordination system is within ['wgs', 'gcj', 'bd']."
         self._cfg_transform_funs()
     
 
+    @property
+    def fetcher(self):
+        """The asyncio download engine, created on first use."""
+        if self._fetcher is None:
+            from .fetcher import AsyncFetcher
+            self._fetcher = AsyncFetcher(self.concurrency, self.limit_per_host, self.timeout, self.keep_alive, self.throttle)
+        
+        return self._fetcher
+
+
+    @property
+    def decoder(self):
+        """The thread pool decoding the cached tiles, created on first use."""
+        if self._decoder is None:
+            self._decoder = ThreadPoolExecutor(self.decode_workers, thread_name_prefix="tilemap-decode")
+        
+        return self._decoder
+
+
+    def close(self):
+        """Release the keep-alive http connections and the cache held by the instance."""
+        self.cache.close()
+        self.sessions.close()
+        if self._fetcher is not None:
+            self._fetcher.close()
+        if self._decoder is not None:
+            self._decoder.shutdown()
+            self._decoder = None
+
+
+    def __getstate__(self):
+        # the handlers of `set_logger` (enqueue) can not be pickled, the workers use their own logger
+        state = self.__dict__.copy()
+        state.pop("logger", None)
+        state["_decoder"] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logger
+
+
+    def _cfg_cache(self, cache, dedup=False):
+        if isinstance(cache, TileCache):
+            return cache
+        
+        assert cache in ['dir', 'mbtiles'], "Check cache is a `TileCache` or within ['dir', 'mbtiles']."
+        fmt = 'pbf' if self.vector else 'png'
+        if cache == 'mbtiles':
+            fn = self.cache_folder.parent / f"{self.provider.name}.mbtiles"
+            # 百度瓦片的编号不是 XYZ, 不做 TMS 翻转
+            return MBTilesCache(fn, self.provider.name, fmt=fmt, flip_y=self.tile_coord_sys != 'bd', dedup=dedup)
+        
+        return DirectoryCache(self.cache_folder, ext=fmt, dedup=dedup)
+
+
+    def _decode(self, content, channels="RGBA"):
+        if self.vector:
+            # only checked, the features are decoded by the consumer of the tile
+            return check_tile(content)
+
+        with metrics.timer("decode_seconds", provider=self.provider.name):
+            with io.BytesIO(content) as image_stream:
+                image = Image.open(image_stream)
+                # straight into the bands of the mosaic, without an RGBA temporary
+                image = image.convert(channels)
+                array = np.asarray(image)
+                image.close()
+        
+        return array[..., None] if array.ndim == 2 else array
+
+
+    def _array_key(self, tile:mt.Tile, content=None, channels="RGBA"):
+        # the decoded arrays of a dedup cache are keyed by the blob, shared by the duplicated tiles
+        key = content_digest(content) if self.cache.dedup else tile
+        return key if channels == "RGBA" else (key, channels)
+
+
+    def _load_tile(self, tile:mt.Tile, store=True, channels="RGBA"):
+        if self.arrays is not None and not self.cache.dedup:
+            array = self.arrays.get(self._array_key(tile, channels=channels))
+            if array is not None:
+                metrics.inc("cache_hits", provider=self.provider.name, layer="memory")
+                return array
+        
+        with metrics.timer("cache_read_seconds", provider=self.provider.name):
+            content = self.cache.get(tile)
+        if content is None:
+            metrics.inc("cache_misses", provider=self.provider.name)
+            return None
+
+        key = self._array_key(tile, content, channels)
+        if self.arrays is not None and self.cache.dedup:
+            array = self.arrays.get(key)
+            if array is not None:
+                metrics.inc("cache_hits", provider=self.provider.name, layer="memory")
+                return array
+
+        metrics.inc("cache_hits", provider=self.provider.name, layer="disk")
+        self.logger.trace(f"Using cache tile: {tile}")
+        array = self._decode(content, channels)
+        if self.arrays is not None and store:
+            self.arrays.put(key, array)
+        
+        return array
+
+
+    def _load_tiles(self, tiles, keep=None, store=True, channels="RGBA"):
+        """Read `tiles` from the caches, None for the tiles not cached.
+
+        The tiles are decoded on the `decoder` threads and the order of `tiles`
+        is kept; `keep(i, array)` maps the array of `tiles[i]`, e.g. writes it
+        into a mosaic from the decoding thread. The tiles are decoded into
+        `channels` and kept in `arrays` unless `store` is False.
+        """
+        def _load(i):
+            array = self._load_tile(tiles[i], store, channels)
+            if array is None or keep is None:
+                return array
+            return keep(i, array)
+
+        if self.decode_workers <= 1 or len(tiles) < 2:
+            return [_load(i) for i in range(len(tiles))]
+        
+        return list(self.decoder.map(_load, range(len(tiles))))
+
+
+    def _save_tile(self, tile:mt.Tile, content, store=True, channels="RGBA"):
+        key = self._array_key(tile, content, channels)
+        # decode before caching, so that broken contents never reach the cache
+        array = self.arrays.get(key) if self.arrays is not None and self.cache.dedup else None
+        if array is None:
+            array = self._decode(content, channels)
+        with metrics.timer("cache_write_seconds", provider=self.provider.name):
+            self.cache.put(tile, content)
+        metrics.inc("bytes_written", len(content), provider=self.provider.name)
+        if self.arrays is not None and store:
+            self.arrays.put(key, array)
+        
+        return array
+
+
     def _fetch_tile(self, tile:mt.Tile, wait=.5, max_retries=2):
         x, y, z = tile.x, tile.y, tile.z
         url = self._construct_tile_url(x, y, z)
         _validate_zoom(z, self.provider, auto='auto')
-        fn = self.cache_folder/ str(z) / str(x) / f"{y}.png"
         
-        if fn.exists():
-            self.logger.trace(f"Using cache file: {'/'.join(fn.parts[-4:])}")
-            array = np.array(Image.open(fn).convert("RGBA"))
+        array = self._load_tile(tile)
+        if array is not None:
             return tile, array
         
-        proxy = get_proxy(self.proxy_pool_api)
-        self.logger.debug(f"Fetching tile: {url}, {proxy}")
-        request = http_retryer(url, wait, max_retries, proxy)
-
-        fn.parent.mkdir(parents=True, exist_ok=True)
-        with io.BytesIO(request.content) as image_stream:
-            image = Image.open(image_stream)
-            image.save(fn)
-            image = image.convert("RGBA")
-            array = np.asarray(image)
-            image.close()
+        self.logger.debug(f"Fetching tile: {url}")
+        session = self.sessions.get(url, self.provider.name)
+        limiter = get_host_limiter(url, **self.throttle) if self.throttle is not None else None
+        request = http_retryer(url, wait, max_retries, None, session, self.timeout, limiter, self.retry_policy, self.proxies)
+        array = self._save_tile(tile, request.content)
+        self.cache.flush()
         
         return tile, array
 
 
+    def _try_fetch_tile(self, tile:mt.Tile, wait=.5, max_retries=2):
+        # isolate the failure of one tile from the others in `parallel_process`
+        try:
+            tile, array = self._fetch_tile(tile, wait, max_retries)
+        except Exception as e:
+            tile, array = tile, e
+
+        # the metrics of the worker, merged into the registry of the parent
+        return tile, array, metrics.collect(reset=True)
+
+
+    def _fetch_tiles(self, tiles, wait=.5, max_retries=2, pbar_switch=False, requeue=True, into=None, failed=None,
+                     store=True, channels="RGBA"):
+        """Fetch `tiles` with the asyncio engine, cached tiles are read from disk.
+
+        A failed tile does not abort the others: the retryable failures are queued
+        and fetched again once the batch is done, the tiles still failing are
+        appended to `failed` as (tile, error) and their arrays are None.
+
+        Args:
+            tiles (list): list of mercantile.Tile.
+            wait (float, optional): the base of the backoff between two attempts. Defaults to .5.
+            max_retries (int, optional): the retries allowed for each tile. Defaults to 2.
+            pbar_switch (bool, optional): show a progress bar. Defaults to False.
+            requeue (bool, optional): fetch the retryable failures again at the end. Defaults to True.
+            into (Function, optional): `into(i, array)` consumes the array of `tiles[i]` as soon as
+                it is decoded, e.g. `Mosaic.put`; the arrays are not returned then. Defaults to None.
+            failed (list, optional): collects the (tile, error) of the tiles failed in this call. Defaults to None.
+            store (bool, optional): keep the decoded arrays in the shared `arrays` LRU, so the next
+                calls skip the decoding; False bounds the memory of a streamed mosaic to the mosaic
+                itself, at the cost of decoding the tiles again next time. Defaults to True.
+            channels (str, optional): the bands the tiles are decoded into, 'RGBA', 'RGB' or 'L'. Defaults to 'RGBA'.
+
+        Returns:
+            list: the arrays, in the order of `tiles`; True for the tiles consumed by `into`.
+        """
+        if into is None:
+            keep = lambda i, arr: arr
+        else:
+            keep = lambda i, arr: into(i, arr) or True
+
+        arrays = self._load_tiles(tiles, keep, store, channels)
+        todo = [i for i, arr in enumerate(arrays) if arr is None]
+        self.logger.debug(f"{len(tiles) - len(todo)} tiles hit the cache, {len(todo)} to fetch.")
+
+        policy = self.retry_policy(backoff=wait, max_retries=max_retries)
+        errors = {}
+        for n_round in range(2 if requeue else 1):
+            if len(todo) == 0:
+                break
+            if n_round > 0:
+                self.logger.info(f"Requeue {len(todo)} failed tiles.")
+            
+            jobs = [(i, self._construct_tile_url(*tiles[i])) for i in todo]
+            res = self.fetcher.fetch(
+                jobs, 
+                lambda i, content: keep(i, self._save_tile(tiles[i], content, store, channels)), 
+                policy, 
+                self.proxies, 
+                pbar_switch and n_round == 0,
+                return_exceptions=True
+            )
+            todo = []
+            for (i, _), arr in zip(jobs, res):
+                if isinstance(arr, BaseException):
+                    errors[i] = arr
+                    if getattr(arr, "retryable", True):
+                        todo.append(i)
+                else:
+                    arrays[i] = arr
+        self.cache.flush()
+
+        self._report_failures(tiles, arrays, errors, failed)
+        metrics.flush(final=True)
+        
+        return arrays
+
+
+    def _report_failures(self, tiles, arrays, errors, failed=None):
+        res = [(tiles[i], errors[i]) for i in sorted(errors) if arrays[i] is None]
+        if res:
+            tile, err = res[0]
+            self.logger.warning(f"{len(res)} tiles failed, e.g. {tile}: {err}")
+        if failed is not None:
+            failed.extend(res)
+        self.failed_tiles = res
+
+        return res
+
+
     def fetch_tile_xyz(self, x, y, z, wait=.5, max_retries=2):
         tile = mt.Tile(x, y, z)
         return self._fetch_tile(tile, wait, max_retries)
@@ -100,11 +375,37 @@ class TileMap():
         return self._fetch_tile(tile, wait, max_retries)
 
 
-    def fetch_tiles(self, w, s, e, n, geofence=None, ll=True, zoom="auto", n_jobs=-1, wait=0.5, max_retries=2):
-        # TODO 增加 filter 机制 -> gpd.sjoin
-        if self.proxy_pool_api is None:
-            n_jobs = 1
+    def fetch_tiles(self, w=None, s=None, e=None, n=None, geofence=None, ll=True, zoom="auto", n_jobs=-1, wait=0.5, max_retries=2, 
+                    engine="async", geofence_sys="wgs", failed=None):
+        """Fetch the tiles of a bounding box, optionally only those intersecting `geofence`.
 
+        `geofence` is a shapely geometry, GeoSeries or GeoDataFrame in the `geofence_sys`
+        coordination system ('wgs', 'gcj' or 'bd'); its bounds are used when `w`, `s`, 
+        `e`, `n` are None. The (tile, error) of the failed tiles are appended to `failed`.
+        """
+        assert engine in ['async', 'process'], "Check engine is within ['async', 'process']."
+        tiles = self._bbox_tiles(w, s, e, n, geofence, zoom, geofence_sys)
+        
+        # download tiles
+        if engine == 'async':
+            arrays = self._fetch_tiles(tiles, wait, max_retries, pbar_switch=True, failed=failed)
+        else:
+            arrays = self._fetch_tiles_process(tiles, wait, max_retries, n_jobs, failed)
+
+        # partial results, the failed tiles are collected in `failed`
+        idxs = [i for i, arr in enumerate(arrays) if arr is not None]
+        return [tiles[i] for i in idxs], [arrays[i] for i in idxs]
+
+
+    def _bbox_tiles(self, w=None, s=None, e=None, n=None, geofence=None, zoom="auto", geofence_sys="wgs"):
+        """The tiles of a bounding box (wgs), optionally only those intersecting `geofence`."""
+        if geofence is not None:
+            from .geofence import to_geometry, transform_geometry
+            geofence = to_geometry(geofence)
+            if w is None:
+                w, s, e, n = transform_geometry(geofence, geofence_sys, 'wgs').bounds
+            geofence = transform_geometry(geofence, geofence_sys, self.tile_coord_sys)
+        
         if self.tile_coord_sys in ['gcj', 'bd']:
             w, s = self.from_wgs(w, s)
             e, n = self.from_wgs(e, n)
@@ -115,16 +416,89 @@ class TileMap():
             zoom = self._calculate_zoom(w, s, e, n)
         zoom = _validate_zoom(zoom, self.provider, auto=auto_zoom)
 
-        # download and merge tiles
-        tiles_lst = [(i, wait, max_retries) for i in self.iter_tiles(w, s, e, n, [zoom])]
-        res = parallel_process(self._fetch_tile, tiles_lst, pbar_switch=True, n_jobs=n_jobs)
-        tiles = [r[0] for r in res]
-        arrays = [r[1] for r in res]
+        tiles = list(self.iter_tiles(w, s, e, n, [zoom]))
+        if geofence is not None:
+            from .geofence import filter_tiles
+            tiles = filter_tiles(tiles, geofence, self.tile_coord_sys)
+        
+        return tiles
+
+
+    def fetch_features(self, w=None, s=None, e=None, n=None, geofence=None, zoom=None, layers=None, wait=.5, 
+                       max_retries=2, merge=True, geofence_sys="wgs", failed=None):
+        """Fetch the vector tiles of a bounding box and decode them into one GeoDataFrame per layer.
 
-        return tiles, arrays
+        The tiles are fetched concurrently into the cache, and each tile is decoded
+        as soon as it arrives or is read from the cache, so the contents are never
+        kept. The pieces of the features cut at the tile boundaries are merged, 
+        see `vector.merge_pieces`.
 
+        Args:
+            w, s, e, n (float, optional): the bounding box in wgs84, the bounds of `geofence` if None.
+            geofence (optional): only the tiles intersecting it, see `fetch_tiles`. Defaults to None.
+            zoom (int, optional): Defaults to None, i.e. the `max_zoom` of the provider, whose tiles 
+                carry all the features.
+            layers (list, optional): the names of the layers to decode, e.g. ['road', 'building'];
+                None for all. Defaults to None.
+            wait (float, optional): the base of the backoff between two attempts. Defaults to .5.
+            max_retries (int, optional): the retries allowed for each tile. Defaults to 2.
+            merge (bool, optional): merge the pieces of the features. Defaults to True.
+            geofence_sys (str, optional): Defaults to 'wgs'.
 
-    def bounds2img(self, w, s, e, n, zoom="auto", ll=True, wait=0, max_retries=2):
+        Returns:
+            dict: {layer: GeoDataFrame} in wgs84, with the column `feature_id`.
+
+        Example:
+            >>> tm = TileMap(providers.Mapbox.Streets(accessToken=token))
+            >>> gdfs = tm.fetch_features(113.90, 22.50, 114.00, 22.60, layers=['road', 'building'])
+            >>> gdfs['road'].plot()
+        """
+        assert self.vector, f"Check {self.provider.name} is a vector tile provider, i.e. format='pbf'."
+        assert self.tile_coord_sys in ['wgs', 'gcj'], "Check the vector tiles are on the XYZ grid."
+        if zoom is None:
+            zoom = self.provider.get('max_zoom')
+        tiles = self._bbox_tiles(w, s, e, n, geofence, zoom, geofence_sys)
+
+        collector = FeatureCollector(tiles, layers, self.tile_coord_sys)
+        self._fetch_tiles(tiles, wait, max_retries, pbar_switch=True, into=collector.put, failed=failed)
+        
+        return collector.to_geodataframes(merge)
+
+
+    def _fetch_tiles_process(self, tiles, wait=.5, max_retries=2, n_jobs=-1, failed=None):
+        """The multiprocessing counterpart of `_fetch_tiles`."""
+        if self.proxies is None:
+            n_jobs = 1
+        
+        arrays = [None] * len(tiles)
+        todo, errors = list(range(len(tiles))), {}
+        for n_round in range(2):
+            if len(todo) == 0:
+                break
+            if n_round > 0:
+                self.logger.info(f"Requeue {len(todo)} failed tiles.")
+
+            tiles_lst = [(tiles[i], wait, max_retries) for i in todo]
+            res = parallel_process(self._try_fetch_tile, tiles_lst, pbar_switch=n_round == 0, n_jobs=n_jobs,
+                                   initializer=_init_fetch_worker)
+            idxs, todo = todo, []
+            for i, (_, arr, worker_metrics) in zip(idxs, res):
+                metrics.merge(worker_metrics)
+                if isinstance(arr, BaseException):
+                    errors[i] = arr
+                    if getattr(arr, "retryable", True):
+                        todo.append(i)
+                else:
+                    arrays[i] = arr
+
+        self._report_failures(tiles, arrays, errors, failed)
+        metrics.flush(final=True)
+        
+        return arrays
+
+
+    def bounds2img(self, w, s, e, n, zoom="auto", ll=True, wait=0, max_retries=2, overzoom=False, channels="RGBA", failed=None,
+                   cache_arrays=True):
         """
         Take bounding box and zoom and return an image with all the tiles
         that compose the map and its Spherical Mercator extent.
@@ -166,14 +540,33 @@ class TileMap():
             URL for tile provider. The placeholders for the XYZ need to be
             `{x}`, `{y}`, `{z}`, respectively. IMPORTANT: tiles are
             assumed to be in the Spherical Mercator projection (EPSG:3857).
+        overzoom : Boolean
+            [Optional. Default: False] If True, the zoom levels beyond the
+            `max_zoom` of the provider (up to `OVERZOOM_MAX_ZOOM`) are allowed,
+            their tiles are cropped and upsampled from the tiles at `max_zoom`
+            and cached as well.
+        channels : str
+            [Optional. Default: 'RGBA'] The bands of the image, 'RGBA', 'RGB'
+            or 'L' (single band luma). The tiles are decoded straight into a
+            preallocated image of that layout, e.g. 'RGB' takes 3/4 of the
+            memory for satellite imagery.
+        failed : list
+            [Optional. Default: None] Collects the (tile, error) of the tiles
+            failed in this call, left transparent in the image.
+        cache_arrays : Boolean
+            [Optional. Default: True] Keep the decoded tiles in the shared
+            array cache (`arrays`) for the next calls. False keeps the peak
+            memory at about the image itself, but every call decodes the
+            cached tiles again.
 
         Returns
         -------
         img : ndarray
-            Image as a 3D array of RGB values
+            Image as a 3D array of shape (height, width, bands)
         extent : tuple
             Bounding box [minX, maxX, minY, maxY] of the returned image
         """
+        assert not self.vector, f"Check {self.provider.name} is a raster provider, see `fetch_features` for the vector tiles."
         if not ll:
             # Convert w, s, e, n into lon/lat
             w, s = _sm2ll(w, s)
@@ -184,7 +577,8 @@ class TileMap():
             w, s = self.from_wgs(w, s)
             e, n = self.from_wgs(e, n)
         
-        merged, extent = self._bounds2img_wgs(w, s, e, n, zoom, ll, wait, max_retries)
+        merged, extent = self._bounds2img_wgs(w, s, e, n, zoom, ll, wait, max_retries, overzoom, channels, failed,
+                                              cache_arrays)
 
         if ll and self.tile_coord_sys in ['gcj', 'bd']:
             west, east, south, north = extent
@@ -195,29 +589,54 @@ class TileMap():
         return merged, extent
         
         
-    def _bounds2img_wgs(self, w, s, e, n, zoom="auto", ll=False, wait=0.5, max_retries=2):
+    def tile_range(self, w, s, e, n, zoom="auto", ll=True, overzoom=False):
+        """The zoom level and the (xmin, ymin, xmax, ymax) indexes of the tiles of `bounds2img`,
+        without fetching them, e.g. to key the mosaics."""
+        from .job import tile_range
+
+        if not ll:
+            w, s = _sm2ll(w, s)
+            e, n = _sm2ll(e, n)
+        if self.tile_coord_sys in ['gcj', 'bd']:
+            w, s = self.from_wgs(w, s)
+            e, n = self.from_wgs(e, n)
+
+        auto_zoom = zoom == "auto"
+        if auto_zoom:
+            zoom = self._calculate_zoom(w, s, e, n, overzoom)
+        zoom = self._validate_zoom(zoom, auto_zoom, overzoom)
+
+        return zoom, tile_range(w, s, e, n, zoom, self.tile_coord_sys)
+
+
+    def _bounds2img_wgs(self, w, s, e, n, zoom="auto", ll=False, wait=0.5, max_retries=2, overzoom=False, channels="RGBA",
+                        failed=None, cache_arrays=True):
         # TODO 增加 抓取进度条的问题，通过日志体现
-        # TODO 多进程获取数据 
 
         # calculate and validate zoom level
         auto_zoom = zoom == "auto"
         if auto_zoom:
-            zoom = self._calculate_zoom(w, s, e, n)
-        zoom = _validate_zoom(zoom, self.provider, auto=auto_zoom)
+            zoom = self._calculate_zoom(w, s, e, n, overzoom)
+        zoom = self._validate_zoom(zoom, auto_zoom, overzoom)
 
         # download and merge tiles
-        tiles = []
-        arrays = []
-        # tiles_lst = list(self.tiles_func(w, s, e, n, [zoom]))
-        for t in self.iter_tiles(w, s, e, n, [zoom]):
-            _, image = self._fetch_tile(t, wait, max_retries)
-            
-            tiles.append(t)
-            arrays.append(image)
+        tiles = list(self.iter_tiles(w, s, e, n, [zoom]))
+        mosaic = Mosaic(tiles, self.tile_coord_sys == 'bd', channels)
+        def into(i, arr):
+            with metrics.timer("merge_seconds", provider=self.provider.name):
+                mosaic.put(i, arr)
 
-        merged, extent = self.merge_tile(tiles, arrays)
-        
-        west, south, east, north = extent
+        if zoom > self.provider.get('max_zoom', zoom):
+            for i, arr in enumerate(self._fetch_overzoom_tiles(tiles, wait, max_retries, failed, cache_arrays)):
+                if arr is not None:
+                    into(i, arr)
+        else:
+            self._fetch_tiles(tiles, wait, max_retries, into=into, failed=failed, store=cache_arrays, channels=channels)
+        if mosaic.image is None:
+            raise TileFetchError(f"None of the {len(tiles)} tiles was fetched.", retryable=False)
+
+        merged = mosaic.image
+        west, south, east, north = self._layout_bounds(mosaic.layout, zoom)
         if ll:
             extent = west, east, south, north
         else:
@@ -229,6 +648,251 @@ class TileMap():
         return merged, extent
 
 
+    def bounds2raster(self, w, s, e, n, path, zoom="auto", ll=True, wait=0, max_retries=2, block_size=16, driver="GTiff", overviews=True,
+                      failed=None):
+        """
+        Take bounding box and zoom, and write the tiles that compose the map
+        into a raster file on disk, block by block. The whole mosaic is never
+        held in memory, the peak memory is bounded by `block_size`.
+
+        Parameters
+        ----------
+        w : float
+            West edge
+        s : float
+            South edge
+        e : float
+            East edge
+        n : float
+            North edge
+        path : str
+            Path to the raster file to be written.
+        zoom : int
+            Level of detail
+        ll : Boolean
+            [Optional. Default: True] If True, `w`, `s`, `e`, `n` are
+            assumed to be lon/lat as opposed to Spherical Mercator.
+        wait : int
+            [Optional. Default: 0]
+            if the tile API is rate-limited, the number of seconds to wait
+            between a failed request and the next try
+        max_retries: int
+            [Optional. Default: 2]
+            total number of rejected requests allowed before contextily
+            will stop trying to fetch more tiles from a rate-limited API.
+        block_size : int
+            [Optional. Default: 16] The tiles are fetched and written in
+            blocks of `block_size` x `block_size` tiles.
+        driver : str
+            [Optional. Default: 'GTiff'] 'GTiff' writes a tiled, compressed
+            GeoTIFF in Spherical Mercator (EPSG:3857); 'npy' writes a memory
+            mapped `.npy` array of shape (height, width, 4).
+        overviews : Boolean
+            [Optional. Default: True] Build the overviews of the GeoTIFF.
+        failed : list
+            [Optional. Default: None] Collects the (tile, error) of the tiles
+            failed in this call, left transparent in the raster.
+
+        Returns
+        -------
+        raster : str or np.memmap
+            The path of the GeoTIFF, or the memory mapped array.
+        extent : tuple
+            Bounding box [minX, maxX, minY, maxY] of the raster
+        """
+        assert driver in ['GTiff', 'npy'], "Check driver is within ['GTiff', 'npy']."
+        if not ll:
+            w, s = _sm2ll(w, s)
+            e, n = _sm2ll(e, n)
+        
+        if self.tile_coord_sys in ['gcj', 'bd']:
+            w, s = self.from_wgs(w, s)
+            e, n = self.from_wgs(e, n)
+
+        auto_zoom = zoom == "auto"
+        if auto_zoom:
+            zoom = self._calculate_zoom(w, s, e, n)
+        zoom = _validate_zoom(zoom, self.provider, auto=auto_zoom)
+
+        tiles = list(self.iter_tiles(w, s, e, n, [zoom]))
+        layout = self._mosaic_layout(tiles)
+        west, south, east, north = self._layout_bounds(layout, zoom)
+        if self.tile_coord_sys in ['gcj', 'bd']:
+            west, south = self.to_wgs(west, south)
+            east, north = self.to_wgs(east, north)
+        left, bottom = mt.xy(west, south)
+        right, top = mt.xy(east, north)
+
+        blocks = {}
+        for t in tiles:
+            row, col = self._tile_slot(t, layout)
+            blocks.setdefault((row // block_size, col // block_size), []).append(t)
+
+        dst, failures = None, []
+        n_rows, n_cols = layout[3] - layout[1] + 1, layout[2] - layout[0] + 1
+        for key in tqdm(sorted(blocks), desc="Writing blocks"):
+            block = blocks[key]
+            arrays = self._fetch_tiles(block, wait, max_retries, failed=failures)
+            if dst is None:
+                shapes = [arr.shape for arr in arrays if arr is not None]
+                if not shapes:
+                    continue
+                h, w_, d = shapes[0]
+                dst = self._open_raster(path, driver, n_rows * h, n_cols * w_, d, (left, bottom, right, top))
+            
+            # the failed tiles are left transparent
+            for t, arr in zip(block, arrays):
+                if arr is None:
+                    continue
+                row, col = self._tile_slot(t, layout)
+                if driver == 'npy':
+                    dst[row * h: (row + 1) * h, col * w_: (col + 1) * w_] = arr
+                else:
+                    from rasterio.windows import Window
+                    dst.write(np.moveaxis(arr, -1, 0), window=Window(col * w_, row * h, w_, h))
+
+        self.failed_tiles = failures
+        if failed is not None:
+            failed.extend(failures)
+        if dst is None:
+            raise TileFetchError(f"None of the {len(tiles)} tiles was fetched.", retryable=False)
+        
+        if driver == 'npy':
+            dst.flush()
+            raster = dst
+        else:
+            if overviews:
+                from rasterio.enums import Resampling
+                factors = [2 ** i for i in range(1, int(np.log2(max(dst.width, dst.height) / 256)) + 1)]
+                dst.build_overviews(factors, Resampling.average)
+                dst.update_tags(ns="rio_overview", resampling="average")
+            dst.close()
+            raster = path
+
+        if ll:
+            extent = west, east, south, north
+        else:
+            extent = left, right, bottom, top
+
+        return raster, extent
+
+
+    def _fetch_overzoom_tiles(self, tiles, wait=.5, max_retries=2, failed=None, store=True):
+        """Synthesize the tiles beyond `max_zoom` by cropping and upsampling their ancestors at `max_zoom`.
+
+        The synthesized tiles are encoded and cached on the `decoder` threads (PIL
+        releases the GIL while encoding), with a fast PNG compression since they
+        can be synthesized again; `store` as in `_fetch_tiles`.
+        """
+        from .pyramid import upsample, encode_png
+
+        max_zoom = self.provider.max_zoom
+        arrays = self._load_tiles(tiles, store=store)
+        todo = [i for i, arr in enumerate(arrays) if arr is None]
+        
+        d = tiles[0].z - max_zoom
+        ancestors = sorted({mt.Tile(tiles[i].x >> d, tiles[i].y >> d, max_zoom) for i in todo})
+        self.logger.debug(f"Synthesize {len(todo)} tiles at z{tiles[0].z} from {len(ancestors)} tiles at z{max_zoom}.")
+        ancestors = dict(zip(ancestors, self._fetch_tiles(ancestors, wait, max_retries, failed=failed, store=store)))
+        
+        flip = self.tile_coord_sys == 'bd'
+        def _synthesize(i):
+            tile = tiles[i]
+            parent = ancestors[mt.Tile(tile.x >> d, tile.y >> d, max_zoom)]
+            if parent is None:
+                return None
+            array = upsample(parent, tile, max_zoom, flip)
+            content = encode_png(array, OVERZOOM_COMPRESS_LEVEL)
+            with metrics.timer("cache_write_seconds", provider=self.provider.name):
+                self.cache.put(tile, content)
+            if self.arrays is not None and store:
+                array = self.arrays.put(self._array_key(tile, content), array)
+            return array
+
+        if self.decode_workers <= 1 or len(todo) < 2:
+            synthesized = [_synthesize(i) for i in todo]
+        else:
+            synthesized = self.decoder.map(_synthesize, todo)
+        for i, array in zip(todo, synthesized):
+            arrays[i] = array
+        self.cache.flush()
+        
+        return arrays
+
+
+    def _open_raster(self, path, driver, height, width, count, bounds):
+        if driver == 'npy':
+            return np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, count))
+
+        import rasterio as rio
+        from rasterio.transform import from_bounds
+        return rio.open(
+            path,
+            "w",
+            driver="GTiff",
+            height=height,
+            width=width,
+            count=count,
+            dtype=np.uint8,
+            crs="epsg:3857",
+            transform=from_bounds(*bounds, width, height),
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            compress="deflate",
+            BIGTIFF="IF_SAFER",
+        )
+
+
+    def _mosaic_layout(self, tiles):
+        """The (xmin, ymin, xmax, ymax) indexes of the tiles."""
+        xs = [t.x for t in tiles]
+        ys = [t.y for t in tiles]
+        
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+    def _tile_slot(self, tile, layout):
+        """The (row, col) of `tile` in the mosaic, rows run from north to south."""
+        xmin, ymin, _, ymax = layout
+        # 百度瓦片的 y 轴向北递增
+        row = ymax - tile.y if self.tile_coord_sys == 'bd' else tile.y - ymin
+        
+        return row, tile.x - xmin
+
+
+    def _layout_bounds(self, layout, z):
+        """The lon/lat bounding box (west, south, east, north) of the mosaic."""
+        xmin, ymin, xmax, ymax = layout
+        if self.tile_coord_sys == 'bd':
+            nw, se = mt.Tile(xmin, ymax, z), mt.Tile(xmax, ymin, z)
+        else:
+            nw, se = mt.Tile(xmin, ymin, z), mt.Tile(xmax, ymax, z)
+        nw, se = self.tile_bounds(nw), self.tile_bounds(se)
+
+        return nw.west, se.south, se.east, nw.north
+
+
+    def build_pyramid(self, zoom, min_zoom=0, bounds=None, n_jobs=-1, overwrite=False):
+        """Build the lower zoom levels offline, by downsampling the cached tiles of `zoom`.
+        
+        Refer to `pyramid.build_pyramid`.
+        """
+        from .pyramid import build_pyramid
+        
+        return build_pyramid(self, zoom, min_zoom, bounds, n_jobs, overwrite)
+
+
+    def regrid(self, dst, zooms, bounds=None, n_jobs=-1, overwrite=False):
+        """Re-grid the cached gcj/bd tiles into WGS84 aligned XYZ tiles written into `dst`.
+        
+        Refer to `regrid.regrid`.
+        """
+        from .regrid import regrid
+        
+        return regrid(self, dst, zooms, bounds, n_jobs, overwrite)
+
+
     def howmany(self, w, s, e, n, zoom, verbose=True, ll=False):
         """
         Number of tiles required for a given bounding box and a zoom level
@@ -264,7 +928,17 @@ class TileMap():
         return tiles
 
 
-    def _calculate_zoom(self, w, s, e, n):
+    def _validate_zoom(self, zoom, auto=False, overzoom=False):
+        # 超出 max_zoom 的级别由 max_zoom 的瓦片裁剪放大得到
+        max_zoom = self.provider.get('max_zoom')
+        if overzoom and max_zoom is not None and zoom > max_zoom:
+            assert zoom <= OVERZOOM_MAX_ZOOM, f"Check zoom {zoom} <= OVERZOOM_MAX_ZOOM ({OVERZOOM_MAX_ZOOM})."
+            return zoom
+        
+        return _validate_zoom(zoom, self.provider, auto=auto)
+
+
+    def _calculate_zoom(self, w, s, e, n, overzoom=False):
         """Automatically choose a zoom level given a desired number of tiles.
 
         .. note:: all values are interpreted as latitude / longitutde.
@@ -297,7 +971,9 @@ class TileMap():
         zoom_lat = np.ceil(np.log2(360 * 2.0 / lat_length))
         zoom = np.max([zoom_lon, zoom_lat])
         
-        if 'max_zoom' in self.provider:
+        if overzoom:
+            zoom = min(zoom, OVERZOOM_MAX_ZOOM)
+        elif 'max_zoom' in self.provider:
             zoom = min(zoom, self.provider.max_zoom)
         
         return int(zoom)